@@ -4,16 +4,37 @@
 订单查询Flask后端服务
 """
 
-from flask import Flask, request, jsonify, render_template, send_from_directory, send_file, redirect, url_for, flash, session
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, send_file, redirect, url_for, flash, session
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from werkzeug.security import check_password_hash, generate_password_hash
 from functools import wraps
 import sqlite3
+import math
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from excel_processor import OrderProcessor
+from bom_engine import BomCycleError, BomGraph, query_bom_tree, rebuild_where_used
+from cost_engine import (
+    BatchCostEngine, bump_config_version, calculate_product_cost as compute_product_cost,
+    compute_cost_variance, cost_details, get_cost_rules, save_cost_records, simulate_cost_changes
+)
+from production_order_manager import ProductionOrderManager
+from inventory_store import (
+    InventoryLockError, create_inventory_snapshot, get_inventory_as_of, load_category_rollup, reconcile_inventory,
+    record_item_deletion
+)
+from mrp_engine import (
+    PURCHASE_TEMPLATE_COLUMNS, check_available_to_promise, plan_material_requirements, purchase_suggestion_rows
+)
+from qr_labels import DEFAULT_COLUMNS, DEFAULT_ROWS, clamp_render_workers, generate_label_pdf, iter_label_pages
+from qr_store import (
+    QR_STORAGE_SQLITE, SQL_CHUNK_SIZE, ZipStreamBuffer, find_qr_file, get_indexed_qr_paths,
+    get_qr_blob_size, get_qr_storage_backend, list_qr_index, load_qr_blobs, qr_file_path,
+    qr_relative_path, remove_qr_files, resolve_short_code, write_qr_cache_file
+)
 import time
+import zipfile
 import pandas as pd
 
 app = Flask(__name__)
@@ -29,6 +50,7 @@ USERS = {
 # 配置
 DB_FILE = "orders.db"
 QR_DIR = "qrcodes"
+QR_STORAGE = get_qr_storage_backend()  # file 或 sqlite（环境变量 QR_STORAGE）
 UPLOAD_FOLDER = "uploads"
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
 
@@ -211,18 +233,71 @@ def list_orders():
             'message': str(e)
         }), 500
 
+def get_cached_qr_blob_file(order_id):
+    """数据库存储模式下获取二维码文件：以qr_images表为准，文件目录仅作缓存
+
+    缓存文件大小与数据库记录一致时直接使用，否则从数据库读取图片并重建缓存；
+    订单（及图片）已删除时返回None，不会继续提供残留的缓存文件。
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        blob_size = get_qr_blob_size(cursor, order_id)
+        if blob_size is None:
+            return None
+        
+        cache_path = qr_file_path(QR_DIR, order_id)
+        if os.path.exists(cache_path) and os.path.getsize(cache_path) == blob_size:
+            return cache_path
+        
+        blob = load_qr_blobs(cursor, [order_id]).get(order_id)
+    finally:
+        conn.close()
+    
+    if blob is None:
+        return None
+    return write_qr_cache_file(QR_DIR, order_id, blob)
+
 @app.route('/qrcode/<order_id>')
 def get_qrcode(order_id):
     """获取订单二维码图片"""
     try:
-        filename = f"order_{order_id}.png"
-        return send_from_directory(QR_DIR, filename)
+        if QR_STORAGE == QR_STORAGE_SQLITE:
+            qr_file = get_cached_qr_blob_file(order_id)
+        else:
+            # 优先读取分片路径 qrcodes/ab/cd/，兼容未迁移的平铺文件
+            qr_file = find_qr_file(QR_DIR, order_id)
+        if qr_file is None:
+            raise FileNotFoundError(order_id)
+        return send_from_directory(QR_DIR, os.path.relpath(qr_file, QR_DIR))
     except Exception as e:
         return jsonify({
             'error': '二维码不存在',
             'message': f'订单 {order_id} 的二维码不存在'
         }), 404
 
+@app.route('/q/<short_code>')
+def resolve_qr_short_code(short_code):
+    """二维码短链接 - 解析短码后跳转到公共查询页面"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        order_id = resolve_short_code(cursor, short_code)
+    except sqlite3.Error:
+        order_id = None
+    finally:
+        if conn:
+            conn.close()
+    
+    if not order_id:
+        return jsonify({
+            'error': '二维码无效',
+            'message': f'短码 {short_code} 未对应任何订单'
+        }), 404
+    
+    return redirect(url_for('public_query', order_id=order_id))
+
 @app.route('/health')
 def health_check():
     """健康检查"""
@@ -458,31 +533,37 @@ def get_all_orders():
 
 @app.route('/api/qrcodes')
 def get_qr_codes():
-    """获取二维码文件列表API"""
-    try:
-        if os.path.exists(QR_DIR):
-            qr_files = [f for f in os.listdir(QR_DIR) if f.endswith('.png')]
-            qr_list = []
-            for qr_file in qr_files:
-                order_id = qr_file.replace('order_', '').replace('.png', '')
-                qr_list.append({
-                    'order_id': order_id,
-                    'filename': qr_file,
-                    'url': f'/qrcode/{order_id}'
-                })
-            
-            return jsonify({
-                'success': True,
-                'qrcodes': qr_list,
-                'count': len(qr_list)
-            })
-        else:
-            return jsonify({
-                'success': True,
-                'qrcodes': [],
-                'count': 0
+    """获取二维码文件列表API（分页读取二维码索引表）"""
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 100)), 1), 1000)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        total, rows = list_qr_index(cursor, page, page_size)
+        conn.close()
+        
+        qr_list = []
+        for order_id, file_path, updated_at in rows:
+            qr_list.append({
+                'order_id': order_id,
+                'filename': file_path,
+                'url': f'/qrcode/{order_id}',
+                'updated_at': updated_at
             })
+        
+        return jsonify({
+            'success': True,
+            'qrcodes': qr_list,
+            'count': len(qr_list),
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'total_pages': (total + page_size - 1) // page_size
+        })
             
+    except ValueError:
+        return jsonify({'error': 'page和page_size必须是整数'}), 400
     except Exception as e:
         return jsonify({'error': f'获取二维码列表失败: {str(e)}'}), 500
 
@@ -507,14 +588,12 @@ def delete_single_order(order_id):
         cursor.execute('DELETE FROM orders WHERE order_id = ?', (order_id,))
         deleted_count = cursor.rowcount
         
+        # 删除对应的二维码文件及索引
+        remove_qr_files(cursor, QR_DIR, [order_id])
+        
         conn.commit()
         conn.close()
         
-        # 删除对应的二维码文件
-        qr_file = f"{QR_DIR}/order_{order_id}.png"
-        if os.path.exists(qr_file):
-            os.remove(qr_file)
-        
         return jsonify({
             'success': True,
             'message': f'订单 {order_id} 删除成功',
@@ -545,15 +624,12 @@ def delete_duplicate_orders():
         cursor.execute(f'DELETE FROM orders WHERE order_id IN ({placeholders})', order_ids)
         deleted_count = cursor.rowcount
         
+        # 同时删除对应的二维码文件及索引
+        remove_qr_files(cursor, QR_DIR, order_ids)
+        
         conn.commit()
         conn.close()
         
-        # 同时删除对应的二维码文件
-        for order_id in order_ids:
-            qr_file = f"{QR_DIR}/order_{order_id}.png"
-            if os.path.exists(qr_file):
-                os.remove(qr_file)
-        
         return jsonify({
             'success': True,
             'message': f'成功删除 {deleted_count} 个重复订单',
@@ -610,6 +686,9 @@ def export_qrcodes_excel():
             ORDER BY order_date DESC
         ''')
         orders = cursor.fetchall()
+        
+        # 从索引表批量获取二维码路径，避免逐个检查文件是否存在
+        indexed_paths = get_indexed_qr_paths(cursor, [order['order_id'] for order in orders])
         conn.close()
         
         if not orders:
@@ -650,12 +729,17 @@ def export_qrcodes_excel():
             ws.cell(row=current_row, column=4, value=f'¥{amount:.2f}')
             ws.cell(row=current_row, column=5, value=product_details)
             
-            # 插入二维码图片
-            qr_file = f"{QR_DIR}/order_{order_id}.png"
+            # 插入二维码图片（未入索引的旧文件回退到按路径查找）
+            if QR_STORAGE == QR_STORAGE_SQLITE:
+                qr_file = get_cached_qr_blob_file(order_id)
+            elif order_id in indexed_paths:
+                qr_file = os.path.join(QR_DIR, indexed_paths[order_id])
+            else:
+                qr_file = find_qr_file(QR_DIR, order_id)
             if OpenpyxlImage is None:
                 # 如果无法导入Image类，显示文本提示
                 ws.cell(row=current_row, column=6, value=f'二维码: {order_id}')
-            elif os.path.exists(qr_file):
+            elif qr_file:
                 try:
                     img = OpenpyxlImage(qr_file)
                     # 调整图片大小（适合打印）
@@ -671,7 +755,7 @@ def export_qrcodes_excel():
                 ws.cell(row=current_row, column=6, value=f'二维码: {order_id}')
             
             # 设置行高（如果有图片则高一些，否则正常高度）
-            if OpenpyxlImage is not None and os.path.exists(qr_file):
+            if OpenpyxlImage is not None and qr_file:
                 ws.row_dimensions[current_row].height = 65
             else:
                 ws.row_dimensions[current_row].height = 30
@@ -737,7 +821,7 @@ def export_simple_excel():
                 '订单日期': order_date,
                 '金额': f'¥{amount:.2f}',
                 '产品详情': product_details,
-                '二维码文件': f'qrcodes/order_{order_id}.png',
+                '二维码文件': f'{QR_DIR}/{qr_relative_path(order_id)}',
                 '查询链接': f'http://localhost:5000/order?order_id={order_id}'
             })
         
@@ -764,6 +848,202 @@ def export_simple_excel():
     except Exception as e:
         return jsonify({'error': f'简化Excel导出失败: {str(e)}'}), 500
 
+def iter_filtered_order_ids(start_date=None, end_date=None, product_code=None, order_ids=None):
+    """按日期范围、产品编码或订单号列表筛选订单，分批返回订单号（生成器）"""
+    conditions = []
+    params = []
+    if start_date:
+        conditions.append('date(order_date) >= date(?)')
+        params.append(start_date)
+    if end_date:
+        conditions.append('date(order_date) <= date(?)')
+        params.append(end_date)
+    if product_code:
+        conditions.append('product_code = ?')
+        params.append(product_code)
+    
+    # 每批单独打开连接，流式输出期间不长时间持有读锁（即时生成二维码时需要写库）
+    if order_ids:
+        # 显式订单号列表：分块查询，保持请求中的顺序
+        for start in range(0, len(order_ids), SQL_CHUNK_SIZE):
+            chunk = order_ids[start:start + SQL_CHUNK_SIZE]
+            placeholders = ','.join(['?' for _ in chunk])
+            chunk_conditions = conditions + [f'order_id IN ({placeholders})']
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT order_id FROM orders WHERE {' AND '.join(chunk_conditions)}",
+                params + chunk
+            )
+            found = {row['order_id'] for row in cursor.fetchall()}
+            conn.close()
+            batch = [order_id for order_id in chunk if order_id in found]
+            if batch:
+                yield batch
+    else:
+        # 按rowid键集分页，避免OFFSET越翻越慢
+        last_rowid = 0
+        while True:
+            batch_conditions = conditions + ['rowid > ?']
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""SELECT rowid, order_id FROM orders
+                    WHERE {' AND '.join(batch_conditions)}
+                    ORDER BY rowid LIMIT ?""",
+                params + [last_rowid, SQL_CHUNK_SIZE]
+            )
+            rows = cursor.fetchall()
+            conn.close()
+            if not rows:
+                break
+            last_rowid = rows[-1]['rowid']
+            yield [row['order_id'] for row in rows]
+
+def generate_qrcodes_zip(order_id_batches):
+    """逐个写入二维码图片并输出ZIP数据块，缺失的二维码即时生成，内存占用与订单数量无关"""
+    processor = OrderProcessor()
+    buffer = ZipStreamBuffer()
+    
+    # PNG本身已压缩，直接存储即可
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_STORED) as zf:
+        for batch in order_id_batches:
+            if QR_STORAGE == QR_STORAGE_SQLITE:
+                # 数据库存储：直接写出图片数据（memoryview，不额外复制），缺失的即时生成
+                conn = get_db_connection()
+                blobs = load_qr_blobs(conn.cursor(), batch)
+                conn.close()
+                missing = [order_id for order_id in batch if order_id not in blobs]
+                if missing:
+                    processor.ensure_qr_codes(missing)
+                    conn = get_db_connection()
+                    blobs.update(load_qr_blobs(conn.cursor(), missing))
+                    conn.close()
+                for order_id in batch:
+                    zf.writestr(f'order_{order_id}.png', blobs[order_id])
+                    yield buffer.drain()
+                continue
+            
+            conn = get_db_connection()
+            indexed_paths = get_indexed_qr_paths(conn.cursor(), batch)
+            conn.close()
+            
+            qr_files = {}
+            missing = []
+            for order_id in batch:
+                qr_file = None
+                if order_id in indexed_paths:
+                    qr_file = os.path.join(QR_DIR, indexed_paths[order_id])
+                if not qr_file or not os.path.exists(qr_file):
+                    qr_file = find_qr_file(QR_DIR, order_id)
+                if qr_file:
+                    qr_files[order_id] = qr_file
+                else:
+                    missing.append(order_id)
+            
+            if missing:
+                for order_id, relative_path in processor.ensure_qr_codes(missing).items():
+                    qr_files[order_id] = os.path.join(QR_DIR, relative_path)
+            
+            for order_id in batch:
+                zf.write(qr_files[order_id], arcname=f'order_{order_id}.png')
+                yield buffer.drain()
+    
+    # 写出ZIP中央目录
+    yield buffer.drain()
+
+def parse_order_filter_batches():
+    """解析导出请求中的订单筛选条件（GET查询参数或POST JSON），返回分批订单号生成器"""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        order_ids = data.get('order_ids') or []
+    else:
+        data = request.args
+        order_ids = request.args.getlist('order_id')
+    
+    if not isinstance(order_ids, list):
+        raise ValueError('order_ids必须是数组')
+    
+    return iter_filtered_order_ids(
+        start_date=data.get('start_date'),
+        end_date=data.get('end_date'),
+        product_code=data.get('product_code'),
+        order_ids=[str(order_id) for order_id in order_ids]
+    )
+
+def peek_batches(batches):
+    """取出第一批订单号，没有匹配订单时返回None，否则返回包含全部批次的生成器"""
+    first_batch = next(batches, None)
+    if first_batch is None:
+        return None
+    
+    def all_batches():
+        yield first_batch
+        yield from batches
+    
+    return all_batches()
+
+@app.route('/export/qrcodes.zip', methods=['GET', 'POST'])
+@login_required
+def export_qrcodes_zip():
+    """流式下载筛选订单的二维码ZIP包（按日期范围、产品编码或订单号列表）"""
+    try:
+        try:
+            batches = parse_order_filter_batches()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # 先取第一批，没有匹配订单时直接返回错误而不是空ZIP
+        batches = peek_batches(batches)
+        if batches is None:
+            return jsonify({'error': '没有符合条件的订单'}), 404
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return Response(
+            generate_qrcodes_zip(batches),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename=qrcodes_{timestamp}.zip'}
+        )
+        
+    except Exception as e:
+        return jsonify({'error': f'导出二维码ZIP失败: {str(e)}'}), 500
+
+@app.route('/export/labels.pdf', methods=['GET', 'POST'])
+@login_required
+def export_label_sheets():
+    """生成N联二维码标签页PDF（A4），筛选条件同 /export/qrcodes.zip"""
+    try:
+        options = (request.get_json() or {}) if request.method == 'POST' else request.args
+        columns = int(options.get('columns', DEFAULT_COLUMNS))
+        rows = int(options.get('rows', DEFAULT_ROWS))
+        workers = clamp_render_workers(int(options['workers']) if options.get('workers') else None)
+        if not (1 <= columns <= 10 and 1 <= rows <= 20):
+            return jsonify({'error': '每页列数须在1-10之间，行数须在1-20之间'}), 400
+        
+        try:
+            batches = parse_order_filter_batches()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        batches = peek_batches(batches)
+        if batches is None:
+            return jsonify({'error': '没有符合条件的订单'}), 404
+        
+        base_url = OrderProcessor().base_url
+        pages = iter_label_pages(DB_FILE, batches, base_url, columns * rows)
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return Response(
+            generate_label_pdf(pages, columns=columns, rows=rows, workers=workers),
+            mimetype='application/pdf',
+            headers={'Content-Disposition': f'attachment; filename=labels_{timestamp}.pdf'}
+        )
+        
+    except ValueError:
+        return jsonify({'error': 'columns、rows和workers必须是整数'}), 400
+    except Exception as e:
+        return jsonify({'error': f'生成标签PDF失败: {str(e)}'}), 500
+
 @app.route('/api/profit_analysis')
 @login_required
 def get_profit_analysis():
@@ -900,12 +1180,15 @@ def get_profit_analysis():
 @app.route('/api/inventory_summary')
 @login_required
 def get_inventory_summary():
-    """获取库存汇总信息"""
+    """获取库存汇总信息（分类汇总 + 库存不足物料，物料明细按分类从 /api/inventory_items 加载）"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # 获取所有库存物料信息
+        # 分类汇总由触发器维护，只读分类行
+        categories = load_category_rollup(cursor)
+        
+        # 库存不足物料走部分索引
         cursor.execute('''
             SELECT 
                 item_code,
@@ -918,16 +1201,13 @@ def get_inventory_summary():
                 low_stock_threshold,
                 warning_stock_threshold
             FROM inventory_items
-            ORDER BY item_category, item_code
+            WHERE current_stock <= COALESCE(low_stock_threshold, 100)
+            ORDER BY current_stock ASC
         ''')
         
-        items = []
-        total_items = 0
-        total_stock = 0
-        total_value = 0
-        
+        low_stock_items = []
         for row in cursor.fetchall():
-            item = {
+            low_stock_items.append({
                 'item_code': row['item_code'],
                 'item_name': row['item_name'],
                 'item_category': row['item_category'],
@@ -935,23 +1215,23 @@ def get_inventory_summary():
                 'current_stock': float(row['current_stock']),
                 'weighted_avg_price': float(row['weighted_avg_price']),
                 'total_value': float(row['total_value']),
-                'low_stock_threshold': int(row['low_stock_threshold']),
-                'warning_stock_threshold': int(row['warning_stock_threshold'])
-            }
-            items.append(item)
-            
-            total_items += 1
-            total_stock += item['current_stock']
-            total_value += item['total_value']
+                'low_stock_threshold': int(row['low_stock_threshold'] or 100),
+                'warning_stock_threshold': int(row['warning_stock_threshold'] or 200)
+            })
         
         conn.close()
         
+        total_stock = sum(category['total_stock'] for category in categories)
+        total_value = sum(category['total_value'] for category in categories)
+        
         return jsonify({
             'success': True,
-            'items': items,
-            'total_items': total_items,
+            'categories': categories,
+            'low_stock_items': low_stock_items,
+            'total_categories': len(categories),
+            'total_items': sum(category['item_count'] for category in categories),
             'total_stock': int(total_stock),
-            'total_value': total_value
+            'total_value': round(total_value, 2)
         })
         
     except Exception as e:
@@ -961,6 +1241,111 @@ def get_inventory_summary():
             'error': str(e)
         }), 500
 
+@app.route('/api/inventory/as_of')
+@login_required
+def get_inventory_as_of_date():
+    """历史库存API：某日结束时各物料的库存和价值（最近快照 + 之后的库存流水）"""
+    try:
+        as_of_date = request.args.get('date')
+        try:
+            as_of_date = datetime.strptime(as_of_date or '', '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            return jsonify({'success': False, 'error': 'date 参数格式应为 YYYY-MM-DD'}), 400
+        category = request.args.get('category')
+        item_code = request.args.get('item_code')
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        method, snapshot_date, balances, scanned = get_inventory_as_of(cursor, as_of_date)
+        cursor.execute('SELECT item_code, item_name, item_category, unit FROM inventory_items')
+        names = {row['item_code']: row for row in cursor.fetchall()}
+        conn.close()
+        
+        items = []
+        for code in sorted(balances):
+            info = names.get(code)
+            if item_code and code != item_code:
+                continue
+            if category and (info is None or info['item_category'] != category):
+                continue
+            stock, price, value = balances[code]
+            items.append({
+                'item_code': code,
+                'item_name': info['item_name'] if info else code,
+                'item_category': info['item_category'] if info else None,
+                'unit': info['unit'] if info else None,
+                'stock': round(stock, 4),
+                'weighted_avg_price': round(price, 4),
+                'total_value': round(value, 2)
+            })
+        
+        return jsonify({
+            'success': True,
+            'date': as_of_date,
+            'method': method,
+            'snapshot_date': snapshot_date,
+            'transactions_scanned': scanned,
+            'items': items,
+            'total_items': len(items),
+            'total_value': round(sum(item['total_value'] for item in items), 2)
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'获取历史库存失败: {str(e)}'}), 500
+
+@app.route('/api/inventory/snapshots', methods=['POST'])
+@login_required
+def create_inventory_snapshot_now():
+    """立即记录当天的库存余额快照（同一天重复执行时覆盖）"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        count = create_inventory_snapshot(cursor)
+        conn.commit()
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'snapshot_date': datetime.now().strftime('%Y-%m-%d'),
+            'item_count': count
+        })
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'记录库存快照失败: {str(e)}'}), 500
+
+@app.route('/api/inventory/reconcile', methods=['GET', 'POST'])
+@login_required
+def reconcile_inventory_api():
+    """库存对账API：按库存流水重新计算账面库存，GET 只报告差异，POST {"repair": true} 在同一事务中修复"""
+    repair = False
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        repair = bool(data.get('repair'))
+    
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        result = reconcile_inventory(cursor, repair=repair)
+        conn.commit()
+        return jsonify({
+            'success': True,
+            'checked': result['checked'],
+            'drift': result['drift'],
+            'drift_count': len(result['drift']),
+            'orphans': result['orphans'],
+            'rollup_drift': result['rollup_drift'],
+            'repaired': result['repaired']
+        })
+        
+    except InventoryLockError as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 503
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': f'库存对账失败: {str(e)}'}), 500
+    finally:
+        conn.close()
+
 @app.route('/api/cost_analysis')
 @login_required
 def get_cost_analysis():
@@ -1092,235 +1477,313 @@ def calculate_product_cost():
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # 获取BOM清单
-        cursor.execute('''
-            SELECT 
-                bi.material_code,
-                bi.required_quantity as quantity,
-                ii.weighted_avg_price,
-                ii.item_name
-            FROM bom_items bi 
-            JOIN inventory_items ii ON bi.material_code = ii.item_code
-            WHERE bi.product_code = ?
-        ''', (product_code,))
-        
-        bom_items = cursor.fetchall()
+        # 多级BOM展开计算材料成本（半成品按其BOM逐级累计）
+        graph = BomGraph.load(cursor)
         
-        if not bom_items:
+        if not graph.has_bom(product_code):
             return jsonify({'success': False, 'error': '找不到产品的BOM清单'}), 404
         
-        # 计算材料成本
-        material_cost = 0
-        for item in bom_items:
-            qty = float(item['quantity']) if item['quantity'] is not None else 0
-            price = float(item['weighted_avg_price']) if item['weighted_avg_price'] is not None else 0
-            material_cost += qty * price
-        
-        # 获取所有有效的成本配置项
-        cursor.execute('''
-            SELECT 
-                item_name,
-                item_type,
-                default_value,
-                unit,
-                description
-            FROM cost_config_items 
-            WHERE is_active = 1
-            ORDER BY id
-        ''')
-        configs = cursor.fetchall()
-        
-        # 初始化成本字典
-        costs = {
-            'material_cost': material_cost,  # 材料成本是基础成本
-            'labor_cost': 0,                 # 人工成本将基于工时计算
-            'management_cost': 0,            # 管理成本
-            'transport_cost': 0,             # 运输成本
-            'other_costs': {},               # 其他成本项
-            'tax_rate': None,                # 税率配置
-            'tax_cost': 0                    # 税费金额
-        }
+        try:
+            rules = get_cost_rules(cursor)
+            costs = compute_product_cost(cursor, product_code, quantity, labor_hours, graph=graph, rules=rules)
+        except BomCycleError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        # 处理每个成本配置项
-        for config in configs:
-            name = config['item_name']
-            value = float(config['default_value'])
-            cost_type = config['item_type']
-            
-            # 如果是税率配置，先保存起来，最后计算
-            if name == '税费':
-                costs['tax_rate'] = {
-                    'name': name,
-                    'value': value,
-                    'type': cost_type
-                }
-                continue
-            
-            # 根据配置项名称和类型计算成本
-            if name == '人工费率':
-                if cost_type == 'fixed':
-                    costs['labor_cost'] = labor_hours * value  # 固定值：每小时费率
-                else:
-                    costs['labor_cost'] = material_cost * (value / 100)  # 百分比：占材料成本比例
-            elif name == '管理费率':
-                if cost_type == 'fixed':
-                    costs['management_cost'] = value  # 固定值
-                else:
-                    costs['management_cost'] = material_cost * (value / 100)  # 百分比
-            elif name == '运输费率':
-                if cost_type == 'fixed':
-                    costs['transport_cost'] = value  # 固定值
-                else:
-                    costs['transport_cost'] = material_cost * (value / 100)  # 百分比
-            else:  # 处理其他所有成本项（包括设备折旧费等）
-                if cost_type == 'fixed':
-                    costs['other_costs'][name] = value  # 固定值
-                else:
-                    costs['other_costs'][name] = material_cost * (value / 100)  # 百分比：基于材料成本
-        
-        # 计算中间总成本（不含税）
-        subtotal_cost = (
-            costs['material_cost'] + 
-            costs['labor_cost'] + 
-            costs['management_cost'] + 
-            costs['transport_cost'] + 
-            sum(costs['other_costs'].values())
-        )
+        save_cost_records(cursor, [costs])
         
-        # 计算税费（基于不含税总成本）
-        if costs['tax_rate']:
-            tax_config = costs['tax_rate']
-            if tax_config['type'] == 'percentage':
-                costs['tax_cost'] = subtotal_cost * (tax_config['value'] / 100)  # 基于不含税总成本计算
-            else:
-                costs['tax_cost'] = tax_config['value']  # 固定税费
+        conn.commit()
+        conn.close()
         
-        # 计算最终总成本（含税）
-        total_cost = subtotal_cost + costs['tax_cost']
-        unit_cost = total_cost / quantity if quantity > 0 else 0
+        return jsonify({
+            'success': True,
+            'cost': {
+                'product_code': product_code,
+                'total_cost': round(costs['total_cost'], 2),
+                'subtotal_cost': round(costs['subtotal_cost'], 2),
+                'unit_cost': round(costs['unit_cost'], 2),
+                'quantity': quantity,
+                'labor_hours': labor_hours,
+                'cost_details': cost_details(rules, costs),
+                'calculation_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+        })
         
-        # 生成成本记录ID
-        cost_id = f"COST_{product_code}"
+    except Exception as e:
+        print(f"❌ 计算产品成本失败: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# 批量报价单次最多的产品行数
+MAX_QUOTE_ITEMS = 5000
+
+@app.route('/api/costs/recalculate_all', methods=['POST'])
+@login_required
+def recalculate_all_costs():
+    """批量重新计算所有有BOM产品的单件成本并保存"""
+    try:
+        data = request.get_json(silent=True) or {}
+        labor_hours = float(data.get('labor_hours', 0))
         
-        # 先删除该产品的旧成本记录
-        cursor.execute('DELETE FROM production_costs WHERE product_code = ?', (product_code,))
+        conn = get_db_connection()
+        cursor = conn.cursor()
         
-        # 保存新的成本记录
-        cursor.execute('''
-            INSERT INTO production_costs (
-                cost_id, 
-                product_code, 
-                material_cost,
-                labor_cost,
-                management_cost,
-                transport_cost,
-                other_cost,
-                tax_cost,
-                total_cost,
-                quantity,
-                unit_cost,
-                calculation_date
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (
-            cost_id,
-            product_code,
-            costs['material_cost'],
-            costs['labor_cost'],
-            costs['management_cost'],
-            costs['transport_cost'],
-            sum(costs['other_costs'].values()),  # 其他所有费用
-            costs['tax_cost'],
-            total_cost,
-            quantity,
-            unit_cost
-        ))
+        engine = BatchCostEngine.load(cursor)
+        records = engine.recalculate_all(labor_hours)
+        save_cost_records(cursor, records)
         
         conn.commit()
         conn.close()
         
-        # 准备成本明细
-        cost_details = []
-        
-        # 1. 材料成本
-        cost_details.append({
-            'name': '材料成本',
-            'value': costs['material_cost'],
-            'type': 'fixed',
-            'percentage': (costs['material_cost'] / total_cost * 100) if total_cost > 0 else 0
+        return jsonify({
+            'success': True,
+            'count': len(records),
+            'costs': records,
+            'errors': engine.errors,
+            'calculation_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
         
-        # 2. 人工成本
-        labor_config = next((c for c in configs if c['item_name'] == '人工费率'), None)
-        cost_details.append({
-            'name': '人工成本',
-            'value': costs['labor_cost'],
-            'type': labor_config['item_type'] if labor_config else 'fixed',
-            'percentage': (costs['labor_cost'] / total_cost * 100) if total_cost > 0 else 0
-        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'批量计算成本失败: {str(e)}'}), 500
+
+@app.route('/api/costs/quote', methods=['POST'])
+@login_required
+def quote_costs():
+    """批量报价API：一次计算多个(产品, 数量)的成本，不保存成本记录"""
+    try:
+        data = request.get_json(silent=True) or {}
+        raw_items = data.get('items')
         
-        # 3. 管理成本
-        management_config = next((c for c in configs if c['item_name'] == '管理费率'), None)
-        cost_details.append({
-            'name': '管理成本',
-            'value': costs['management_cost'],
-            'type': management_config['item_type'] if management_config else 'fixed',
-            'percentage': (costs['management_cost'] / total_cost * 100) if total_cost > 0 else 0
-        })
+        if not isinstance(raw_items, list) or not raw_items:
+            return jsonify({'success': False, 'error': '缺少报价明细 items'}), 400
+        if len(raw_items) > MAX_QUOTE_ITEMS:
+            return jsonify({'success': False, 'error': f'单次最多报价 {MAX_QUOTE_ITEMS} 行'}), 400
+        
+        items = []
+        for item in raw_items:
+            if not isinstance(item, dict) or not item.get('product_code'):
+                return jsonify({'success': False, 'error': '报价明细缺少产品编码'}), 400
+            items.append((
+                str(item['product_code']),
+                float(item.get('quantity', 1)),
+                float(item.get('labor_hours', 0))
+            ))
+        
+        conn = get_db_connection()
+        engine = BatchCostEngine.load(conn.cursor())
+        conn.close()
         
-        # 4. 运输成本
-        transport_config = next((c for c in configs if c['item_name'] == '运输费率'), None)
-        cost_details.append({
-            'name': '运输成本',
-            'value': costs['transport_cost'],
-            'type': transport_config['item_type'] if transport_config else 'fixed',
-            'percentage': (costs['transport_cost'] / total_cost * 100) if total_cost > 0 else 0
+        quotes, errors = engine.quote(items)
+        
+        return jsonify({
+            'success': True,
+            'quotes': quotes,
+            'errors': errors,
+            'total_cost': round(sum(quote['total_cost'] for quote in quotes), 2)
         })
         
-        # 5. 其他成本项
-        for name, value in costs['other_costs'].items():
-            config = next((c for c in configs if c['item_name'] == name), None)
-            if config:
-                cost_details.append({
-                    'name': name,
-                    'value': value,
-                    'type': config['item_type'],
-                    'percentage': (value / total_cost * 100) if total_cost > 0 else 0
-                })
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'参数格式错误: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'批量报价失败: {str(e)}'}), 500
+
+@app.route('/api/costs/simulate', methods=['POST'])
+@login_required
+def simulate_costs():
+    """成本假设分析API：按调整后的原料价格和成本配置重算成本与订单毛利，只读不保存"""
+    try:
+        data = request.get_json(silent=True) or {}
+        
+        for field in ('price_overrides', 'price_changes', 'config_overrides'):
+            if not isinstance(data.get(field) or {}, dict):
+                return jsonify({'success': False, 'error': f'{field} 必须是对象'}), 400
         
-        # 6. 税费（如果有）
-        if costs['tax_rate']:
-            cost_details.append({
-                'name': costs['tax_rate']['name'],
-                'value': costs['tax_cost'],
-                'type': costs['tax_rate']['type'],
-                'percentage': (costs['tax_cost'] / total_cost * 100) if total_cost > 0 else 0,
-                'is_tax': True
+        conn = get_db_connection()
+        try:
+            result = simulate_cost_changes(
+                conn.cursor(),
+                price_overrides=data.get('price_overrides'),
+                price_changes=data.get('price_changes'),
+                config_overrides=data.get('config_overrides'),
+                labor_hours=float(data.get('labor_hours', 0))
+            )
+        finally:
+            conn.close()
+        
+        return jsonify({'success': True, **result})
+        
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({'success': False, 'error': f'参数格式错误: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'成本模拟失败: {str(e)}'}), 500
+
+# 成本历史降采样的时间桶（SQLite日期表达式，周以周一为起点）
+COST_HISTORY_BUCKETS = {
+    'day': "date(calculation_date)",
+    'week': "date(calculation_date, 'weekday 0', '-6 days')",
+    'month': "strftime('%Y-%m-01', calculation_date)",
+}
+
+@app.route('/api/costs/history')
+@login_required
+def get_cost_history():
+    """产品单位成本历史API：按天/周/月在SQL中降采样，图表点数与成本记录数无关"""
+    try:
+        try:
+            end_date = datetime.strptime(request.args.get('end_date') or datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
+            start_date = datetime.strptime(
+                request.args.get('start_date') or (end_date - timedelta(days=90)).strftime('%Y-%m-%d'), '%Y-%m-%d'
+            )
+        except ValueError:
+            return jsonify({'success': False, 'error': '日期格式应为 YYYY-MM-DD'}), 400
+        if start_date > end_date:
+            return jsonify({'success': False, 'error': '开始日期不能晚于结束日期'}), 400
+        
+        # 未指定粒度时按时间跨度自动选择
+        interval = request.args.get('interval', 'auto')
+        if interval == 'auto':
+            days = (end_date - start_date).days
+            interval = 'day' if days <= 92 else 'week' if days <= 730 else 'month'
+        if interval not in COST_HISTORY_BUCKETS:
+            return jsonify({'success': False, 'error': 'interval 只能是 day、week、month 或 auto'}), 400
+        
+        product_codes = [
+            code.strip()
+            for value in request.args.getlist('product_code')
+            for code in value.split(',') if code.strip()
+        ]
+        
+        conditions = ["calculation_date >= ?", "calculation_date < date(?, '+1 day')"]
+        params = [start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')]
+        if product_codes:
+            conditions.append(f"product_code IN ({','.join(['?' for _ in product_codes])})")
+            params.extend(product_codes)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            WITH bucketed AS (
+                SELECT
+                    product_code,
+                    unit_cost,
+                    {COST_HISTORY_BUCKETS[interval]} AS bucket,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY product_code, {COST_HISTORY_BUCKETS[interval]}
+                        ORDER BY calculation_date DESC, id DESC
+                    ) AS rn
+                FROM production_costs
+                WHERE {' AND '.join(conditions)}
+            )
+            SELECT
+                product_code,
+                bucket,
+                COUNT(*) AS calculations,
+                AVG(unit_cost) AS avg_unit_cost,
+                MIN(unit_cost) AS min_unit_cost,
+                MAX(unit_cost) AS max_unit_cost,
+                MAX(CASE WHEN rn = 1 THEN unit_cost END) AS last_unit_cost
+            FROM bucketed
+            GROUP BY product_code, bucket
+            ORDER BY product_code, bucket
+        ''', params)
+        
+        series = {}
+        for row in cursor.fetchall():
+            series.setdefault(row['product_code'], []).append({
+                'bucket': row['bucket'],
+                'calculations': row['calculations'],
+                'avg_unit_cost': round(row['avg_unit_cost'], 2),
+                'min_unit_cost': round(row['min_unit_cost'], 2),
+                'max_unit_cost': round(row['max_unit_cost'], 2),
+                'last_unit_cost': round(row['last_unit_cost'], 2)
             })
         
-        # 按照百分比降序排序
-        cost_details.sort(key=lambda x: x['percentage'], reverse=True)
+        conn.close()
         
         return jsonify({
             'success': True,
-            'cost': {
-                'product_code': product_code,
-                'total_cost': round(total_cost, 2),
-                'subtotal_cost': round(subtotal_cost, 2),
-                'unit_cost': round(unit_cost, 2),
-                'quantity': quantity,
-                'labor_hours': labor_hours,
-                'cost_details': [{
-                    **detail,
-                    'value': round(detail['value'], 2),
-                    'percentage': round(detail['percentage'], 2)
-                } for detail in cost_details],
-                'calculation_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
+            'interval': interval,
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+            'series': [{'product_code': code, 'points': points} for code, points in series.items()]
         })
         
     except Exception as e:
-        print(f"❌ 计算产品成本失败: {str(e)}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return jsonify({'success': False, 'error': f'获取成本历史失败: {str(e)}'}), 500
+
+# 成本差异导出的Excel列：(字段, 列名)
+COST_VARIANCE_COLUMNS = [
+    ('product_code', '产品编码'),
+    ('month', '月份'),
+    ('order_count', '订单数'),
+    ('quantity', '数量'),
+    ('revenue', '销售额'),
+    ('frozen_cost', '导入时成本'),
+    ('current_cost', '当前成本'),
+    ('variance', '成本差异'),
+    ('material_price_variance', '原料价格差异'),
+    ('rate_variance', '费率差异'),
+    ('frozen_margin', '导入时毛利'),
+    ('current_margin', '当前毛利'),
+    ('frozen_margin_rate', '导入时毛利率(%)'),
+    ('current_margin_rate', '当前毛利率(%)'),
+    ('estimated_count', '反推材料成本订单数'),
+]
+
+def load_cost_variance():
+    """按请求参数（start_date、end_date、product_code）计算订单成本差异"""
+    conn = get_db_connection()
+    try:
+        return compute_cost_variance(
+            conn.cursor(),
+            start_date=request.args.get('start_date'),
+            end_date=request.args.get('end_date'),
+            product_code=request.args.get('product_code')
+        )
+    finally:
+        conn.close()
+
+@app.route('/api/costs/variance')
+@login_required
+def get_cost_variance():
+    """订单成本差异API：导入时冻结成本 vs 当前成本，拆分原料价格差异与费率差异，按产品×月份汇总"""
+    try:
+        result = load_cost_variance()
+        return jsonify({'success': True, **result})
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'成本差异分析失败: {str(e)}'}), 500
+
+@app.route('/export/cost_variance.xlsx')
+@login_required
+def export_cost_variance():
+    """导出订单成本差异Excel（筛选参数同 /api/costs/variance）"""
+    try:
+        import io
+        
+        result = load_cost_variance()
+        if not result['groups']:
+            return jsonify({'error': '没有可分析的订单'}), 404
+        
+        totals = dict(result['totals'], product_code='合计', month='')
+        df = pd.DataFrame(
+            [[row[field] for field, _ in COST_VARIANCE_COLUMNS] for row in result['groups'] + [totals]],
+            columns=[title for _, title in COST_VARIANCE_COLUMNS]
+        )
+        
+        output = io.BytesIO()
+        df.to_excel(output, index=False, sheet_name='成本差异', engine='openpyxl')
+        output.seek(0)
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return send_file(
+            output,
+            as_attachment=True,
+            download_name=f'成本差异_{timestamp}.xlsx',
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+        
+    except Exception as e:
+        return jsonify({'error': f'导出成本差异失败: {str(e)}'}), 500
 
 @app.route('/api/product_costs')
 @login_required
@@ -1500,6 +1963,66 @@ def get_bom_list():
     except Exception as e:
         return jsonify({'error': f'获取BOM列表失败: {str(e)}'}), 500
 
+@app.route('/api/bom_tree/<product_code>')
+@login_required
+def get_bom_tree(product_code):
+    """BOM树API：递归展开产品的多级BOM，第一层子件分页"""
+    try:
+        page = max(request.args.get('page', 1, type=int), 1)
+        page_size = min(max(request.args.get('page_size', 100, type=int), 1), 1000)
+        child_limit = min(max(request.args.get('child_limit', page_size, type=int), 1), 1000)
+        max_depth = min(max(request.args.get('max_depth', 20, type=int), 1), 50)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM bom_items WHERE product_code = ?) AS children_total,
+                ii.item_name, ii.unit, ii.current_stock
+            FROM (SELECT 1) LEFT JOIN inventory_items ii ON ii.item_code = ?
+        ''', (product_code, product_code))
+        product = cursor.fetchone()
+        
+        if not product['children_total']:
+            conn.close()
+            return jsonify({'error': f'产品 {product_code} 没有BOM清单'}), 404
+        
+        children = query_bom_tree(
+            cursor, product_code,
+            offset=(page - 1) * page_size, limit=page_size,
+            child_limit=child_limit, max_depth=max_depth
+        )
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'product_code': product_code,
+            'product_name': product['item_name'] or product_code,
+            'unit': product['unit'],
+            'current_stock': float(product['current_stock'] or 0),
+            'children': children,
+            'children_total': product['children_total'],
+            'page': page,
+            'page_size': page_size,
+            'total_pages': (product['children_total'] + page_size - 1) // page_size
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'获取BOM树失败: {str(e)}'}), 500
+
+def refresh_bom_index(cursor, changed_products, check_cycle=True):
+    """BOM修改后（当前事务内）检查修改的产品是否陷入循环引用，并只重建这些产品及其上层产品的物料反查索引，
+    存在循环时返回循环路径"""
+    graph = BomGraph.load(cursor)
+    if check_cycle:
+        for product_code in changed_products:
+            cycle = graph.find_cycle(product_code)
+            if cycle:
+                return cycle
+    rebuild_where_used(cursor, graph, changed_products=changed_products)
+    return None
+
 @app.route('/api/bom_item', methods=['POST', 'PUT', 'DELETE'])
 @login_required
 def manage_bom_item():
@@ -1595,6 +2118,12 @@ def manage_bom_item():
                 data.get('notes', '')
             ))
             
+            cycle = refresh_bom_index(cursor, [product_code])
+            if cycle:
+                conn.rollback()
+                conn.close()
+                return jsonify({'error': f"BOM存在循环引用: {' → '.join(cycle)}"}), 400
+            
             conn.commit()
             conn.close()
             
@@ -1636,15 +2165,28 @@ def manage_bom_item():
             
             update_values.append(data['id'])
             
+            # 改产品编码时原产品也少了一个子件，两者的反查索引都要重建
+            cursor.execute('SELECT product_code FROM bom_items WHERE id = ?', (data['id'],))
+            old_item = cursor.fetchone()
+            
             cursor.execute(f'''
                 UPDATE bom_items 
                 SET {', '.join(update_fields)}
                 WHERE id = ?
+                RETURNING product_code
             ''', update_values)
+            updated_item = cursor.fetchone()
             
-            if cursor.rowcount == 0:
+            if updated_item is None:
                 return jsonify({'error': 'BOM项目不存在'}), 404
             
+            if 'product_code' in data or 'material_code' in data:
+                cycle = refresh_bom_index(cursor, {old_item['product_code'], updated_item['product_code']})
+                if cycle:
+                    conn.rollback()
+                    conn.close()
+                    return jsonify({'error': f"BOM存在循环引用: {' → '.join(cycle)}"}), 400
+            
             conn.commit()
             conn.close()
             
@@ -1658,11 +2200,13 @@ def manage_bom_item():
             if 'id' not in data:
                 return jsonify({'error': '缺少BOM项目ID'}), 400
             
-            cursor.execute('DELETE FROM bom_items WHERE id = ?', (data['id'],))
+            cursor.execute('DELETE FROM bom_items WHERE id = ? RETURNING product_code', (data['id'],))
+            deleted_item = cursor.fetchone()
             
-            if cursor.rowcount == 0:
+            if deleted_item is None:
                 return jsonify({'error': 'BOM项目不存在'}), 404
             
+            refresh_bom_index(cursor, [deleted_item['product_code']], check_cycle=False)
             conn.commit()
             conn.close()
             
@@ -1674,6 +2218,42 @@ def manage_bom_item():
     except Exception as e:
         return jsonify({'error': f'BOM项目操作失败: {str(e)}'}), 500
 
+@app.route('/api/materials/<material_code>/where_used')
+@login_required
+def get_material_where_used(material_code):
+    """物料反查API：列出直接或通过半成品间接使用该物料的所有产品"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT w.product_code, w.depth, ii.item_name, ii.item_category
+            FROM bom_where_used w
+            LEFT JOIN inventory_items ii ON w.product_code = ii.item_code
+            WHERE w.material_code = ?
+            ORDER BY w.depth, w.product_code
+        ''', (material_code,))
+        
+        products = [{
+            'product_code': row['product_code'],
+            'product_name': row['item_name'],
+            'category': row['item_category'],
+            'depth': row['depth'],
+            'direct': row['depth'] == 1
+        } for row in cursor.fetchall()]
+        
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'material_code': material_code,
+            'products': products,
+            'count': len(products)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'获取物料使用情况失败: {str(e)}'}), 500
+
 @app.route('/api/bom_item/<int:bom_id>')
 @login_required
 def get_bom_item(bom_id):
@@ -1886,6 +2466,247 @@ def get_products_with_bom():
             'error': str(e)
         }), 500
 
+def load_mrp_plan():
+    """按请求参数计算物料需求计划
+
+    GET 参数: include_pending（默认true）
+    POST JSON: {"demand": {产品编码: 数量}, "scheduled_receipts": {物料编码: 数量}, "include_pending": true}
+    """
+    options = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    include_pending = options.get('include_pending', True)
+    if isinstance(include_pending, str):
+        include_pending = include_pending.lower() not in ('0', 'false', 'no')
+    demand = options.get('demand') if request.method == 'POST' else None
+    scheduled_receipts = options.get('scheduled_receipts') if request.method == 'POST' else None
+    if (demand is not None and not isinstance(demand, dict)) or \
+            (scheduled_receipts is not None and not isinstance(scheduled_receipts, dict)):
+        raise ValueError('demand 和 scheduled_receipts 必须是 {编码: 数量} 对象')
+    
+    conn = get_db_connection()
+    try:
+        return plan_material_requirements(
+            conn.cursor(),
+            demand=demand,
+            scheduled_receipts=scheduled_receipts,
+            include_pending=bool(include_pending)
+        )
+    finally:
+        conn.close()
+
+@app.route('/api/mrp/plan', methods=['GET', 'POST'])
+@login_required
+def get_mrp_plan():
+    """物料需求计划API：展开待处理需求、按库存和安全库存净额计算，返回采购建议"""
+    try:
+        plan = load_mrp_plan()
+        return jsonify({'success': True, **plan})
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'物料需求计划计算失败: {str(e)}'}), 500
+
+@app.route('/export/purchase_suggestions.xlsx', methods=['GET', 'POST'])
+@login_required
+def export_purchase_suggestions():
+    """按采购订单模板格式导出采购建议（参数同 /api/mrp/plan），确认后可直接上传入库"""
+    try:
+        import io
+        
+        plan = load_mrp_plan()
+        if not plan['suggestions']:
+            return jsonify({'error': '当前没有需要采购的物料'}), 404
+        
+        df = pd.DataFrame(purchase_suggestion_rows(plan['suggestions']), columns=PURCHASE_TEMPLATE_COLUMNS)
+        output = io.BytesIO()
+        df.to_excel(output, index=False, engine='openpyxl')
+        output.seek(0)
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return send_file(
+            output,
+            as_attachment=True,
+            download_name=f'采购建议_{timestamp}.xlsx',
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'导出采购建议失败: {str(e)}'}), 500
+
+@app.route('/api/atp', methods=['POST'])
+@login_required
+def check_atp():
+    """批量可承诺量检查API：按顺序用成品库存和原料库存（经多级BOM展开）分配，只读不扣减
+
+    请求: {"lines": [{"product_code": "PROD001", "quantity": 10}, ...]}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        raw_lines = data.get('lines')
+        
+        if not isinstance(raw_lines, list) or not raw_lines:
+            return jsonify({'success': False, 'error': '缺少订单明细 lines'}), 400
+        if len(raw_lines) > MAX_QUOTE_ITEMS:
+            return jsonify({'success': False, 'error': f'单次最多检查 {MAX_QUOTE_ITEMS} 行'}), 400
+        
+        lines = []
+        for line in raw_lines:
+            if not isinstance(line, dict) or not line.get('product_code'):
+                return jsonify({'success': False, 'error': '订单明细缺少产品编码'}), 400
+            raw_quantity = line.get('quantity', 1)
+            try:
+                quantity = float(raw_quantity) if not isinstance(raw_quantity, bool) else math.nan
+            except (TypeError, ValueError):
+                quantity = math.nan
+            if not math.isfinite(quantity):
+                return jsonify({'success': False, 'error': f'数量必须是有限数值: {raw_quantity!r}'}), 400
+            if quantity < 0:
+                return jsonify({'success': False, 'error': '数量不能为负数'}), 400
+            lines.append((str(line['product_code']), quantity))
+        
+        conn = get_db_connection()
+        try:
+            results = check_available_to_promise(conn.cursor(), lines)
+        finally:
+            conn.close()
+        
+        return jsonify({
+            'success': True,
+            'lines': results,
+            'all_promised': all(result['can_promise'] for result in results),
+            'shortfall_count': sum(1 for result in results if not result['can_promise'])
+        })
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'参数格式错误: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'可承诺量检查失败: {str(e)}'}), 500
+
+PRODUCTION_ORDER_STATUSES = ('planned', 'released', 'completed')
+
+@app.route('/api/production_orders')
+@login_required
+def get_production_orders():
+    """生产订单列表API（按状态、产品筛选，分页）"""
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 100)), 1), 1000)
+        status = request.args.get('status')
+        product_code = request.args.get('product_code')
+        if status and status not in PRODUCTION_ORDER_STATUSES:
+            return jsonify({'error': 'status 只能是 planned、released 或 completed'}), 400
+        
+        conditions = []
+        params = []
+        if status:
+            conditions.append('p.status = ?')
+            params.append(status)
+        if product_code:
+            conditions.append('p.product_code = ?')
+            params.append(product_code)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT COUNT(*) FROM production_orders p {where}', params)
+        total = cursor.fetchone()[0]
+        
+        cursor.execute(f'''
+            SELECT
+                p.production_order_id, p.product_code, i.item_name AS product_name, p.quantity, p.status,
+                p.created_at, p.released_at, p.completed_at,
+                (SELECT COUNT(*) FROM production_order_lines l
+                 WHERE l.production_order_id = p.production_order_id) AS line_count,
+                (SELECT COUNT(*) FROM orders o
+                 WHERE o.production_order_id = p.production_order_id) AS sales_order_count
+            FROM production_orders p
+            LEFT JOIN inventory_items i ON p.product_code = i.item_code
+            {where}
+            ORDER BY p.created_at DESC, p.id DESC
+            LIMIT ? OFFSET ?
+        ''', params + [page_size, (page - 1) * page_size])
+        production_orders = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'production_orders': production_orders,
+            'count': len(production_orders),
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'total_pages': (total + page_size - 1) // page_size
+        })
+        
+    except ValueError:
+        return jsonify({'error': 'page和page_size必须是整数'}), 400
+    except Exception as e:
+        return jsonify({'error': f'获取生产订单列表失败: {str(e)}'}), 500
+
+@app.route('/api/production_orders/<production_order_id>')
+@login_required
+def get_production_order(production_order_id):
+    """生产订单详情API：原料消耗明细和对应的销售订单"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT production_order_id, product_code, quantity, status, created_at, released_at, completed_at
+            FROM production_orders WHERE production_order_id = ?
+        ''', (production_order_id,))
+        production_order = cursor.fetchone()
+        if not production_order:
+            conn.close()
+            return jsonify({'error': '生产订单不存在'}), 404
+        
+        cursor.execute('''
+            SELECT l.material_code, i.item_name AS material_name, l.quantity, i.unit
+            FROM production_order_lines l
+            LEFT JOIN inventory_items i ON l.material_code = i.item_code
+            WHERE l.production_order_id = ?
+            ORDER BY l.material_code
+        ''', (production_order_id,))
+        lines = [dict(row) for row in cursor.fetchall()]
+        
+        cursor.execute('''
+            SELECT order_id, customer_name, order_date, quantity
+            FROM orders WHERE production_order_id = ?
+            ORDER BY order_date, order_id
+        ''', (production_order_id,))
+        sales_orders = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        
+        return jsonify({
+            'success': True,
+            'production_order': dict(production_order),
+            'lines': lines,
+            'sales_orders': sales_orders
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'获取生产订单详情失败: {str(e)}'}), 500
+
+@app.route('/api/production_orders/<production_order_id>/complete', methods=['POST'])
+@login_required
+def complete_production_order(production_order_id):
+    """生产订单完工API：状态改为 completed，成品按生产数量入库"""
+    try:
+        conn = get_db_connection()
+        try:
+            result = ProductionOrderManager(DB_FILE, conn=conn).complete_production_order(production_order_id)
+        finally:
+            conn.close()
+        
+        if not result['success']:
+            status_code = 404 if '不存在' in result['error'] else 400
+            return jsonify(result), status_code
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({'error': f'生产订单完工失败: {str(e)}'}), 500
+
 @app.route('/api/order_profit_report')
 @login_required
 def get_order_profit_report():
@@ -2105,6 +2926,7 @@ def add_cost_config_item():
             data.get('description', '')
         ))
         
+        bump_config_version(cursor)
         conn.commit()
         conn.close()
         
@@ -2144,6 +2966,7 @@ def update_cost_config_item(item_id):
             item_id
         ))
         
+        bump_config_version(cursor)
         conn.commit()
         conn.close()
         
@@ -2173,6 +2996,7 @@ def delete_cost_config_item(item_id):
             WHERE id = ?
         ''', (item_id,))
         
+        bump_config_version(cursor)
         conn.commit()
         conn.close()
         
@@ -2274,7 +3098,9 @@ def init_app():
             else:
                 print("❌ 数据库初始化失败")
         else:
-            print("✅ 数据库已存在，跳过初始化")
+            # 已有数据库：补建新增的表（CREATE TABLE IF NOT EXISTS，不影响现有数据）
+            print("✅ 数据库已存在，检查表结构...")
+            OrderProcessor().init_database()
         
         print("✅ 应用初始化完成")
     except Exception as e:
@@ -2582,11 +3408,17 @@ def delete_inventory_item(item_code):
         bom_count = cursor.fetchone()['count']
         
         if bom_count > 0:
-            # 先删除相关的BOM记录
-            cursor.execute('DELETE FROM bom_items WHERE material_code = ? OR product_code = ?', (item_code, item_code))
-            print(f"删除了 {cursor.rowcount} 条相关的BOM记录")
+            # 先删除相关的BOM记录，只重建受影响产品的反查索引
+            cursor.execute(
+                'DELETE FROM bom_items WHERE material_code = ? OR product_code = ? RETURNING product_code',
+                (item_code, item_code)
+            )
+            changed_products = {row['product_code'] for row in cursor.fetchall()}
+            print(f"删除了 {bom_count} 条相关的BOM记录")
+            rebuild_where_used(cursor, changed_products=changed_products)
         
-        # 删除库存物料
+        # 删除库存物料，保留流水和快照供历史库存查询，只记一笔冲销流水把账面库存冲为零
+        record_item_deletion(cursor, item_code)
         cursor.execute('DELETE FROM inventory_items WHERE item_code = ?', (item_code,))
         deleted_count = cursor.rowcount
         
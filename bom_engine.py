@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多级BOM展开引擎
+一次性读取 bom_items 构建产品结构图，检测循环引用并拓扑排序，
+缓存每个半成品的累计材料成本和展开到最底层原料的需求量。
+物料反查索引 bom_where_used 记录每个物料被哪些产品（含多级上层产品）使用，
+BOM变更时只重建变更产品及其上层产品的索引行
+"""
+
+from collections import defaultdict, deque
+
+# SQLite单条语句的参数数量有限，批量查询时分块
+SQL_CHUNK_SIZE = 500
+
+
+class BomCycleError(ValueError):
+    """BOM存在循环引用（例如 A 需要 B，B 又需要 A）"""
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super().__init__(f"BOM存在循环引用: {' → '.join(cycle)}")
+
+
+class BomGraph:
+    """产品结构图：产品 → [(子件, 单位用量)]，子件本身有BOM时视为半成品继续展开"""
+
+    def __init__(self, bom_rows, items=None):
+        """
+        bom_rows: [(product_code, material_code, required_quantity)]
+        items: {item_code: (weighted_avg_price, current_stock, unit)}
+        """
+        self.children = defaultdict(list)
+        for product_code, material_code, required_quantity in bom_rows:
+            self.children[product_code].append((material_code, float(required_quantity or 0)))
+
+        self.items = items or {}
+        self.order, self.cyclic = self._topological_sort()
+        self._unit_cost_memo = {}
+        self._flatten_memo = {}
+
+    @classmethod
+    def load(cls, cursor):
+        """从数据库读取全部BOM和物料价格（两次查询）构建产品结构图"""
+        cursor.execute('SELECT product_code, material_code, required_quantity FROM bom_items')
+        bom_rows = [tuple(row) for row in cursor.fetchall()]
+        cursor.execute('SELECT item_code, weighted_avg_price, current_stock, unit FROM inventory_items')
+        items = {row[0]: (float(row[1] or 0), float(row[2] or 0), row[3]) for row in cursor.fetchall()}
+        return cls(bom_rows, items)
+
+    def _topological_sort(self):
+        """按子件在前、父件在后的顺序排序（Kahn算法），返回 (顺序列表, 处于循环中或依赖循环的节点集合)"""
+        nodes = set(self.children)
+        parents = defaultdict(set)
+        pending = {}
+        for product_code, components in self.children.items():
+            distinct = {material_code for material_code, _ in components}
+            pending[product_code] = len(distinct)
+            for material_code in distinct:
+                parents[material_code].add(product_code)
+                nodes.add(material_code)
+
+        queue = deque(node for node in nodes if pending.get(node, 0) == 0)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for parent in parents[node]:
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    queue.append(parent)
+
+        return order, nodes - set(order)
+
+    def has_bom(self, code):
+        """是否有BOM清单（产品或半成品）"""
+        return bool(self.children.get(code))
+
+    def price(self, code):
+        return self.items.get(code, (0, 0, None))[0]
+
+    def stock(self, code):
+        return self.items.get(code, (0, 0, None))[1]
+
+    def unit(self, code):
+        return self.items.get(code, (0, 0, None))[2]
+
+    def find_cycle(self, start):
+        """返回从start可达的一条循环路径（首尾相同），不存在时返回None"""
+        if start not in self.cyclic:
+            return None
+
+        path = []
+        on_path = set()
+        visited = set()
+
+        def visit(node):
+            path.append(node)
+            on_path.add(node)
+            for child, _ in self.children.get(node, []):
+                if child in on_path:
+                    return path[path.index(child):] + [child]
+                if child in self.cyclic and child not in visited:
+                    cycle = visit(child)
+                    if cycle:
+                        return cycle
+            visited.add(node)
+            on_path.discard(node)
+            path.pop()
+            return None
+
+        return visit(start)
+
+    def _check_acyclic(self, code):
+        if code in self.cyclic:
+            raise BomCycleError(self.find_cycle(code) or [code])
+
+    def unit_cost(self, code):
+        """单位材料成本：原料取加权平均价，有BOM的产品/半成品按子件成本逐级累加"""
+        if code in self._unit_cost_memo:
+            return self._unit_cost_memo[code]
+        self._check_acyclic(code)
+
+        components = self.children.get(code)
+        if not components:
+            cost = self.price(code)
+        else:
+            cost = sum(quantity * self.unit_cost(child) for child, quantity in components)
+
+        self._unit_cost_memo[code] = cost
+        return cost
+
+    def flatten(self, code):
+        """展开到最底层原料的单位需求量 {原料编码: 数量}，无BOM的物料返回自身"""
+        if code in self._flatten_memo:
+            return self._flatten_memo[code]
+        self._check_acyclic(code)
+
+        components = self.children.get(code)
+        if not components:
+            flat = {code: 1.0}
+        else:
+            totals = defaultdict(float)
+            for child, quantity in components:
+                for material_code, material_quantity in self.flatten(child).items():
+                    totals[material_code] += quantity * material_quantity
+            flat = dict(totals)
+
+        self._flatten_memo[code] = flat
+        return flat
+
+    def where_used(self):
+        """物料反查：{物料编码: {使用它的产品编码: 最小层级}}，层级1为直接使用"""
+        parents = defaultdict(set)
+        for product_code, components in self.children.items():
+            for material_code, _ in components:
+                parents[material_code].add(product_code)
+
+        index = {}
+        for material_code in parents:
+            depths = {}
+            queue = deque((parent, 1) for parent in parents[material_code])
+            while queue:
+                code, depth = queue.popleft()
+                if code in depths:
+                    continue
+                depths[code] = depth
+                queue.extend((parent, depth + 1) for parent in parents.get(code, ()) if parent not in depths)
+            index[material_code] = depths
+        return index
+
+    def ancestors(self, codes):
+        """codes 及直接或间接使用它们的所有产品"""
+        parents = defaultdict(set)
+        for product_code, components in self.children.items():
+            for material_code, _ in components:
+                parents[material_code].add(product_code)
+
+        found = set(codes)
+        queue = deque(found)
+        while queue:
+            for parent in parents.get(queue.popleft(), ()):
+                if parent not in found:
+                    found.add(parent)
+                    queue.append(parent)
+        return found
+
+    def descendants(self, code):
+        """产品直接或间接使用的物料：{物料编码: 最小层级}，层级1为直接使用"""
+        depths = {}
+        queue = deque((child, 1) for child, _ in self.children.get(code, []))
+        while queue:
+            child, depth = queue.popleft()
+            if child in depths:
+                continue
+            depths[child] = depth
+            queue.extend(
+                (grandchild, depth + 1) for grandchild, _ in self.children.get(child, []) if grandchild not in depths
+            )
+        return depths
+
+    def requirements(self, code, quantity):
+        """生产 quantity 个产品所需的最底层原料 [(原料编码, 总需求量)]"""
+        return [
+            (material_code, unit_quantity * quantity)
+            for material_code, unit_quantity in sorted(self.flatten(code).items())
+        ]
+
+
+def rebuild_where_used(cursor, graph=None, changed_products=None):
+    """重建物料反查索引 bom_where_used（BOM变更后在同一事务内调用），返回写入的索引条数
+
+    changed_products 指定时只重建这些产品（BOM清单有增删子件的产品）及其上层产品的索引行，
+    变更只涉及这些产品的子件，上层产品按新结构图查找即可；未指定时全量重建。
+    """
+    graph = graph or BomGraph.load(cursor)
+    if changed_products is None:
+        rows = [
+            (material_code, product_code, depth)
+            for material_code, products in graph.where_used().items()
+            for product_code, depth in products.items()
+        ]
+        cursor.execute('DELETE FROM bom_where_used')
+    else:
+        changed_products = set(changed_products)
+        if not changed_products:
+            return 0
+        affected = sorted(graph.ancestors(changed_products))
+        rows = [
+            (material_code, product_code, depth)
+            for product_code in affected
+            for material_code, depth in graph.descendants(product_code).items()
+        ]
+        for start in range(0, len(affected), SQL_CHUNK_SIZE):
+            chunk = affected[start:start + SQL_CHUNK_SIZE]
+            placeholders = ','.join(['?' for _ in chunk])
+            cursor.execute(f'DELETE FROM bom_where_used WHERE product_code IN ({placeholders})', chunk)
+    cursor.executemany(
+        'INSERT INTO bom_where_used (material_code, product_code, depth) VALUES (?, ?, ?)',
+        rows
+    )
+    return len(rows)
+
+
+def get_where_used_products(cursor, material_codes):
+    """查询使用这些物料的所有产品编码（含多级上层产品）"""
+    material_codes = list(material_codes)
+    products = set()
+    for start in range(0, len(material_codes), SQL_CHUNK_SIZE):
+        chunk = material_codes[start:start + SQL_CHUNK_SIZE]
+        placeholders = ','.join(['?' for _ in chunk])
+        cursor.execute(
+            f'SELECT DISTINCT product_code FROM bom_where_used WHERE material_code IN ({placeholders})',
+            chunk
+        )
+        products.update(row[0] for row in cursor.fetchall())
+    return products
+
+
+def query_bom_tree(cursor, product_code, offset=0, limit=100, child_limit=100, max_depth=20):
+    """单条 WITH RECURSIVE 查询展开产品BOM树，返回第一层子件列表（嵌套children）
+
+    第一层按 offset/limit 分页，更深层每个节点最多返回 child_limit 个子件（children_total 为实际数量）；
+    cumulative_quantity 为每生产1个产品所需的累计数量，路径中已出现的物料不再展开以防循环引用。
+    """
+    cursor.execute('''
+        WITH RECURSIVE tree (
+            bom_id, node_path, parent_path, material_code, level,
+            required_quantity, cumulative_quantity, unit
+        ) AS (
+            SELECT
+                b.id, '/' || b.product_code || '/' || b.material_code || '/', '/' || b.product_code || '/',
+                b.material_code, 1, b.required_quantity, b.required_quantity, b.unit
+            FROM (
+                SELECT * FROM bom_items
+                WHERE product_code = ?
+                ORDER BY material_code, id
+                LIMIT ? OFFSET ?
+            ) b
+            UNION ALL
+            SELECT
+                b.id, t.node_path || b.material_code || '/', t.node_path,
+                b.material_code, t.level + 1, b.required_quantity,
+                t.cumulative_quantity * b.required_quantity, b.unit
+            FROM tree t
+            JOIN bom_items b ON b.product_code = t.material_code
+            WHERE t.level < ?
+              AND instr(t.node_path, '/' || b.material_code || '/') = 0
+        ),
+        numbered AS (
+            SELECT
+                t.*,
+                ROW_NUMBER() OVER (PARTITION BY t.parent_path ORDER BY t.material_code, t.bom_id) AS sibling_rank,
+                COUNT(*) OVER (PARTITION BY t.parent_path) AS sibling_count
+            FROM tree t
+        )
+        SELECT
+            n.bom_id, n.node_path, n.parent_path, n.material_code, n.level,
+            n.required_quantity, n.cumulative_quantity, n.unit, n.sibling_count,
+            ii.item_name, ii.item_category, ii.current_stock
+        FROM numbered n
+        LEFT JOIN inventory_items ii ON n.material_code = ii.item_code
+        WHERE n.level = 1 OR n.sibling_rank <= ?
+        ORDER BY n.level, n.parent_path, n.sibling_rank
+    ''', (product_code, limit, offset, max_depth, child_limit))
+
+    root = {'children': []}
+    nodes = {'/' + product_code + '/': root}
+    for row in cursor.fetchall():
+        parent = nodes.get(row[2])
+        if parent is None:
+            continue
+        node = {
+            'bom_id': row[0],
+            'material_code': row[3],
+            'material_name': row[9] or row[3],
+            'category': row[10],
+            'level': row[4],
+            'required_quantity': float(row[5] or 0),
+            'cumulative_quantity': float(row[6] or 0),
+            'unit': row[7],
+            'current_stock': float(row[11] or 0),
+            'children': [],
+            'children_total': 0
+        }
+        parent['children'].append(node)
+        parent['children_total'] = row[8]
+        nodes[row[1]] = node
+
+    for node in nodes.values():
+        node['truncated'] = node.get('children_total', 0) > len(node['children'])
+    return root['children']
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+成本历史压缩脚本
+合并内容相同的成本快照，并限制每个产品保留的成本历史条数，
+可定期执行（如每天一次的计划任务）
+"""
+
+import sqlite3
+import sys
+
+from cost_engine import COST_HISTORY_KEEP, compact_cost_history
+from excel_processor import OrderProcessor
+
+
+def compact_costs(db_file="orders.db", keep_per_product=COST_HISTORY_KEEP):
+    """压缩 production_costs 成本历史"""
+    print(f"🔧 开始压缩成本历史（每个产品保留最近 {keep_per_product} 条）...")
+
+    # 确保内容哈希列和索引存在
+    OrderProcessor(db_file=db_file, base_url="").init_database()
+
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("SELECT COUNT(*) FROM production_costs")
+        before = cursor.fetchone()[0]
+
+        merged, trimmed = compact_cost_history(cursor, keep_per_product)
+        conn.commit()
+
+        cursor.execute("SELECT COUNT(*) FROM production_costs")
+        after = cursor.fetchone()[0]
+
+        print(f"✅ 成本历史压缩完成！合并重复快照 {merged} 条，清理超期快照 {trimmed} 条，记录数 {before} → {after}")
+
+    except Exception as e:
+        print(f"❌ 压缩失败: {str(e)}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "orders.db"
+    keep = int(sys.argv[2]) if len(sys.argv) > 2 else COST_HISTORY_KEEP
+    compact_costs(db_path, keep)
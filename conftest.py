@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pytest 公共夹具：每个测试使用临时目录中的独立数据库，不影响 orders.db
+"""
+
+import contextlib
+import io
+import sqlite3
+
+import pytest
+
+from excel_processor import OrderProcessor
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    """已建表、已写入示例数据（物料、BOM）的临时数据库路径"""
+    path = str(tmp_path / 'test.db')
+    processor = OrderProcessor(db_file=path, base_url='http://test')
+    with contextlib.redirect_stdout(io.StringIO()):
+        processor.init_database()
+        processor.init_sample_data()
+    return path
+
+
+@pytest.fixture
+def conn(db_file):
+    """示例数据库连接，测试结束后关闭"""
+    connection = sqlite3.connect(db_file)
+    yield connection
+    connection.close()
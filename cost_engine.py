@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+产品成本计算
+导入销售订单、成本计算API、批量重算和报价共用同一套编译后的成本规则。
+批量计算时把多级BOM展开后的用量装入 产品×原料 稀疏矩阵、加权平均价装入价格向量，
+一次矩阵向量乘法得到所有产品的材料成本，再按 cost_config_items 向量化叠加各项费用
+"""
+
+import hashlib
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+from bom_engine import BomCycleError, BomGraph, get_where_used_products
+
+# 有专门成本列的配置项名称，其余配置项计入其他成本
+LABOR_CONFIG = '人工费率'
+MANAGEMENT_CONFIG = '管理费率'
+TRANSPORT_CONFIG = '运输费率'
+TAX_CONFIG = '税费'
+
+# config_versions 表中成本配置的版本号键名，配置项增删改时递增
+COST_CONFIG_VERSION_KEY = 'cost_config_items'
+
+# SQLite单条语句的参数数量有限，批量查询时分块
+SQL_CHUNK_SIZE = 500
+
+# 成本历史压缩时每个产品默认保留的快照数
+COST_HISTORY_KEEP = 100
+
+# 参与成本快照内容哈希的金额字段
+SNAPSHOT_FIELDS = [
+    'material_cost', 'labor_cost', 'management_cost', 'transport_cost',
+    'other_cost', 'tax_cost', 'total_cost'
+]
+
+COST_FIELDS = [
+    'material_cost', 'labor_cost', 'management_cost', 'transport_cost',
+    'other_cost', 'subtotal_cost', 'tax_cost', 'total_cost'
+]
+
+
+def _split_rate(rule):
+    """把 (类型, 数值) 拆成 (固定金额, 占材料成本的比例)"""
+    if rule is None:
+        return 0.0, 0.0
+    item_type, value = rule
+    if item_type == 'percentage':
+        return 0.0, value / 100
+    return value, 0.0
+
+
+def load_cost_configs(cursor):
+    """读取有效的成本配置项 [(item_name, item_type, default_value)]"""
+    cursor.execute('''
+        SELECT item_name, item_type, default_value
+        FROM cost_config_items
+        WHERE is_active = 1
+        ORDER BY id
+    ''')
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+class CostRules:
+    """编译后的成本规则：各项费用折算为固定金额与材料成本比例两组系数"""
+
+    def __init__(self, configs):
+        """configs: 按id排序的有效配置项 [(item_name, item_type, default_value)]，同名配置后者生效"""
+        named = {}
+        others = {}
+        for name, item_type, value in configs:
+            rule = (item_type, float(value or 0))
+            if name in (LABOR_CONFIG, MANAGEMENT_CONFIG, TRANSPORT_CONFIG, TAX_CONFIG):
+                named[name] = rule
+            else:
+                others[name] = rule
+
+        # 人工费固定值为每工时费率
+        self.labor_hourly_rate, self.labor_rate = _split_rate(named.get(LABOR_CONFIG))
+        self.management_fixed, self.management_rate = _split_rate(named.get(MANAGEMENT_CONFIG))
+        self.transport_fixed, self.transport_rate = _split_rate(named.get(TRANSPORT_CONFIG))
+        self.other_fixed = sum(_split_rate(rule)[0] for rule in others.values())
+        self.other_rate = sum(_split_rate(rule)[1] for rule in others.values())
+        # 税费基于不含税总成本：百分比按比例计算，固定值直接累加
+        self.tax_fixed, self.tax_rate = _split_rate(named.get(TAX_CONFIG))
+
+        # 成本明细展示用的配置类型
+        self.item_types = {name: rule[0] for name, rule in named.items()}
+        self.other_items = [(name, rule[0]) + _split_rate(rule) for name, rule in others.items()]
+
+    @classmethod
+    def load(cls, cursor):
+        return cls(load_cost_configs(cursor))
+
+    def compute(self, material_cost, labor_hours=0):
+        """按材料成本（标量或数组）计算各项成本，返回 {成本字段: 数组}"""
+        material_cost = np.asarray(material_cost, dtype=float)
+        labor_hours = np.asarray(labor_hours, dtype=float)
+
+        labor_cost = labor_hours * self.labor_hourly_rate + material_cost * self.labor_rate
+        management_cost = self.management_fixed + material_cost * self.management_rate
+        transport_cost = self.transport_fixed + material_cost * self.transport_rate
+        other_cost = self.other_fixed + material_cost * self.other_rate
+        subtotal_cost = material_cost + labor_cost + management_cost + transport_cost + other_cost
+        tax_cost = self.tax_fixed + subtotal_cost * self.tax_rate
+
+        shape = np.broadcast(material_cost, labor_hours).shape
+        costs = {
+            'material_cost': material_cost,
+            'labor_cost': labor_cost,
+            'management_cost': management_cost,
+            'transport_cost': transport_cost,
+            'other_cost': other_cost,
+            'subtotal_cost': subtotal_cost,
+            'tax_cost': tax_cost,
+            'total_cost': subtotal_cost + tax_cost,
+        }
+        return {field: np.broadcast_to(values, shape) for field, values in costs.items()}
+
+
+# 进程内已编译成本规则缓存：{数据库文件: (配置版本号, CostRules)}
+_cost_rules_cache = {}
+
+
+def bump_config_version(cursor, key=COST_CONFIG_VERSION_KEY):
+    """递增配置版本号（随调用方事务提交），各进程下次读取成本规则时重新编译"""
+    cursor.execute('''
+        INSERT INTO config_versions (config_key, version, updated_at)
+        VALUES (?, 1, CURRENT_TIMESTAMP)
+        ON CONFLICT(config_key) DO UPDATE SET
+            version = version + 1,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (key,))
+
+
+def get_cost_rules(cursor):
+    """获取已编译的成本规则：配置版本号未变化时直接使用进程内缓存
+
+    版本号保存在数据库中，多个gunicorn工作进程各自缓存，任一进程修改配置后其他进程都会失效重载。
+    """
+    cursor.execute('''
+        SELECT
+            (SELECT version FROM config_versions WHERE config_key = ?),
+            (SELECT file FROM pragma_database_list WHERE name = 'main')
+    ''', (COST_CONFIG_VERSION_KEY,))
+    version, db_file = cursor.fetchone()
+    version = version or 0
+
+    cached = _cost_rules_cache.get(db_file)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    rules = CostRules.load(cursor)
+    _cost_rules_cache[db_file] = (version, rules)
+    return rules
+
+
+class BatchCostEngine:
+    """所有产品的批量成本计算"""
+
+    def __init__(self, graph, rules, product_codes=None):
+        """product_codes 指定时只计算这些产品，否则计算所有有BOM的产品"""
+        self.rules = rules
+        self.errors = {}
+
+        if product_codes is None:
+            product_codes = graph.children
+        product_codes = sorted(code for code in set(product_codes) if graph.has_bom(code))
+
+        products = []
+        material_index = {}
+        rows, cols, quantities = [], [], []
+        for product_code in product_codes:
+            try:
+                flat = graph.flatten(product_code)
+            except BomCycleError as e:
+                self.errors[product_code] = str(e)
+                continue
+            row = len(products)
+            products.append(product_code)
+            for material_code, quantity in flat.items():
+                rows.append(row)
+                cols.append(material_index.setdefault(material_code, len(material_index)))
+                quantities.append(quantity)
+
+        self.products = products
+        self.product_index = {code: index for index, code in enumerate(products)}
+        self.materials = list(material_index)
+        self.material_index = material_index
+
+        # 稀疏矩阵（COO三元组）：第 rows[k] 个产品每件需要 quantities[k] 个第 cols[k] 种原料
+        self.bom_rows = np.array(rows, dtype=np.intp)
+        self.bom_cols = np.array(cols, dtype=np.intp)
+        self.bom_quantities = np.array(quantities, dtype=float)
+        self.prices = np.array([graph.price(code) for code in self.materials], dtype=float)
+        self.unit_material_costs = self.material_costs(self.prices)
+
+    @classmethod
+    def load(cls, cursor):
+        return cls(BomGraph.load(cursor), get_cost_rules(cursor))
+
+    def material_costs(self, prices):
+        """各产品单位材料成本 = BOM稀疏矩阵 × 价格向量"""
+        return np.bincount(
+            self.bom_rows,
+            weights=self.bom_quantities * prices[self.bom_cols],
+            minlength=len(self.products)
+        )
+
+    def recalculate_all(self, labor_hours=0):
+        """计算所有产品单件成本，返回成本记录列表"""
+        quantities = np.ones(len(self.products))
+        costs = self.rules.compute(self.unit_material_costs, labor_hours)
+        return cost_records(self.products, quantities, costs)
+
+    def quote(self, items):
+        """批量报价：items 为 [(product_code, quantity, labor_hours)]，返回 (成本记录列表, {产品编码: 错误})"""
+        known = [item for item in items if item[0] in self.product_index]
+        errors = {
+            code: self.errors.get(code, '找不到产品的BOM清单')
+            for code, _, _ in items if code not in self.product_index
+        }
+        if not known:
+            return [], errors
+
+        product_codes = [code for code, _, _ in known]
+        index = np.array([self.product_index[code] for code in product_codes], dtype=np.intp)
+        quantities = np.array([quantity for _, quantity, _ in known], dtype=float)
+        labor_hours = np.array([hours for _, _, hours in known], dtype=float)
+
+        costs = self.rules.compute(self.unit_material_costs[index] * quantities, labor_hours)
+        return cost_records(product_codes, quantities, costs), errors
+
+
+def recalculate_affected_costs(cursor, material_codes):
+    """原料价格变化后，按反查索引只重算使用这些原料的产品（含多级上层产品），返回重算的产品数"""
+    product_codes = get_where_used_products(cursor, material_codes)
+    if not product_codes:
+        return 0
+    engine = BatchCostEngine(BomGraph.load(cursor), get_cost_rules(cursor), product_codes)
+    records = engine.recalculate_all()
+    save_cost_records(cursor, records)
+    return len(records)
+
+
+def cost_records(product_codes, quantities, costs):
+    """把向量化计算结果转换为每个产品一条的成本记录（金额保留两位小数）"""
+    totals = costs['total_cost']
+    unit_costs = np.divide(totals, quantities, out=np.zeros_like(totals, dtype=float), where=quantities > 0)
+    columns = {field: np.round(costs[field], 2).tolist() for field in COST_FIELDS}
+    columns['unit_cost'] = np.round(unit_costs, 2).tolist()
+
+    records = []
+    for index, product_code in enumerate(product_codes):
+        record = {'product_code': product_code, 'quantity': float(quantities[index])}
+        for field, values in columns.items():
+            record[field] = values[index]
+        records.append(record)
+    return records
+
+
+def simulate_cost_changes(cursor, price_overrides=None, price_changes=None, config_overrides=None, labor_hours=0):
+    """假设分析：在内存中按调整后的原料价格和成本配置重算所有产品及已有订单的成本，不写入数据库
+
+    price_overrides: {原料编码: 新单价}
+    price_changes: {原料编码: 涨跌百分比}，如 12 表示上涨12%
+    config_overrides: {配置项名称: 新数值 或 {"type": ..., "value": ...}}，不存在的配置项视为新增
+    """
+    engine = BatchCostEngine.load(cursor)
+    configs = load_cost_configs(cursor)
+
+    # 调整原料价格向量
+    prices = engine.prices.copy()
+    unknown_materials = []
+    for code, price in (price_overrides or {}).items():
+        if code in engine.material_index:
+            prices[engine.material_index[code]] = float(price)
+        else:
+            unknown_materials.append(code)
+    for code, percent in (price_changes or {}).items():
+        if code in engine.material_index:
+            prices[engine.material_index[code]] *= 1 + float(percent) / 100
+        elif code not in unknown_materials:
+            unknown_materials.append(code)
+
+    # 调整成本配置（同名配置后者生效，覆盖项追加在最后即可）
+    existing_types = {name: item_type for name, item_type, _ in configs}
+    simulated_configs = list(configs)
+    for name, override in (config_overrides or {}).items():
+        if isinstance(override, dict):
+            item_type = override.get('type', existing_types.get(name, 'fixed'))
+            value = override['value']
+        else:
+            item_type = existing_types.get(name, 'fixed')
+            value = override
+        simulated_configs.append((name, item_type, float(value)))
+    simulated_rules = CostRules(simulated_configs)
+
+    base_material = engine.unit_material_costs
+    simulated_material = engine.material_costs(prices)
+    base_unit = engine.rules.compute(base_material, labor_hours)['total_cost']
+    simulated_unit = simulated_rules.compute(simulated_material, labor_hours)['total_cost']
+    unit_delta = simulated_unit - base_unit
+
+    changed = np.flatnonzero(np.abs(unit_delta) >= 0.005)
+    changed = changed[np.argsort(-np.abs(unit_delta[changed]), kind='stable')]
+    products = [
+        {
+            'product_code': engine.products[index],
+            'base_unit_cost': round(float(base_unit[index]), 2),
+            'simulated_unit_cost': round(float(simulated_unit[index]), 2),
+            'delta': round(float(unit_delta[index]), 2),
+            'delta_percent': round(float(unit_delta[index] / base_unit[index] * 100), 2) if base_unit[index] else None
+        }
+        for index in changed
+    ]
+
+    # 已有订单的毛利影响：按订单数量重算整单成本（固定费用每单计一次，与导入时一致）
+    cursor.execute('SELECT product_code, quantity, amount FROM orders WHERE product_code IS NOT NULL')
+    order_rows = [row for row in cursor.fetchall() if row[0] in engine.product_index]
+    if order_rows:
+        order_index = np.array([engine.product_index[row[0]] for row in order_rows], dtype=np.intp)
+        quantities = np.array([row[1] or 0 for row in order_rows], dtype=float)
+        revenue = np.array([row[2] or 0 for row in order_rows], dtype=float)
+    else:
+        order_index = np.zeros(0, dtype=np.intp)
+        quantities = revenue = np.zeros(0)
+
+    base_cost = engine.rules.compute(base_material[order_index] * quantities)['total_cost']
+    simulated_cost = simulated_rules.compute(simulated_material[order_index] * quantities)['total_cost']
+
+    product_count = len(engine.products)
+    by_revenue = np.bincount(order_index, weights=revenue, minlength=product_count)
+    by_base = np.bincount(order_index, weights=base_cost, minlength=product_count)
+    by_simulated = np.bincount(order_index, weights=simulated_cost, minlength=product_count)
+    by_orders = np.bincount(order_index, minlength=product_count)
+
+    margin_by_product = [
+        {
+            'product_code': engine.products[index],
+            'order_count': int(by_orders[index]),
+            'revenue': round(float(by_revenue[index]), 2),
+            'base_margin': round(float(by_revenue[index] - by_base[index]), 2),
+            'simulated_margin': round(float(by_revenue[index] - by_simulated[index]), 2),
+            'margin_delta': round(float(by_base[index] - by_simulated[index]), 2)
+        }
+        for index in np.flatnonzero(by_orders)
+    ]
+
+    total_revenue = float(revenue.sum())
+    base_margin = total_revenue - float(base_cost.sum())
+    simulated_margin = total_revenue - float(simulated_cost.sum())
+    return {
+        'products': products,
+        'product_count': product_count,
+        'changed_count': len(products),
+        'orders_impact': {
+            'order_count': len(order_rows),
+            'revenue': round(total_revenue, 2),
+            'base_margin': round(base_margin, 2),
+            'simulated_margin': round(simulated_margin, 2),
+            'margin_delta': round(simulated_margin - base_margin, 2),
+            'base_margin_rate': round(base_margin / total_revenue * 100, 2) if total_revenue else None,
+            'simulated_margin_rate': round(simulated_margin / total_revenue * 100, 2) if total_revenue else None,
+            'by_product': margin_by_product
+        },
+        'unknown_materials': unknown_materials,
+        'errors': engine.errors
+    }
+
+
+def compute_cost_variance(cursor, start_date=None, end_date=None, product_code=None):
+    """订单成本差异分析：对比导入时冻结的订单成本与按当前原料价格、成本配置重算的成本
+
+    差异拆分为两部分（向量化一次算完所有订单）：
+    - 原料价格差异 = 当前规则(当前材料成本) - 当前规则(冻结材料成本)
+    - 费率差异 = 当前规则(冻结材料成本) - 冻结总成本
+    旧订单没有冻结材料成本时，按当前规则由冻结总成本反推，差异全部计入原料价格差异。
+    导入时未能计算成本（profit_status 为 unknown）或产品没有BOM的订单不参与分析。
+    返回按 产品×月份 汇总的差异列表和合计
+    """
+    engine = BatchCostEngine.load(cursor)
+
+    conditions = ["product_code IS NOT NULL", "profit_status != 'unknown'"]
+    params = []
+    if start_date:
+        conditions.append('date(order_date) >= date(?)')
+        params.append(start_date)
+    if end_date:
+        conditions.append('date(order_date) <= date(?)')
+        params.append(end_date)
+    if product_code:
+        conditions.append('product_code = ?')
+        params.append(product_code)
+    cursor.execute(f"""
+        SELECT product_code, substr(order_date, 1, 7), quantity, amount, total_cost, material_cost
+        FROM orders WHERE {' AND '.join(conditions)}
+    """, params)
+    rows = cursor.fetchall()
+    order_rows = [row for row in rows if row[0] in engine.product_index]
+    skipped = len(rows) - len(order_rows)
+
+    order_index = np.array([engine.product_index[row[0]] for row in order_rows], dtype=np.intp)
+    quantities = np.array([row[2] or 0 for row in order_rows], dtype=float)
+    revenue = np.array([row[3] or 0 for row in order_rows], dtype=float)
+    frozen_cost = np.array([row[4] or 0 for row in order_rows], dtype=float)
+    frozen_material = np.array([np.nan if row[5] is None else row[5] for row in order_rows], dtype=float)
+
+    rules = engine.rules
+    current_material = engine.unit_material_costs[order_index] * quantities
+    current_cost = rules.compute(current_material)['total_cost']
+
+    # 总成本是材料成本的一次函数：total = slope × material + base，据此反推旧订单的冻结材料成本
+    estimated = np.isnan(frozen_material)
+    base = float(rules.compute(0.0)['total_cost'])
+    slope = float(rules.compute(1.0)['total_cost']) - base
+    if slope:
+        frozen_material = np.where(estimated, (frozen_cost - base) / slope, frozen_material)
+    else:
+        frozen_material = np.where(estimated, 0.0, frozen_material)
+
+    repriced_cost = np.where(estimated, frozen_cost, rules.compute(frozen_material)['total_cost'])
+    material_variance = current_cost - repriced_cost
+    rate_variance = repriced_cost - frozen_cost
+
+    # 按 产品×月份 分组汇总
+    months = [row[1] or '' for row in order_rows]
+    keys = np.array([f"{row[0]}\t{month}" for row, month in zip(order_rows, months)], dtype=object)
+    if len(keys):
+        group_keys, group_index = np.unique(keys, return_inverse=True)
+    else:
+        group_keys, group_index = np.zeros(0, dtype=object), np.zeros(0, dtype=np.intp)
+    group_count = len(group_keys)
+
+    def group_sum(values):
+        return np.bincount(group_index, weights=values, minlength=group_count)
+
+    sums = {
+        'quantity': group_sum(quantities),
+        'revenue': group_sum(revenue),
+        'frozen_cost': group_sum(frozen_cost),
+        'current_cost': group_sum(current_cost),
+        'material_price_variance': group_sum(material_variance),
+        'rate_variance': group_sum(rate_variance),
+    }
+    order_counts = np.bincount(group_index, minlength=group_count)
+    estimated_counts = np.bincount(group_index, weights=estimated, minlength=group_count)
+
+    def summarize(values, order_count, estimated_count):
+        revenue_total = values['revenue']
+        frozen_margin = revenue_total - values['frozen_cost']
+        current_margin = revenue_total - values['current_cost']
+        return {
+            'order_count': int(order_count),
+            'estimated_count': int(estimated_count),
+            'quantity': round(values['quantity'], 2),
+            'revenue': round(revenue_total, 2),
+            'frozen_cost': round(values['frozen_cost'], 2),
+            'current_cost': round(values['current_cost'], 2),
+            'variance': round(values['current_cost'] - values['frozen_cost'], 2),
+            'material_price_variance': round(values['material_price_variance'], 2),
+            'rate_variance': round(values['rate_variance'], 2),
+            'frozen_margin': round(frozen_margin, 2),
+            'current_margin': round(current_margin, 2),
+            'frozen_margin_rate': round(frozen_margin / revenue_total * 100, 2) if revenue_total else None,
+            'current_margin_rate': round(current_margin / revenue_total * 100, 2) if revenue_total else None,
+        }
+
+    groups = []
+    for index, key in enumerate(group_keys):
+        group_product, month = key.split('\t', 1)
+        values = {field: float(column[index]) for field, column in sums.items()}
+        group = {'product_code': group_product, 'month': month}
+        group.update(summarize(values, order_counts[index], estimated_counts[index]))
+        groups.append(group)
+
+    totals = summarize(
+        {field: float(column.sum()) for field, column in sums.items()},
+        len(order_rows), int(estimated.sum())
+    )
+    totals['skipped_count'] = skipped
+    return {'groups': groups, 'totals': totals, 'errors': engine.errors}
+
+
+def calculate_product_cost(cursor, product_code, quantity=1, labor_hours=0, graph=None, rules=None):
+    """计算单个产品的完整成本，返回未取整的成本字典（没有BOM的产品材料成本为0）
+
+    graph、rules 可传入已加载的BOM结构图和成本规则，批量导入时避免重复查询。
+    """
+    graph = graph or BomGraph.load(cursor)
+    rules = rules or get_cost_rules(cursor)
+
+    material_cost = graph.unit_cost(product_code) * quantity if graph.has_bom(product_code) else 0.0
+    costs = {field: float(value) for field, value in rules.compute(material_cost, labor_hours).items()}
+    costs['unit_cost'] = costs['total_cost'] / quantity if quantity > 0 else 0
+    costs['product_code'] = product_code
+    costs['quantity'] = quantity
+    return costs
+
+
+def cost_details(rules, costs):
+    """成本构成明细（按占总成本比例降序）"""
+    total_cost = costs['total_cost']
+    details = [
+        ('材料成本', costs['material_cost'], 'fixed', False),
+        ('人工成本', costs['labor_cost'], rules.item_types.get(LABOR_CONFIG, 'fixed'), False),
+        ('管理成本', costs['management_cost'], rules.item_types.get(MANAGEMENT_CONFIG, 'fixed'), False),
+        ('运输成本', costs['transport_cost'], rules.item_types.get(TRANSPORT_CONFIG, 'fixed'), False),
+    ]
+    for name, item_type, fixed, rate in rules.other_items:
+        details.append((name, fixed + costs['material_cost'] * rate, item_type, False))
+    if TAX_CONFIG in rules.item_types:
+        details.append((TAX_CONFIG, costs['tax_cost'], rules.item_types[TAX_CONFIG], True))
+
+    result = []
+    for name, value, item_type, is_tax in details:
+        detail = {
+            'name': name,
+            'value': round(value, 2),
+            'type': item_type,
+            'percentage': round(value / total_cost * 100, 2) if total_cost > 0 else 0
+        }
+        if is_tax:
+            detail['is_tax'] = True
+        result.append(detail)
+    result.sort(key=lambda detail: detail['percentage'], reverse=True)
+    return result
+
+
+def cost_content_hash(record):
+    """成本快照内容哈希：产品及按分取整的各项单位成本
+
+    计算结果由产品BOM、原料价格和成本配置决定，三者都未变化时哈希相同；
+    按单位成本计算，同一成本按不同数量计算时哈希也相同。
+    """
+    quantity = float(record['quantity'] or 0)
+    parts = [str(record['product_code'])]
+    parts.extend(
+        f"{float(record[field] or 0) / quantity if quantity > 0 else float(record[field] or 0):.4f}"
+        for field in SNAPSHOT_FIELDS
+    )
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _latest_cost_hashes(cursor, product_codes):
+    """每个产品最新一条成本快照 {产品编码: (id, 内容哈希)}"""
+    latest = {}
+    product_codes = list(product_codes)
+    for start in range(0, len(product_codes), SQL_CHUNK_SIZE):
+        chunk = product_codes[start:start + SQL_CHUNK_SIZE]
+        placeholders = ','.join(['?' for _ in chunk])
+        cursor.execute(f'''
+            SELECT product_code, id, content_hash FROM (
+                SELECT product_code, id, content_hash,
+                       ROW_NUMBER() OVER (PARTITION BY product_code ORDER BY calculation_date DESC, id DESC) AS rn
+                FROM production_costs
+                WHERE product_code IN ({placeholders})
+            ) WHERE rn = 1
+        ''', chunk)
+        for product_code, row_id, content_hash in cursor.fetchall():
+            latest[product_code] = (row_id, content_hash)
+    return latest
+
+
+def save_cost_records(cursor, records):
+    """保存产品成本快照：与该产品最新快照内容相同时不新增记录，只刷新 last_seen_at
+
+    已有快照的计算时间不会改写，成本 A→B→A 变化时历史中保留三段。
+    """
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    latest = _latest_cost_hashes(cursor, {record['product_code'] for record in records})
+
+    inserts, seen = [], []
+    for record in records:
+        product_code = record['product_code']
+        content_hash = cost_content_hash(record)
+        row_id, latest_hash = latest.get(product_code, (None, None))
+        if content_hash == latest_hash:
+            if row_id is not None:
+                seen.append((row_id,))
+            continue
+        latest[product_code] = (None, content_hash)
+        inserts.append((
+            f"{product_code}_{timestamp}_{uuid.uuid4().hex[:8]}", product_code,
+            record['material_cost'], record['labor_cost'], record['management_cost'],
+            record['transport_cost'], record['other_cost'], record['tax_cost'],
+            record['total_cost'], record['quantity'], record['unit_cost'],
+            content_hash
+        ))
+
+    cursor.executemany('''
+        UPDATE production_costs SET last_seen_at = CURRENT_TIMESTAMP WHERE id = ?
+    ''', seen)
+    cursor.executemany('''
+        INSERT INTO production_costs (
+            cost_id, product_code, material_cost, labor_cost, management_cost,
+            transport_cost, other_cost, tax_cost, total_cost, quantity, unit_cost,
+            calculation_date, last_seen_at, content_hash
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?)
+    ''', inserts)
+    return len(inserts)
+
+
+def compact_cost_history(cursor, keep_per_product=COST_HISTORY_KEEP):
+    """压缩成本历史，返回 (合并的重复快照数, 超出保留数量删除的快照数)
+
+    1. 按当前哈希规则重算内容哈希，同一产品按时间连续且内容相同的快照只保留最早一条
+       （计算时间为该成本开始生效的时间），last_seen_at 取这段中最后一次出现的时间；
+    2. 每个产品只保留最近 keep_per_product 条快照。
+    """
+    cursor.execute(f'''
+        SELECT id, product_code, quantity, calculation_date, COALESCE(last_seen_at, calculation_date),
+               {', '.join(SNAPSHOT_FIELDS)}
+        FROM production_costs
+        ORDER BY product_code, calculation_date, id
+    ''')
+    columns = ['id', 'product_code', 'quantity', 'calculation_date', 'last_seen_at'] + SNAPSHOT_FIELDS
+    duplicates, updates = [], {}
+    previous_product, previous_hash, keeper = None, None, None
+    for row in cursor.fetchall():
+        record = dict(zip(columns, row))
+        content_hash = cost_content_hash(record)
+        if record['product_code'] == previous_product and content_hash == previous_hash:
+            duplicates.append((record['id'],))
+            updates[keeper][1] = max(updates[keeper][1], record['last_seen_at'])
+        else:
+            keeper = record['id']
+            updates[keeper] = [content_hash, record['last_seen_at']]
+        previous_product, previous_hash = record['product_code'], content_hash
+
+    cursor.executemany('DELETE FROM production_costs WHERE id = ?', duplicates)
+    cursor.executemany(
+        'UPDATE production_costs SET content_hash = ?, last_seen_at = ? WHERE id = ?',
+        [(content_hash, last_seen_at, row_id) for row_id, (content_hash, last_seen_at) in updates.items()]
+    )
+
+    cursor.execute('''
+        DELETE FROM production_costs
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY product_code ORDER BY calculation_date DESC, id DESC
+                ) AS rn
+                FROM production_costs
+            )
+            WHERE rn > ?
+        )
+    ''', (keep_per_product,))
+    return len(duplicates), cursor.rowcount
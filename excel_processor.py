@@ -6,10 +6,23 @@
 
 import pandas as pd
 import qrcode
+import io
 import os
 import sqlite3
 from datetime import datetime
-import random
+from qr_store import (
+    QR_STORAGE_SQLITE, assign_short_codes, build_qr_payload, get_canonical_base_url,
+    get_qr_storage_backend, qr_relative_path, record_qr_files, save_qr_blob
+)
+from bom_engine import BomGraph, rebuild_where_used
+from inventory_store import (
+    TRANSACTION_TYPES, apply_stock_changes, begin_immediate, ensure_opening_balances, load_category_rollup,
+    migrate_inventory_transactions, rebuild_category_rollup, record_opening_balances, record_transactions
+)
+from cost_engine import (
+    bump_config_version, calculate_product_cost as compute_product_cost, get_cost_rules,
+    recalculate_affected_costs, save_cost_records
+)
 
 # 导入生产订单管理器
 try:
@@ -24,13 +37,18 @@ class OrderProcessor:
         self.excel_file = excel_file
         self.db_file = db_file
         
-        # 如果没有提供base_url，自动获取本机IP
+        # 如果没有提供base_url，优先使用配置的规范域名，否则自动获取本机IP
         if base_url is None:
-            self.base_url = self._get_base_url()
+            self.base_url = get_canonical_base_url() or self._get_base_url()
         else:
             self.base_url = base_url
             
         self.qr_output_dir = "qrcodes"
+        self.qr_storage = get_qr_storage_backend()
+        
+        # 批量导入期间共用的BOM结构图和成本规则（导入开始时加载一次）
+        self._bom_graph = None
+        self._cost_rules = None
         
         # 确保输出目录存在
         if not os.path.exists(self.qr_output_dir):
@@ -171,6 +189,25 @@ class OrderProcessor:
                 )
             ''')
             
+            # 创建物料反查索引表（物料 → 直接或多级使用它的产品，BOM变更时重建变更产品及其上层产品的行）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bom_where_used (
+                    material_code TEXT NOT NULL,
+                    product_code TEXT NOT NULL,
+                    depth INTEGER NOT NULL,
+                    PRIMARY KEY (material_code, product_code)
+                ) WITHOUT ROWID
+            ''')
+            # 增量重建按产品删除索引行
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_bom_where_used_product ON bom_where_used(product_code)
+            ''')
+            
+            # 已有BOM数据的旧数据库补建反查索引
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM bom_where_used)')
+            if not cursor.fetchone()[0]:
+                rebuild_where_used(cursor)
+            
             # 创建成本配置项表
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS cost_config_items (
@@ -186,6 +223,15 @@ class OrderProcessor:
                 )
             ''')
             
+            # 创建配置版本号表（成本配置变更时递增，用于各进程的成本规则缓存失效）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS config_versions (
+                    config_key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
             # 创建成本配置表（兼容旧版本）
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS cost_config (
@@ -198,20 +244,87 @@ class OrderProcessor:
                 )
             ''')
 
-            # 创建库存变动记录表
+            # 创建库存流水表：物料和流水类型用整数键，数量带符号（正数入库、负数出库），时间为Unix时间戳
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS inventory_transactions (
+                CREATE TABLE IF NOT EXISTS inventory_item_keys (
+                    item_id INTEGER PRIMARY KEY,
+                    item_code TEXT UNIQUE NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS inventory_transaction_types (
+                    type_id INTEGER PRIMARY KEY,
+                    type_name TEXT UNIQUE NOT NULL
+                )
+            ''')
+            cursor.executemany('''
+                INSERT OR IGNORE INTO inventory_transaction_types (type_id, type_name) VALUES (?, ?)
+            ''', [(type_id, type_name) for type_name, type_id in TRANSACTION_TYPES.items()])
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS inventory_ledger (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_code TEXT NOT NULL,
-                    transaction_type TEXT NOT NULL,  -- 'in' or 'out'
+                    item_id INTEGER NOT NULL,
+                    type_id INTEGER NOT NULL,
                     quantity REAL NOT NULL,
                     unit_price REAL,
                     total_amount REAL,
-                    transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    created_at INTEGER NOT NULL,
                     notes TEXT,
-                    FOREIGN KEY (item_code) REFERENCES inventory_items (item_code)
+                    FOREIGN KEY (item_id) REFERENCES inventory_item_keys (item_id),
+                    FOREIGN KEY (type_id) REFERENCES inventory_transaction_types (type_id)
                 )
             ''')
+            # 按物料汇总（对账）和按时间范围汇总（历史库存）的覆盖索引
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_inventory_ledger_item
+                ON inventory_ledger (item_id, type_id, quantity)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_inventory_ledger_time
+                ON inventory_ledger (created_at, item_id, type_id, quantity)
+            ''')
+            
+            # 旧版库存变动记录表迁移到 inventory_ledger，原表名改为兼容视图（'out' 数量仍显示为正数）
+            migrated = migrate_inventory_transactions(cursor)
+            if migrated:
+                print(f"✅ 已迁移 {migrated} 条库存流水到 inventory_ledger")
+            cursor.execute('''
+                CREATE VIEW IF NOT EXISTS inventory_transactions AS
+                SELECT l.id, k.item_code, t.type_name AS transaction_type,
+                       CASE WHEN t.type_name = 'out' THEN -l.quantity ELSE l.quantity END AS quantity,
+                       l.unit_price, l.total_amount,
+                       datetime(l.created_at, 'unixepoch') AS transaction_date,
+                       l.notes
+                FROM inventory_ledger l
+                JOIN inventory_item_keys k ON k.item_id = l.item_id
+                JOIN inventory_transaction_types t ON t.type_id = l.type_id
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS inventory_transactions_insert
+                INSTEAD OF INSERT ON inventory_transactions
+                BEGIN
+                    INSERT OR IGNORE INTO inventory_item_keys (item_code) VALUES (NEW.item_code);
+                    INSERT OR IGNORE INTO inventory_transaction_types (type_name) VALUES (NEW.transaction_type);
+                    INSERT INTO inventory_ledger (item_id, type_id, quantity, unit_price, total_amount, created_at, notes)
+                    SELECT k.item_id, t.type_id,
+                           CASE WHEN NEW.transaction_type = 'out' THEN -NEW.quantity ELSE NEW.quantity END,
+                           NEW.unit_price, NEW.total_amount,
+                           COALESCE(CAST(CASE WHEN instr(NEW.transaction_date, 'T')
+                                              THEN strftime('%s', NEW.transaction_date, 'utc')
+                                              ELSE strftime('%s', NEW.transaction_date) END AS INTEGER),
+                                    CAST(strftime('%s', 'now') AS INTEGER)),
+                           NEW.notes
+                    FROM inventory_item_keys k, inventory_transaction_types t
+                    WHERE k.item_code = NEW.item_code AND t.type_name = NEW.transaction_type;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS inventory_transactions_delete
+                INSTEAD OF DELETE ON inventory_transactions
+                BEGIN
+                    DELETE FROM inventory_ledger WHERE id = OLD.id;
+                END
+            ''')
 
             # 创建生产成本记录表
             cursor.execute('''
@@ -233,6 +346,186 @@ class OrderProcessor:
                 )
             ''')
             
+            # 库存行版本号：每次库存变动加1（变动计数，并发安全由相对更新和 BEGIN IMMEDIATE 保证）
+            self._add_column_if_not_exists(cursor, 'inventory_items', 'version', 'INTEGER NOT NULL DEFAULT 0')
+            
+            # 库存分类汇总：inventory_items 的插入、删除以及库存/金额/单价/分类/阈值变化时由触发器增量维护
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS inventory_category_rollup (
+                    item_category TEXT PRIMARY KEY,
+                    item_count INTEGER NOT NULL DEFAULT 0,
+                    total_stock REAL NOT NULL DEFAULT 0,
+                    total_value REAL NOT NULL DEFAULT 0,
+                    price_sum REAL NOT NULL DEFAULT 0,  -- 加权平均价合计，平均单价 = price_sum / item_count
+                    low_stock_count INTEGER NOT NULL DEFAULT 0
+                ) WITHOUT ROWID
+            ''')
+            rollup_add = '''
+                INSERT INTO inventory_category_rollup
+                (item_category, item_count, total_stock, total_value, price_sum, low_stock_count)
+                VALUES (NEW.item_category, 1, COALESCE(NEW.current_stock, 0), COALESCE(NEW.total_value, 0),
+                        COALESCE(NEW.weighted_avg_price, 0),
+                        COALESCE(NEW.current_stock <= COALESCE(NEW.low_stock_threshold, 100), 0))
+                ON CONFLICT (item_category) DO UPDATE SET
+                    item_count = item_count + excluded.item_count,
+                    total_stock = total_stock + excluded.total_stock,
+                    total_value = total_value + excluded.total_value,
+                    price_sum = price_sum + excluded.price_sum,
+                    low_stock_count = low_stock_count + excluded.low_stock_count;
+            '''
+            rollup_remove = '''
+                UPDATE inventory_category_rollup SET
+                    item_count = item_count - 1,
+                    total_stock = total_stock - COALESCE(OLD.current_stock, 0),
+                    total_value = total_value - COALESCE(OLD.total_value, 0),
+                    price_sum = price_sum - COALESCE(OLD.weighted_avg_price, 0),
+                    low_stock_count = low_stock_count - COALESCE(OLD.current_stock <= COALESCE(OLD.low_stock_threshold, 100), 0)
+                WHERE item_category = OLD.item_category;
+                DELETE FROM inventory_category_rollup WHERE item_category = OLD.item_category AND item_count <= 0;
+            '''
+            # 库存不足判定为“库存不高于阈值”（与网页端一致）；旧版按“低于阈值”建的触发器和部分索引重建，汇总重新计算
+            cursor.execute('''
+                SELECT name, type FROM sqlite_master
+                WHERE name IN ('inventory_rollup_insert', 'inventory_rollup_delete', 'inventory_rollup_update',
+                               'idx_inventory_items_low_stock')
+                  AND sql LIKE '%current_stock < COALESCE%'
+            ''')
+            outdated = cursor.fetchall()
+            for name, object_type in outdated:
+                cursor.execute(f'DROP {object_type.upper()} IF EXISTS {name}')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS inventory_rollup_insert
+                AFTER INSERT ON inventory_items
+                BEGIN {rollup_add} END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS inventory_rollup_delete
+                AFTER DELETE ON inventory_items
+                BEGIN {rollup_remove} END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS inventory_rollup_update
+                AFTER UPDATE OF item_category, current_stock, total_value, weighted_avg_price, low_stock_threshold
+                ON inventory_items
+                BEGIN {rollup_remove} {rollup_add} END
+            ''')
+            # 已有库存数据的旧数据库补建分类汇总，库存不足判定变化后重新计算
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM inventory_category_rollup)')
+            if not cursor.fetchone()[0] or outdated:
+                rebuild_category_rollup(cursor)
+            # 库存不足物料的部分索引，库存汇总只读取不高于阈值的物料
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_inventory_items_low_stock
+                ON inventory_items (current_stock) WHERE current_stock <= COALESCE(low_stock_threshold, 100)
+            ''')
+            
+            # 库存余额快照：每个物料每天一行，last_transaction_id 为快照时的流水水位线
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS inventory_snapshots (
+                    snapshot_date TEXT NOT NULL,
+                    item_code TEXT NOT NULL,
+                    stock REAL NOT NULL,
+                    weighted_avg_price REAL NOT NULL,
+                    total_value REAL NOT NULL,
+                    last_transaction_id INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (snapshot_date, item_code)
+                ) WITHOUT ROWID
+            ''')
+            # 启用流水对账前已有的库存补记为期初余额（只执行一次）
+            ensure_opening_balances(cursor)
+            
+            # 订单导入时冻结的材料成本，用于区分成本差异中的原料价格变动与费率变动
+            self._add_column_if_not_exists(cursor, 'orders', 'material_cost', 'REAL')
+            
+            # 生产处理标记：订单已转换为生产订单并扣减原料后记录生产订单号，为空表示待处理
+            if self._add_column_if_not_exists(cursor, 'orders', 'production_order_id', 'TEXT'):
+                # 旧版本每次导入都按全部订单扣减原料，已有订单视为已处理，避免升级后重复扣减
+                cursor.execute("UPDATE orders SET production_order_id = 'LEGACY' WHERE product_code IS NOT NULL")
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_orders_production_pending
+                ON orders (product_code) WHERE production_order_id IS NULL
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_orders_production_order
+                ON orders (production_order_id)
+            ''')
+            
+            # 创建生产订单表：planned（已计划）→ released（已下达，原料已出库）→ completed（已完工，成品已入库）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS production_orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    production_order_id TEXT UNIQUE NOT NULL,
+                    product_code TEXT NOT NULL,
+                    quantity REAL NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'planned'
+                        CHECK (status IN ('planned', 'released', 'completed')),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    released_at TIMESTAMP,
+                    completed_at TIMESTAMP,
+                    FOREIGN KEY (product_code) REFERENCES inventory_items (item_code)
+                )
+            ''')
+            # 按产品查询未完工的生产订单
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_production_orders_product_status
+                ON production_orders (product_code, status)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_production_orders_status_created
+                ON production_orders (status, created_at)
+            ''')
+            
+            # 创建生产订单原料明细表（每个生产订单每种原料一行）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS production_order_lines (
+                    production_order_id TEXT NOT NULL,
+                    material_code TEXT NOT NULL,
+                    quantity REAL NOT NULL,
+                    PRIMARY KEY (production_order_id, material_code),
+                    FOREIGN KEY (production_order_id) REFERENCES production_orders (production_order_id)
+                ) WITHOUT ROWID
+            ''')
+            
+            # 成本快照内容哈希：与该产品最新快照相同时不重复写入，只刷新 last_seen_at
+            self._add_column_if_not_exists(cursor, 'production_costs', 'content_hash', 'TEXT')
+            self._add_column_if_not_exists(cursor, 'production_costs', 'last_seen_at', 'TIMESTAMP')
+            # 同一成本可以在不同时期重复出现（A→B→A），内容哈希不再唯一
+            cursor.execute('DROP INDEX IF EXISTS idx_production_costs_hash')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_production_costs_product_date
+                ON production_costs (product_code, calculation_date)
+            ''')
+            
+            # 创建二维码短码表（二维码内容为 /q/<base36(id)>，与服务器地址无关）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS qr_short_codes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id TEXT UNIQUE NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # 创建二维码文件索引表（图片按哈希分片存放，列表查询走索引而非扫描目录）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS qr_code_index (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id TEXT UNIQUE NOT NULL,
+                    file_path TEXT NOT NULL,
+                    file_size INTEGER DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # 创建二维码图片表（QR_STORAGE=sqlite 时使用，与订单同一事务写入）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS qr_images (
+                    order_id TEXT PRIMARY KEY,
+                    image BLOB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
             # 检查是否需要初始化默认成本配置项
             cursor.execute('SELECT COUNT(*) FROM cost_config_items')
             if cursor.fetchone()[0] == 0:
@@ -250,6 +543,7 @@ class OrderProcessor:
                     (item_name, item_type, default_value, unit, description)
                     VALUES (?, ?, ?, ?, ?)
                 ''', default_configs)
+                bump_config_version(cursor)
                 
                 print("✅ 初始化默认成本配置项完成")
             
@@ -266,11 +560,12 @@ class OrderProcessor:
             return False
 
     def _add_column_if_not_exists(self, cursor, table_name, column_name, column_definition):
-        """安全添加数据库列"""
+        """安全添加数据库列，返回是否新增了该列"""
         try:
             cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_definition}")
+            return True
         except sqlite3.OperationalError:
-            pass  # 列已存在
+            return False  # 列已存在
 
     def process_excel(self):
         """处理Excel文件并导入数据库"""
@@ -344,13 +639,20 @@ class OrderProcessor:
             if not duplicate_check["success"]:
                 return duplicate_check
             
-            # 连接数据库
+            # 连接数据库，导入会先读后写（库存、BOM），一开始就取得写锁
             conn = sqlite3.connect(self.db_file)
+            begin_immediate(conn)
             cursor = conn.cursor()
             
+            # 一次性加载BOM结构图和成本规则，逐行计算成本时不再重复查询
+            self._bom_graph = BomGraph.load(cursor)
+            self._cost_rules = get_cost_rules(cursor)
+            
             # 插入数据并计算盈亏
             success_count = 0
             for index, row in df.iterrows():
+                # 每行一个保存点：出错时库存扣减、成本快照和二维码一起回滚，不留下孤立数据
+                cursor.execute('SAVEPOINT order_row')
                 try:
                     order_id = str(row["订单号"]).strip()
                     customer_name = str(row["客户姓名"]).strip()
@@ -440,12 +742,14 @@ class OrderProcessor:
                     
                     unit_cost = 0
                     total_cost = 0
+                    material_cost = None
                     profit = 0
                     profit_status = 'unknown'
                     
                     if cost_result['success']:
                         unit_cost = cost_result['cost_breakdown']['unit_cost']
                         total_cost = cost_result['cost_breakdown']['total_cost']
+                        material_cost = cost_result['cost_breakdown']['material_cost']
                         profit = sale_total_amount - total_cost
                         
                         # 判断盈亏状态
@@ -460,23 +764,31 @@ class OrderProcessor:
                     else:
                         print(f"⚠️ {order_id}: 无法计算成本 - {cost_result.get('error', '未知错误')}，但库存已正确扣减")
                     
+                    # 数据库存储模式：二维码与订单在同一保存点中写入，失败时一起回滚
+                    if self.qr_storage == QR_STORAGE_SQLITE:
+                        short_code = assign_short_codes(cursor, [order_id])[order_id]
+                        relative_path, qr_size = self._store_qr_blob(cursor, order_id, short_code)
+                        record_qr_files(cursor, [(order_id, relative_path, qr_size)])
+                    
                     # 构建产品详情描述
                     product_details = f"{product_name} (编码: {product_code})"
                     
                     cursor.execute('''
                         INSERT OR REPLACE INTO orders 
                         (order_id, customer_name, order_date, amount, product_details, 
-                         product_code, quantity, unit_cost, total_cost, profit, profit_status)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                         product_code, quantity, unit_cost, total_cost, material_cost, profit, profit_status)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     ''', (order_id, customer_name, order_date, sale_total_amount, product_details,
-                          product_code, quantity, unit_cost, total_cost, profit, profit_status))
+                          product_code, quantity, unit_cost, total_cost, material_cost, profit, profit_status))
                     
                     success_count += 1
                     print(f"✅ 处理销售订单: {order_id} - {product_name}")
                     
                 except Exception as e:
+                    cursor.execute('ROLLBACK TO order_row')
                     print(f"❌ 处理第 {index+1} 行销售订单数据时出错: {e}")
-                    continue
+                finally:
+                    cursor.execute('RELEASE order_row')
             
             conn.commit()
             
@@ -489,7 +801,8 @@ class OrderProcessor:
             if PRODUCTION_MANAGER_AVAILABLE and success_count > 0:
                 print("\n🏭 开始自动处理生产订单，扣减原料库存...")
                 try:
-                    production_manager = ProductionOrderManager(self.db_file)
+                    # 复用导入连接和已加载的BOM结构图
+                    production_manager = ProductionOrderManager(self.db_file, conn=conn, bom_graph=self._bom_graph)
                     production_manager.process_all_sales_orders()
                     print("✅ 生产订单处理完成，原料库存已自动扣减")
                 except Exception as e:
@@ -510,47 +823,121 @@ class OrderProcessor:
             print(f"❌ {error_msg}")
             return {"success": False, "error": error_msg}
         finally:
+            self._bom_graph = None
+            self._cost_rules = None
             if conn:
                 try:
                     conn.close()
                 except:
                     pass
     
-    def generate_qrcodes(self):
-        """为所有订单生成二维码"""
+    def _load_order_short_codes(self):
+        """读取所有订单并分配短码，返回 [(order_id, 短码)]"""
+        conn = sqlite3.connect(self.db_file)
         try:
-            # 从数据库读取订单数据
-            conn = sqlite3.connect(self.db_file)
             cursor = conn.cursor()
             cursor.execute("SELECT order_id FROM orders")
-            orders = cursor.fetchall()
+            order_ids = [row[0] for row in cursor.fetchall()]
+            short_codes = assign_short_codes(cursor, order_ids)
+            conn.commit()
+            return [(order_id, short_codes[order_id]) for order_id in order_ids]
+        finally:
             conn.close()
+
+    def _build_qr_image(self, short_code):
+        """生成二维码图片对象"""
+        # 二维码只包含短链接，内容越短二维码版本越低，图片越小
+        url = build_qr_payload(self.base_url, short_code)
+        
+        # 创建二维码（version=None 时按内容长度自动选择最小版本）
+        qr = qrcode.QRCode(
+            version=None,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=10,
+            border=4,
+        )
+        qr.add_data(url)
+        qr.make(fit=True)
+        
+        return qr.make_image(fill_color="black", back_color="white")
+
+    def _render_qr_code(self, order_id, short_code):
+        """生成单个订单的二维码图片（分片目录存储），返回相对二维码目录的路径"""
+        img = self._build_qr_image(short_code)
+        
+        # 保存图片到分片目录 qrcodes/ab/cd/
+        relative_path = qr_relative_path(order_id)
+        img_path = os.path.join(self.qr_output_dir, relative_path)
+        os.makedirs(os.path.dirname(img_path), exist_ok=True)
+        img.save(img_path)
+        return relative_path
+
+    def _store_qr_blob(self, cursor, order_id, short_code):
+        """生成二维码PNG并写入qr_images表（随cursor所在事务提交），返回 (缓存相对路径, 字节数)"""
+        buffer = io.BytesIO()
+        self._build_qr_image(short_code).save(buffer, format='PNG')
+        png_bytes = buffer.getvalue()
+        save_qr_blob(cursor, order_id, png_bytes)
+        
+        # 丢弃旧的文件缓存，下次读取时按数据库内容重建
+        cache_path = os.path.join(self.qr_output_dir, qr_relative_path(order_id))
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        return qr_relative_path(order_id), len(png_bytes)
+
+    def _store_qr_codes(self, orders, skip_errors=False):
+        """按配置的存储方式保存二维码并写入索引，orders 为 [(order_id, 短码)]，返回 {order_id: 相对路径}"""
+        conn = sqlite3.connect(self.db_file)
+        try:
+            cursor = conn.cursor()
+            paths = {}
+            index_entries = []
+            for order_id, short_code in orders:
+                try:
+                    if self.qr_storage == QR_STORAGE_SQLITE:
+                        relative_path, size = self._store_qr_blob(cursor, order_id, short_code)
+                        print(f"生成二维码: {order_id} (数据库存储)")
+                    else:
+                        relative_path = self._render_qr_code(order_id, short_code)
+                        img_path = os.path.join(self.qr_output_dir, relative_path)
+                        size = os.path.getsize(img_path)
+                        print(f"生成二维码: {img_path}")
+                except Exception as e:
+                    if not skip_errors:
+                        raise
+                    print(f"为订单 {order_id} 生成二维码时出错: {e}")
+                    continue
+                
+                paths[order_id] = relative_path
+                index_entries.append((order_id, relative_path, size))
             
-            print(f"开始生成 {len(orders)} 个二维码...")
+            record_qr_files(cursor, index_entries)
+            conn.commit()
+            return paths
+        finally:
+            conn.close()
+
+    def ensure_qr_codes(self, order_ids):
+        """为指定订单生成二维码（分配短码、渲染并写入索引），返回 {order_id: 相对路径}"""
+        order_ids = list(order_ids)
+        conn = sqlite3.connect(self.db_file)
+        try:
+            short_codes = assign_short_codes(conn.cursor(), order_ids)
+            conn.commit()
+        finally:
+            conn.close()
+        
+        return self._store_qr_codes([(order_id, short_codes[order_id]) for order_id in order_ids])
+
+    def generate_qrcodes(self):
+        """为所有订单生成二维码"""
+        try:
+            # 从数据库读取订单数据并分配短码
+            orders = self._load_order_short_codes()
             
-            for order in orders:
-                order_id = order[0]
-                # 生成查询URL - 指向公共查询页面
-                url = f"{self.base_url}/public?order_id={order_id}"
-                
-                # 创建二维码
-                qr = qrcode.QRCode(
-                    version=1,
-                    error_correction=qrcode.constants.ERROR_CORRECT_L,
-                    box_size=10,
-                    border=4,
-                )
-                qr.add_data(url)
-                qr.make(fit=True)
-                
-                # 生成图片
-                img = qr.make_image(fill_color="black", back_color="white")
-                
-                # 保存图片
-                img_path = f"{self.qr_output_dir}/order_{order_id}.png"
-                img.save(img_path)
-                print(f"生成二维码: {img_path}")
+            print(f"开始生成 {len(orders)} 个二维码...")
             
+            self._store_qr_codes(orders)
             print("所有二维码生成完成！")
             return True
             
@@ -561,12 +948,8 @@ class OrderProcessor:
     def generate_qr_codes(self):
         """为所有订单生成二维码（返回详细状态）"""
         try:
-            # 从数据库读取订单数据
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute("SELECT order_id FROM orders")
-            orders = cursor.fetchall()
-            conn.close()
+            # 从数据库读取订单数据并分配短码
+            orders = self._load_order_short_codes()
             
             total_orders = len(orders)
             if total_orders == 0:
@@ -574,35 +957,7 @@ class OrderProcessor:
             
             print(f"开始生成 {total_orders} 个二维码...")
             
-            success_count = 0
-            for order in orders:
-                order_id = order[0]
-                try:
-                    # 生成查询URL - 指向公共查询页面
-                    url = f"{self.base_url}/public?order_id={order_id}"
-                    
-                    # 创建二维码
-                    qr = qrcode.QRCode(
-                        version=1,
-                        error_correction=qrcode.constants.ERROR_CORRECT_L,
-                        box_size=10,
-                        border=4,
-                    )
-                    qr.add_data(url)
-                    qr.make(fit=True)
-                    
-                    # 生成图片
-                    img = qr.make_image(fill_color="black", back_color="white")
-                    
-                    # 保存图片
-                    img_path = f"{self.qr_output_dir}/order_{order_id}.png"
-                    img.save(img_path)
-                    success_count += 1
-                    print(f"生成二维码: {img_path}")
-                    
-                except Exception as e:
-                    print(f"为订单 {order_id} 生成二维码时出错: {e}")
-                    continue
+            success_count = len(self._store_qr_codes(orders, skip_errors=True))
             
             if success_count == 0:
                 return {"success": False, "error": "没有成功生成任何二维码"}
@@ -671,10 +1026,13 @@ class OrderProcessor:
                 print(f"❌ {error_msg}")
                 return {"success": False, "error": error_msg}
             
+            # 采购导入会先读后写（物品信息、库存），一开始就取得写锁
             conn = sqlite3.connect(self.db_file)
+            begin_immediate(conn)
             cursor = conn.cursor()
             
             success_count = 0
+            updated_items = set()
             for index, row in df.iterrows():
                 try:
                     purchase_id = str(row["采购单号"]).strip()
@@ -706,8 +1064,13 @@ class OrderProcessor:
                     ''', (purchase_id, item_code, supplier_name, purchase_date, 
                           quantity, unit_price, total_amount, other_fees))
                     
-                    # 3. 更新库存数量和加权平均价格
+                    # 3. 更新库存数量和加权平均价格，并记录入库流水
                     self._update_weighted_avg_price(cursor, item_code, quantity, unit_price, other_fees)
+                    record_transactions(cursor, [(
+                        item_code, '采购入库', quantity, unit_price, total_amount,
+                        f'采购单 {purchase_id} 入库（供应商: {supplier_name}）'
+                    )])
+                    updated_items.add(item_code)
                     
                     success_count += 1
                     print(f"✅ 处理采购订单: {purchase_id} - {item_name}")
@@ -716,6 +1079,15 @@ class OrderProcessor:
                     print(f"❌ 处理第 {index+1} 行采购数据时出错: {e}")
                     continue
             
+            # 原料加权平均价变化后，只重算使用这些原料的产品成本
+            if updated_items:
+                try:
+                    refreshed = recalculate_affected_costs(cursor, updated_items)
+                    if refreshed:
+                        print(f"💰 已重算受影响的 {refreshed} 个产品成本")
+                except Exception as e:
+                    print(f"⚠️ 重算受影响产品成本失败: {e}，采购数据仍会保存")
+            
             conn.commit()
             conn.close()
             
@@ -769,38 +1141,11 @@ class OrderProcessor:
             print(f"✨ 创建新物品: {item_code} - {item_name} ({category})")
 
     def _update_weighted_avg_price(self, cursor, item_code, new_quantity, new_price, other_fees=0):
-        """更新库存的加权平均价格"""
-        # 获取当前库存信息
-        cursor.execute('''
-            SELECT current_stock, weighted_avg_price, total_value
-            FROM inventory_items WHERE item_code = ?
-        ''', (item_code,))
-        
-        result = cursor.fetchone()
-        if result:
-            current_stock, current_avg_price, current_total_value = result
-            
-            # 计算新的加权平均价格
-            new_item_total_cost = new_quantity * new_price + other_fees
-            new_total_stock = current_stock + new_quantity
-            new_total_value = current_total_value + new_item_total_cost
-            
-            if new_total_stock > 0:
-                new_weighted_avg_price = new_total_value / new_total_stock
-            else:
-                new_weighted_avg_price = 0
-            
-            # 更新库存信息
-            cursor.execute('''
-                UPDATE inventory_items 
-                SET current_stock = ?, 
-                    weighted_avg_price = ?, 
-                    total_value = ?,
-                    last_updated = CURRENT_TIMESTAMP
-                WHERE item_code = ?
-            ''', (new_total_stock, new_weighted_avg_price, new_total_value, item_code))
-            
-            print(f"📈 更新库存 {item_code}: 数量{current_stock}→{new_total_stock}, 均价¥{current_avg_price:.2f}→¥{new_weighted_avg_price:.2f}")
+        """采购入库：增加库存并按入库成本（含其他费用）更新加权平均价格"""
+        changed = apply_stock_changes(cursor, [(item_code, new_quantity, new_quantity * new_price + other_fees)])
+        if item_code in changed:
+            current_stock, new_total_stock = changed[item_code]
+            print(f"📈 更新库存 {item_code}: 数量{current_stock}→{new_total_stock}, 入库单价¥{new_price:.2f}")
 
     def process_bom_data(self, bom_excel_file):
         """处理BOM物料清单Excel文件"""
@@ -922,6 +1267,8 @@ class OrderProcessor:
             
             success_count = 0
             update_count = 0
+            # 新增了子件的产品，只需重建这些产品及其上层产品的反查索引（只改用量不影响索引）
+            added_products = set()
             
             for index, row in df.iterrows():
                 try:
@@ -961,12 +1308,25 @@ class OrderProcessor:
                             VALUES (?, ?, ?, ?, ?)
                         ''', (product_code, material_code, required_quantity, unit, notes))
                         success_count += 1
+                        added_products.add(product_code)
                         print(f"✅ 新增BOM: {product_code} 需要 {material_code} × {required_quantity}")
                     
                 except Exception as e:
                     print(f"❌ 处理第 {index+1} 行BOM数据时出错: {e}")
                     continue
             
+            # 导入后的BOM不能出现循环引用（例如 A 需要 B，B 又需要 A）
+            graph = BomGraph.load(cursor)
+            if graph.cyclic:
+                cycle = graph.find_cycle(sorted(graph.cyclic)[0])
+                conn.rollback()
+                conn.close()
+                error_msg = f"BOM存在循环引用: {' → '.join(cycle)}，本次导入已撤销"
+                print(f"❌ {error_msg}")
+                return {"success": False, "error": error_msg}
+            
+            rebuild_where_used(cursor, graph, changed_products=added_products)
+            
             conn.commit()
             conn.close()
             
@@ -983,7 +1343,7 @@ class OrderProcessor:
             return {"success": False, "error": error_msg}
 
     def calculate_product_cost(self, product_code, quantity=1, labor_hours=0, conn=None):
-        """计算产品的完整成本"""
+        """计算产品的完整成本（成本规则与API、批量重算共用 cost_engine）"""
         close_conn = False
         try:
             if conn is None:
@@ -993,97 +1353,15 @@ class OrderProcessor:
             
             print(f"💰 开始计算产品 {product_code} 的成本 (数量: {quantity})")
             
-            # 1. 计算材料成本
-            material_cost = self._calculate_material_cost(cursor, product_code, quantity)
+            graph = self._bom_graph or BomGraph.load(cursor)
+            rules = self._cost_rules or get_cost_rules(cursor)
             
-            # 2. 获取所有成本配置项
-            cursor.execute('''
-                SELECT item_name, item_type, default_value 
-                FROM cost_config_items 
-                WHERE is_active = 1
-            ''')
-            configs = cursor.fetchall()
-            
-            # 3. 初始化成本字典
-            costs = {
-                'material_cost': material_cost,
-                'labor_cost': 0,
-                'management_cost': 0,
-                'transport_cost': 0,
-                'other_costs': {},
-                'tax_cost': 0
-            }
-            
-            # 4. 处理每个成本配置项
-            for config in configs:
-                name = config[0]
-                cost_type = config[1]
-                value = float(config[2])
-                
-                # 如果是税费，先跳过，最后计算
-                if name == '税费':
-                    tax_rate = value / 100 if cost_type == 'percentage' else value
-                    continue
-                    
-                # 根据配置项类型计算成本
-                if name == '人工费率':
-                    if cost_type == 'fixed':
-                        costs['labor_cost'] = labor_hours * value
-                    else:
-                        costs['labor_cost'] = material_cost * (value / 100)
-                elif name == '管理费率':
-                    if cost_type == 'fixed':
-                        costs['management_cost'] = value
-                    else:
-                        costs['management_cost'] = material_cost * (value / 100)
-                elif name == '运输费率':
-                    if cost_type == 'fixed':
-                        costs['transport_cost'] = value
-                    else:
-                        costs['transport_cost'] = material_cost * (value / 100)
-                else:  # 处理其他所有成本项（包括设备折旧费等）
-                    if cost_type == 'fixed':
-                        costs['other_costs'][name] = value
-                    else:
-                        costs['other_costs'][name] = material_cost * (value / 100)
-            
-            # 5. 计算不含税总成本
-            subtotal_cost = (
-                costs['material_cost'] +
-                costs['labor_cost'] +
-                costs['management_cost'] +
-                costs['transport_cost'] +
-                sum(costs['other_costs'].values())
-            )
+            # 1. 输出材料需求明细
+            self._calculate_material_cost(cursor, product_code, quantity, graph=graph)
             
-            # 6. 计算税费（如果有）
-            tax_rate = None  # 初始化税率
-            if 'tax_rate' in locals():
-                costs['tax_cost'] = subtotal_cost * tax_rate
-            else:
-                costs['tax_cost'] = 0
-            
-            # 7. 计算总成本
-            total_cost = subtotal_cost + costs['tax_cost']
-            unit_cost = total_cost / quantity if quantity > 0 else 0
-            
-            # 提取各项成本值
-            material_cost = costs['material_cost']
-            labor_cost = costs['labor_cost'] 
-            management_cost = costs['management_cost']
-            transport_cost = costs['transport_cost']
-            tax_cost = costs['tax_cost']
-            other_cost = sum(costs['other_costs'].values())
-            
-            # 4. 保存成本记录
-            cost_id = f"{product_code}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{random.randint(1000, 9999)}"
-            cursor.execute('''
-                INSERT INTO production_costs 
-                (cost_id, product_code, material_cost, labor_cost, management_cost, 
-                 transport_cost, tax_cost, other_cost, total_cost, quantity, unit_cost)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (cost_id, product_code, material_cost, labor_cost, management_cost,
-                  transport_cost, tax_cost, other_cost, total_cost, quantity, unit_cost))
+            # 2. 按成本规则计算各项成本并保存成本记录
+            costs = compute_product_cost(cursor, product_code, quantity, labor_hours, graph=graph, rules=rules)
+            save_cost_records(cursor, [costs])
             
             if close_conn:
                 conn.commit()
@@ -1091,25 +1369,25 @@ class OrderProcessor:
             cost_breakdown = {
                 'product_code': product_code,
                 'quantity': quantity,
-                'material_cost': round(material_cost, 2),
-                'labor_cost': round(labor_cost, 2),
-                'management_cost': round(management_cost, 2),
-                'transport_cost': round(transport_cost, 2),
-                'tax_cost': round(tax_cost, 2),
-                'other_cost': round(other_cost, 2),
-                'total_cost': round(total_cost, 2),
-                'unit_cost': round(unit_cost, 2)
+                'material_cost': round(costs['material_cost'], 2),
+                'labor_cost': round(costs['labor_cost'], 2),
+                'management_cost': round(costs['management_cost'], 2),
+                'transport_cost': round(costs['transport_cost'], 2),
+                'tax_cost': round(costs['tax_cost'], 2),
+                'other_cost': round(costs['other_cost'], 2),
+                'total_cost': round(costs['total_cost'], 2),
+                'unit_cost': round(costs['unit_cost'], 2)
             }
             
             print(f"✅ 成本计算完成:")
-            print(f"   📦 材料成本: ¥{material_cost:.2f}")
-            print(f"   👷 人工成本: ¥{labor_cost:.2f}")
-            print(f"   🏢 管理成本: ¥{management_cost:.2f}")
-            print(f"   🚚 运输成本: ¥{transport_cost:.2f}")
-            print(f"   💰 税费: ¥{tax_cost:.2f}")
-            print(f"   💰 其他成本: ¥{other_cost:.2f}")
-            print(f"   💯 总成本: ¥{total_cost:.2f}")
-            print(f"   💰 单位成本: ¥{unit_cost:.2f}")
+            print(f"   📦 材料成本: ¥{costs['material_cost']:.2f}")
+            print(f"   👷 人工成本: ¥{costs['labor_cost']:.2f}")
+            print(f"   🏢 管理成本: ¥{costs['management_cost']:.2f}")
+            print(f"   🚚 运输成本: ¥{costs['transport_cost']:.2f}")
+            print(f"   💰 税费: ¥{costs['tax_cost']:.2f}")
+            print(f"   💰 其他成本: ¥{costs['other_cost']:.2f}")
+            print(f"   💯 总成本: ¥{costs['total_cost']:.2f}")
+            print(f"   💰 单位成本: ¥{costs['unit_cost']:.2f}")
             
             return {"success": True, "cost_breakdown": cost_breakdown}
             
@@ -1124,35 +1402,20 @@ class OrderProcessor:
                 except:
                     pass
 
-    def _calculate_material_cost(self, cursor, product_code, quantity):
-        """计算材料成本（递归计算BOM）"""
-        material_cost = 0
+    def _calculate_material_cost(self, cursor, product_code, quantity, graph=None):
+        """计算材料成本（多级BOM展开，半成品按其BOM逐级累计成本）"""
+        graph = graph or self._bom_graph or BomGraph.load(cursor)
         
-        # 获取该产品的BOM
-        cursor.execute('''
-            SELECT bi.material_code, bi.required_quantity, bi.unit,
-                   ii.weighted_avg_price, ii.current_stock
-            FROM bom_items bi
-            LEFT JOIN inventory_items ii ON bi.material_code = ii.item_code
-            WHERE bi.product_code = ?
-        ''', (product_code,))
-        
-        bom_items = cursor.fetchall()
-        
-        if not bom_items:
+        if not graph.has_bom(product_code):
             print(f"   ⚠️ {product_code}: 未找到BOM清单")
             return 0
         
-        for item in bom_items:
-            material_code = item[0]
-            required_qty = item[1]
-            unit = item[2]
-            avg_price = item[3] or 0
-            stock = item[4] or 0
-            
-            total_required = required_qty * quantity
+        # 存在循环引用时抛出BomCycleError，由调用方记录为成本计算失败
+        for material_code, total_required in graph.requirements(product_code, quantity):
+            unit = graph.unit(material_code) or ''
+            avg_price = graph.price(material_code)
+            stock = graph.stock(material_code)
             cost = total_required * avg_price
-            material_cost += cost
             
             if stock >= total_required:
                 print(f"   🔧 {material_code}: {total_required}{unit} × ¥{avg_price:.2f} = ¥{cost:.2f} (库存充足)")
@@ -1164,7 +1427,7 @@ class OrderProcessor:
             
             # 无论库存是否充足，都按价格计算成本
         
-        return material_cost
+        return graph.unit_cost(product_code) * quantity
 
     def create_purchase_sample_excel(self, filename="purchase_template.xlsx"):
         """创建采购订单示例Excel文件"""
@@ -1224,57 +1487,22 @@ class OrderProcessor:
             conn = sqlite3.connect(self.db_file)
             cursor = conn.cursor()
             
-            # 获取库存统计（包含负库存）
-            cursor.execute('''
-                SELECT 
-                    item_category,
-                    COUNT(*) as item_count,
-                    SUM(current_stock) as total_stock,
-                    SUM(total_value) as total_value,
-                    AVG(weighted_avg_price) as avg_price
-                FROM inventory_items 
-                GROUP BY item_category
-                ORDER BY total_value DESC
-            ''')
+            # 分类统计（包含负库存）读取触发器维护的分类汇总，总体统计由分类行合计
+            categories = load_category_rollup(cursor)
             
-            category_stats = cursor.fetchall()
-            
-            # 获取库存不足的物品（使用每个物品的实际阈值）
+            # 获取库存不足的物品（使用每个物品的实际阈值，走部分索引）
             cursor.execute('''
                 SELECT item_code, item_name, current_stock, weighted_avg_price, 
                        low_stock_threshold, warning_stock_threshold
                 FROM inventory_items 
-                WHERE current_stock < COALESCE(low_stock_threshold, 100)
+                WHERE current_stock <= COALESCE(low_stock_threshold, 100)
                 ORDER BY current_stock ASC
             ''')
             
             low_stock_items = cursor.fetchall()
             
-            # 获取总体统计（包含负库存）
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_items,
-                    SUM(current_stock) as total_stock,
-                    SUM(total_value) as total_value,
-                    COUNT(DISTINCT item_category) as total_categories
-                FROM inventory_items
-            ''')
-            
-            overall_stats = cursor.fetchone()
-            
             conn.close()
             
-            # 格式化分类数据 - 匹配前端期望的格式
-            categories = []
-            for stat in category_stats:
-                categories.append({
-                    "category": stat[0] or "未分类",
-                    "item_count": stat[1],
-                    "total_stock": float(stat[2] or 0),
-                    "total_value": float(stat[3] or 0),
-                    "avg_price": float(stat[4] or 0)
-                })
-            
             # 格式化库存不足物品 - 匹配前端期望的格式
             low_stock_formatted = []
             for item in low_stock_items:
@@ -1289,9 +1517,10 @@ class OrderProcessor:
             
             return {
                 "success": True,
-                "total_categories": overall_stats[3] or 0,
-                "total_stock": float(overall_stats[1] or 0),
-                "total_value": float(overall_stats[2] or 0),
+                "total_categories": len(categories),
+                "total_items": sum(category["item_count"] for category in categories),
+                "total_stock": round(sum(category["total_stock"] for category in categories), 4),
+                "total_value": round(sum(category["total_value"] for category in categories), 2),
                 "categories": categories,
                 "low_stock_items": low_stock_formatted
             }
@@ -1550,65 +1779,38 @@ class OrderProcessor:
             if conn is None:
                 conn = sqlite3.connect(self.db_file)
                 close_conn = True
+            begin_immediate(conn)
             cursor = conn.cursor()
             
             # 计算总金额
             total_amount = unit_price * quantity if unit_price is not None else None
             
-            # 记录库存变动
-            cursor.execute('''
-                INSERT INTO inventory_transactions (
-                    item_code,
-                    transaction_type,
-                    quantity,
-                    unit_price,
-                    total_amount,
-                    notes
-                ) VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
+            # 记录库存变动（流水数量带符号：入库为正、出库为负）
+            signed_quantity = quantity if transaction_type == 'in' else -quantity
+            record_transactions(cursor, [(
                 item_code,
                 transaction_type,
-                quantity,
+                signed_quantity,
                 unit_price,
                 total_amount,
                 notes
-            ))
+            )])
             
-            # 更新库存数量和价值
+            # 更新库存数量和价值（入库带单价时更新加权平均价格，出库保持不变）
             if transaction_type == 'in':
-                # 入库：增加库存，更新加权平均价格
-                if unit_price is not None:
-                    cursor.execute('''
-                        UPDATE inventory_items
-                        SET 
-                            current_stock = current_stock + ?,
-                            weighted_avg_price = CASE
-                                WHEN current_stock = 0 THEN ?
-                                ELSE (weighted_avg_price * current_stock + ? * ?) / (current_stock + ?)
-                            END,
-                            total_value = (current_stock + ?) * weighted_avg_price,
-                            last_updated = CURRENT_TIMESTAMP
-                        WHERE item_code = ?
-                    ''', (quantity, unit_price, quantity, unit_price, quantity, quantity, item_code))
-                else:
-                    cursor.execute('''
-                        UPDATE inventory_items
-                        SET 
-                            current_stock = current_stock + ?,
-                            total_value = (current_stock + ?) * weighted_avg_price,
-                            last_updated = CURRENT_TIMESTAMP
-                        WHERE item_code = ?
-                    ''', (quantity, quantity, item_code))
+                incoming_cost = unit_price * quantity if unit_price is not None else None
+                apply_stock_changes(cursor, [(item_code, quantity, incoming_cost)])
+                
+                # 加权平均价变化后，只重算使用该物料的产品成本
+                if incoming_cost is not None:
+                    try:
+                        refreshed = recalculate_affected_costs(cursor, [item_code])
+                        if refreshed:
+                            print(f"💰 已重算受影响的 {refreshed} 个产品成本")
+                    except Exception as e:
+                        print(f"⚠️ 重算受影响产品成本失败: {e}，入库记录仍会保存")
             else:
-                # 出库：减少库存，保持加权平均价格不变
-                cursor.execute('''
-                    UPDATE inventory_items
-                    SET 
-                        current_stock = current_stock - ?,
-                        total_value = (current_stock - ?) * weighted_avg_price,
-                        last_updated = CURRENT_TIMESTAMP
-                    WHERE item_code = ?
-                ''', (quantity, quantity, item_code))
+                apply_stock_changes(cursor, [(item_code, -quantity, None)])
             
             if close_conn:
                 conn.commit()
@@ -1700,6 +1902,8 @@ class OrderProcessor:
                 (product_code, material_code, required_quantity, unit, notes)
                 VALUES (?, ?, ?, ?, ?)
             ''', sample_bom)
+            rebuild_where_used(cursor)
+            record_opening_balances(cursor)
             
             conn.commit()
             conn.close()
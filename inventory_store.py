@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+库存变动原语
+所有库存数量变化（销售出库、生产领料、完工入库、采购入库、手工入库）都经过 apply_stock_changes：
+在SQL中做相对更新（current_stock = current_stock + ?），加权平均价和库存金额按更新后的数量一并计算，
+多个worker同时写入也不会丢失更新。写事务用 BEGIN IMMEDIATE 开始，一开始就取得写锁，
+避免先读后写时升级锁失败（database is locked）；写锁被占用时在事务外等待后重试。
+行版本号 version 只是变动计数（每次库存变动加1），不用于冲突检测。
+库存余额快照 inventory_snapshots 定期记录每个物料的库存和价值，查询历史某日库存时
+从最近的快照出发，只扫描快照之后的库存流水。
+库存流水保存在 inventory_ledger：整数物料键、整数流水类型、带符号数量（正数入库、负数出库）、
+Unix时间戳（秒），inventory_transactions 视图保留旧的表结构供查询和兼容写入。
+库存对账按物料一次分组汇总全部流水，找出库存数量、库存金额与流水不一致的物料，可在同一事务中修复。
+库存分类汇总 inventory_category_rollup 由 inventory_items 上的触发器增量维护，库存汇总只读分类行，
+对账时与按物料重新分组的结果比对，修复时全量重建
+"""
+
+import math
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+# SQLite单条语句的参数数量有限，批量查询时分块
+SQL_CHUNK_SIZE = 500
+
+# 取得写锁的最大重试次数（每次尝试本身还会按连接的 timeout 等待）
+MAX_RETRIES = 5
+
+# 入库带成本时按移动加权平均更新单价；原库存不为正或入库后仍不为正时取本次入库单价
+_NEW_AVG_PRICE_SQL = '''CASE
+    WHEN :incoming_cost IS NULL OR :quantity <= 0 THEN weighted_avg_price
+    WHEN current_stock <= 0 OR current_stock + :quantity <= 0 THEN :incoming_cost / :quantity
+    ELSE (weighted_avg_price * current_stock + :incoming_cost) / (current_stock + :quantity)
+END'''
+
+_UPDATE_STOCK_SQL = f'''
+    UPDATE inventory_items
+    SET current_stock = current_stock + :quantity,
+        weighted_avg_price = {_NEW_AVG_PRICE_SQL},
+        total_value = (current_stock + :quantity) * {_NEW_AVG_PRICE_SQL},
+        version = version + 1,
+        last_updated = CURRENT_TIMESTAMP
+    WHERE item_code = :item_code
+    RETURNING current_stock
+'''
+
+# 库存流水类型编码（inventory_transaction_types），其他类型写入时自动追加编码
+TRANSACTION_TYPES = {
+    'in': 1,
+    'out': 2,
+    '生产出库': 3,
+    '生产入库': 4,
+    '采购入库': 5,
+    '期初': 6,
+}
+
+# 期初余额流水：启用流水对账前已有的库存，不是某一天发生的库存变动，历史库存查询不计入
+OPENING_BALANCE_TYPE = '期初'
+
+# 删除物料时冲销剩余库存的流水，保留删除前的流水和快照，历史库存查询不受删除影响
+DELETION_TYPE = '物料删除'
+
+# 对账容差：库存数量和库存金额
+STOCK_TOLERANCE = 1e-6
+VALUE_TOLERANCE = 0.01
+
+# 按物料分组计算分类汇总（重建汇总表和对账共用）
+_CATEGORY_ROLLUP_SQL = '''
+    SELECT item_category, COUNT(*), COALESCE(SUM(current_stock), 0), COALESCE(SUM(total_value), 0),
+           COALESCE(SUM(weighted_avg_price), 0),
+           SUM(COALESCE(current_stock <= COALESCE(low_stock_threshold, 100), 0))
+    FROM inventory_items
+    GROUP BY item_category
+'''
+
+
+class InventoryLockError(RuntimeError):
+    """多次重试后仍无法取得数据库写锁"""
+
+
+def _is_busy_error(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def begin_immediate(conn, max_retries=MAX_RETRIES):
+    """开始写事务（BEGIN IMMEDIATE），写锁被占用时等待后重试
+
+    已在事务中时不做任何操作，由开启事务的调用方负责；重试前没有持有任何锁
+    """
+    if conn.in_transaction:
+        return
+    for attempt in range(max_retries):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_busy_error(e):
+                raise
+        time.sleep(0.05 * (attempt + 1))
+    raise InventoryLockError(f"数据库写锁被占用，已重试 {max_retries} 次")
+
+
+def _day_end(as_of_date):
+    """某日（本地时间）结束时的Unix时间戳"""
+    day = datetime.strptime(as_of_date, '%Y-%m-%d') + timedelta(days=1)
+    return int(time.mktime(day.timetuple()))
+
+
+def record_transactions(cursor, entries, created_at=None):
+    """写入库存流水（不提交，随调用方事务提交）
+
+    entries: [(item_code, 流水类型, quantity, unit_price, total_amount, notes)]，quantity 正数入库、负数出库
+    """
+    if not entries:
+        return
+    created_at = int(time.time()) if created_at is None else created_at
+    cursor.executemany(
+        'INSERT OR IGNORE INTO inventory_item_keys (item_code) VALUES (?)',
+        [(entry[0],) for entry in entries]
+    )
+    new_types = {entry[1] for entry in entries} - TRANSACTION_TYPES.keys()
+    cursor.executemany(
+        'INSERT OR IGNORE INTO inventory_transaction_types (type_name) VALUES (?)',
+        [(type_name,) for type_name in sorted(new_types)]
+    )
+    cursor.executemany('''
+        INSERT INTO inventory_ledger (item_id, type_id, quantity, unit_price, total_amount, created_at, notes)
+        SELECT k.item_id, t.type_id, ?, ?, ?, ?, ?
+        FROM inventory_item_keys k, inventory_transaction_types t
+        WHERE k.item_code = ? AND t.type_name = ?
+    ''', [
+        (quantity, unit_price, total_amount, created_at, notes, item_code, transaction_type)
+        for item_code, transaction_type, quantity, unit_price, total_amount, notes in entries
+    ])
+
+
+
+def record_item_deletion(cursor, item_code):
+    """删除物料前记一笔冲销流水，把账面库存冲为零（不提交，随调用方事务提交）
+
+    保留该物料已有的流水和快照：删除日之前的历史库存查询结果不变，对账也不会报告未冲销的库存。
+    冲销流水记录删除时的加权平均价，供没有快照时估算历史价值
+    """
+    cursor.execute('''
+        SELECT COALESCE(SUM(l.quantity), 0),
+               (SELECT weighted_avg_price FROM inventory_items WHERE item_code = ?)
+        FROM inventory_item_keys k
+        JOIN inventory_ledger l ON l.item_id = k.item_id
+        WHERE k.item_code = ?
+    ''', (item_code, item_code))
+    ledger_stock, price = cursor.fetchone()
+    ledger_stock = float(ledger_stock)
+    if abs(ledger_stock) > STOCK_TOLERANCE:
+        record_transactions(cursor, [(item_code, DELETION_TYPE, -ledger_stock, price, None, '删除物料')])
+
+def migrate_inventory_transactions(cursor):
+    """把旧版 inventory_transactions 表迁移到 inventory_ledger 后删除旧表，返回迁移的流水条数
+
+    旧表 'out' 出库数量记为正数，迁移后改为负数；流水id保持不变（快照水位线仍然有效）；
+    CURRENT_TIMESTAMP 写入的时间是UTC，isoformat 写入的（带'T'）是本地时间，分别换算为Unix时间戳
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'inventory_transactions'")
+    if cursor.fetchone() is None:
+        return 0
+
+    cursor.execute('''
+        INSERT OR IGNORE INTO inventory_item_keys (item_code)
+        SELECT DISTINCT item_code FROM inventory_transactions
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO inventory_transaction_types (type_name)
+        SELECT DISTINCT transaction_type FROM inventory_transactions
+    ''')
+    cursor.execute('''
+        INSERT INTO inventory_ledger (id, item_id, type_id, quantity, unit_price, total_amount, created_at, notes)
+        SELECT tr.id, k.item_id, t.type_id,
+               CASE WHEN tr.transaction_type = 'out' THEN -tr.quantity ELSE tr.quantity END,
+               tr.unit_price, tr.total_amount,
+               COALESCE(CAST(CASE WHEN instr(tr.transaction_date, 'T')
+                                  THEN strftime('%s', tr.transaction_date, 'utc')
+                                  ELSE strftime('%s', tr.transaction_date) END AS INTEGER),
+                        CAST(strftime('%s', 'now') AS INTEGER)),
+               tr.notes
+        FROM inventory_transactions tr
+        JOIN inventory_item_keys k ON k.item_code = tr.item_code
+        JOIN inventory_transaction_types t ON t.type_name = tr.transaction_type
+        ORDER BY tr.id
+    ''')
+    migrated = cursor.rowcount
+    cursor.execute('DROP TABLE inventory_transactions')
+    return migrated
+
+
+def _merge_changes(changes):
+    """同一物料的多次变动合并为一次：{物料编码: [数量, 入库成本或None]}"""
+    merged = {}
+    for item_code, quantity, incoming_cost in changes:
+        entry = merged.setdefault(item_code, [0.0, None])
+        entry[0] += float(quantity)
+        if incoming_cost is not None:
+            entry[1] = (entry[1] or 0.0) + float(incoming_cost)
+    return merged
+
+
+def apply_stock_changes(cursor, changes):
+    """批量变动库存（不提交，随调用方事务提交）
+
+    changes: [(item_code, quantity, incoming_cost)]
+        quantity 正数入库、负数出库；
+        incoming_cost 为本次入库总成本（含其他费用），None 表示不影响加权平均价
+    返回 {物料编码: (变动前库存, 变动后库存)}，库存表中不存在的物料不更新也不返回
+    不在事务中时以 BEGIN IMMEDIATE 开始事务；调用方先读后写时应先调用 begin_immediate
+    """
+    merged = _merge_changes(changes)
+    if not merged:
+        return {}
+
+    begin_immediate(cursor.connection)
+
+    changed = {}
+    for item_code, (quantity, incoming_cost) in merged.items():
+        cursor.execute(_UPDATE_STOCK_SQL, {
+            'item_code': item_code,
+            'quantity': quantity,
+            'incoming_cost': incoming_cost
+        })
+        row = cursor.fetchone()
+        if row is not None:
+            stock = float(row[0] or 0)
+            changed[item_code] = (stock - quantity, stock)
+    return changed
+
+
+def create_inventory_snapshot(cursor, snapshot_date=None):
+    """记录当前所有物料的库存余额快照（同一天重复执行时覆盖），返回快照物料数
+
+    快照与流水水位线（当时最大的流水id）在同一条语句中读取，之后的流水都不包含在快照内
+    """
+    snapshot_date = snapshot_date or datetime.now().strftime('%Y-%m-%d')
+    cursor.execute('''
+        INSERT OR REPLACE INTO inventory_snapshots
+        (snapshot_date, item_code, stock, weighted_avg_price, total_value, last_transaction_id, created_at)
+        SELECT ?, item_code, current_stock, weighted_avg_price, current_stock * weighted_avg_price,
+               (SELECT COALESCE(MAX(id), 0) FROM inventory_ledger), CURRENT_TIMESTAMP
+        FROM inventory_items
+    ''', (snapshot_date,))
+    return cursor.rowcount
+
+
+def get_inventory_as_of(cursor, as_of_date):
+    """计算某日结束时每个物料的库存和价值
+
+    从不晚于该日的最近快照出发，只扫描快照水位线之后、该日结束前的流水（按主键范围扫描），
+    按移动加权平均重放单价；没有可用快照时从当前库存倒推该日之后的流水（价值按当前单价估算）。
+    返回 (计算方式, 快照日期, {物料编码: (库存, 加权平均价, 价值)}, 扫描的流水条数)
+    """
+    cursor.execute('''
+        SELECT MAX(snapshot_date) FROM inventory_snapshots WHERE snapshot_date <= date(?)
+    ''', (as_of_date,))
+    snapshot_date = cursor.fetchone()[0]
+
+    if snapshot_date is None:
+        cursor.execute('SELECT item_code, current_stock, weighted_avg_price FROM inventory_items')
+        balances = {row[0]: [float(row[1] or 0), float(row[2] or 0)] for row in cursor.fetchall()}
+        # 已删除物料没有当前单价，按删除时冲销流水记录的单价估算
+        cursor.execute('''
+            SELECT k.item_code, l.unit_price
+            FROM inventory_ledger l
+            JOIN inventory_item_keys k ON k.item_id = l.item_id
+            JOIN inventory_transaction_types t ON t.type_id = l.type_id
+            WHERE t.type_name = ? AND k.item_code NOT IN (SELECT item_code FROM inventory_items)
+            ORDER BY l.id
+        ''', (DELETION_TYPE,))
+        for item_code, unit_price in cursor.fetchall():
+            balances[item_code] = [0.0, float(unit_price or 0)]
+        cursor.execute('''
+            SELECT k.item_code, l.quantity, l.count
+            FROM (
+                SELECT item_id, SUM(quantity) AS quantity, COUNT(*) AS count
+                FROM inventory_ledger
+                WHERE created_at >= ? AND type_id != ?
+                GROUP BY item_id
+            ) l
+            JOIN inventory_item_keys k ON k.item_id = l.item_id
+        ''', (_day_end(as_of_date), TRANSACTION_TYPES[OPENING_BALANCE_TYPE]))
+        scanned = 0
+        for item_code, quantity, count in cursor.fetchall():
+            balance = balances.setdefault(item_code, [0.0, 0.0])
+            balance[0] -= float(quantity or 0)
+            scanned += count
+        result = {code: (stock, price, stock * price) for code, (stock, price) in balances.items()}
+        return 'current', None, result, scanned
+
+    cursor.execute('''
+        SELECT item_code, stock, weighted_avg_price, last_transaction_id
+        FROM inventory_snapshots WHERE snapshot_date = ?
+    ''', (snapshot_date,))
+    balances = {}
+    watermark = 0
+    for item_code, stock, price, last_transaction_id in cursor.fetchall():
+        balances[item_code] = [float(stock or 0), float(price or 0)]
+        watermark = last_transaction_id
+
+    cursor.execute('''
+        SELECT k.item_code, l.quantity, l.total_amount
+        FROM inventory_ledger l
+        JOIN inventory_item_keys k ON k.item_id = l.item_id
+        WHERE l.id > ? AND l.created_at < ? AND l.type_id != ?
+        ORDER BY l.id
+    ''', (watermark, _day_end(as_of_date), TRANSACTION_TYPES[OPENING_BALANCE_TYPE]))
+    scanned = 0
+    for item_code, quantity, total_amount in cursor.fetchall():
+        scanned += 1
+        quantity = float(quantity or 0)
+        balance = balances.setdefault(item_code, [0.0, 0.0])
+        stock, price = balance
+        # 与 apply_stock_changes 相同的移动加权平均规则
+        if quantity > 0 and total_amount:
+            if stock <= 0 or stock + quantity <= 0:
+                price = float(total_amount) / quantity
+            else:
+                price = (price * stock + float(total_amount)) / (stock + quantity)
+        balance[0] = stock + quantity
+        balance[1] = price
+
+    result = {code: (stock, price, stock * price) for code, (stock, price) in balances.items()}
+    return 'snapshot', snapshot_date, result, scanned
+
+
+# 按物料分组汇总流水得到账面库存（走 (item_id, type_id, quantity) 覆盖索引）
+_LEDGER_BALANCES_SQL = '''
+    SELECT item_id, SUM(quantity) AS ledger_stock, COUNT(*) AS transaction_count
+    FROM inventory_ledger
+    GROUP BY item_id
+'''
+
+
+def record_opening_balances(cursor):
+    """为库存与流水不一致的物料补记期初余额流水，使流水合计等于当前库存，返回补记的物料数"""
+    cursor.execute('INSERT OR IGNORE INTO inventory_item_keys (item_code) SELECT item_code FROM inventory_items')
+    cursor.execute(f'''
+        INSERT INTO inventory_ledger (item_id, type_id, quantity, unit_price, total_amount, created_at, notes)
+        SELECT k.item_id, ?, i.current_stock - COALESCE(l.ledger_stock, 0), i.weighted_avg_price,
+               (i.current_stock - COALESCE(l.ledger_stock, 0)) * i.weighted_avg_price, ?, '期初库存余额'
+        FROM inventory_items i
+        JOIN inventory_item_keys k ON k.item_code = i.item_code
+        LEFT JOIN ({_LEDGER_BALANCES_SQL}) l ON l.item_id = k.item_id
+        WHERE abs(i.current_stock - COALESCE(l.ledger_stock, 0)) > ?
+    ''', (TRANSACTION_TYPES[OPENING_BALANCE_TYPE], int(time.time()), STOCK_TOLERANCE))
+    return cursor.rowcount
+
+
+def ensure_opening_balances(cursor):
+    """只执行一次的迁移：启用流水对账前的库存记为期初余额"""
+    cursor.execute('''
+        INSERT OR IGNORE INTO config_versions (config_key, version) VALUES ('inventory_opening_balance', 1)
+    ''')
+    if cursor.rowcount:
+        return record_opening_balances(cursor)
+    return 0
+
+
+def reconcile_inventory(cursor, repair=False):
+    """库存对账：按物料一次分组汇总全部流水，对比 current_stock 和 total_value
+
+    账面库存 = 流水带符号数量合计，账面金额 = 账面库存 × 加权平均价。
+    同时检查分类汇总表是否与物料一致（触发器维护的汇总可能因直接改库等原因偏离）。
+    已删除物料的流水保留作历史，只有账面库存未冲销为零时才报告。
+    repair 为真时先取得写锁（对账期间其他连接不能变动库存），把不一致的物料改为账面值，
+    为未冲销的已删除物料补记冲销流水，并全量重建分类汇总。不提交，随调用方事务提交。
+    返回 {'checked': 物料数, 'drift': 不一致明细, 'orphans': 未冲销的已删除物料,
+          'rollup_drift': 汇总不一致的分类, 'repaired': 是否已修复}
+    """
+    if repair:
+        begin_immediate(cursor.connection)
+
+    cursor.execute(f'''
+        SELECT i.item_code, i.current_stock, i.total_value, i.weighted_avg_price,
+               COALESCE(l.ledger_stock, 0), COALESCE(l.transaction_count, 0)
+        FROM inventory_items i
+        LEFT JOIN inventory_item_keys k ON k.item_code = i.item_code
+        LEFT JOIN ({_LEDGER_BALANCES_SQL}) l ON l.item_id = k.item_id
+        WHERE abs(i.current_stock - COALESCE(l.ledger_stock, 0)) > ?
+           OR abs(COALESCE(i.total_value, 0) - COALESCE(l.ledger_stock, 0) * i.weighted_avg_price) > ?
+        ORDER BY i.item_code
+    ''', (STOCK_TOLERANCE, VALUE_TOLERANCE))
+    rows = cursor.fetchall()
+
+    drift = []
+    for item_code, stock, value, price, ledger_stock, count in rows:
+        stock, value, price = float(stock or 0), float(value or 0), float(price or 0)
+        ledger_stock = float(ledger_stock)
+        drift.append({
+            'item_code': item_code,
+            'current_stock': round(stock, 4),
+            'ledger_stock': round(ledger_stock, 4),
+            'stock_drift': round(stock - ledger_stock, 4),
+            'total_value': round(value, 2),
+            'ledger_value': round(ledger_stock * price, 2),
+            'value_drift': round(value - ledger_stock * price, 2),
+            'transaction_count': count
+        })
+
+    cursor.execute(f'''
+        SELECT k.item_code, l.ledger_stock, l.transaction_count
+        FROM ({_LEDGER_BALANCES_SQL}) l
+        JOIN inventory_item_keys k ON k.item_id = l.item_id
+        WHERE k.item_code NOT IN (SELECT item_code FROM inventory_items)
+          AND ABS(l.ledger_stock) > ?
+        ORDER BY k.item_code
+    ''', (STOCK_TOLERANCE,))
+    orphans = [
+        {'item_code': row[0], 'ledger_stock': round(float(row[1]), 4), 'transaction_count': row[2]}
+        for row in cursor.fetchall()
+    ]
+
+    cursor.execute('SELECT COUNT(*) FROM inventory_items')
+    checked = cursor.fetchone()[0]
+
+    rollup_drift = check_category_rollup(cursor)
+
+    repaired = False
+    if repair and (drift or orphans or rollup_drift):
+        cursor.executemany('''
+            UPDATE inventory_items
+            SET current_stock = ledger.ledger_stock,
+                total_value = ledger.ledger_stock * weighted_avg_price,
+                version = version + 1,
+                last_updated = CURRENT_TIMESTAMP
+            FROM (
+                SELECT COALESCE(SUM(l.quantity), 0) AS ledger_stock
+                FROM inventory_item_keys k
+                JOIN inventory_ledger l ON l.item_id = k.item_id
+                WHERE k.item_code = ?
+            ) AS ledger
+            WHERE item_code = ?
+        ''', [(item['item_code'], item['item_code']) for item in drift])
+        record_transactions(cursor, [
+            (item['item_code'], DELETION_TYPE, -item['ledger_stock'], None, None, '对账冲销已删除物料')
+            for item in orphans
+        ])
+        # 物料修复经触发器更新汇总，汇总本身偏离时仍需全量重建
+        rebuild_category_rollup(cursor)
+        repaired = True
+
+    return {
+        'checked': checked, 'drift': drift, 'orphans': orphans,
+        'rollup_drift': rollup_drift, 'repaired': repaired
+    }
+
+
+def rebuild_category_rollup(cursor):
+    """从 inventory_items 重建库存分类汇总（触发器增量维护，旧数据库或需要校正时全量重建）"""
+    cursor.execute('DELETE FROM inventory_category_rollup')
+    cursor.execute(f'''
+        INSERT INTO inventory_category_rollup
+        (item_category, item_count, total_stock, total_value, price_sum, low_stock_count)
+        {_CATEGORY_ROLLUP_SQL}
+    ''')
+    return cursor.rowcount
+
+
+def check_category_rollup(cursor):
+    """对比分类汇总表与按物料重新分组的结果，返回不一致的分类（汇总表缺行或多行也算）"""
+    cursor.execute(_CATEGORY_ROLLUP_SQL)
+    actual = {row[0]: row[1:] for row in cursor.fetchall()}
+    cursor.execute('''
+        SELECT item_category, item_count, total_stock, total_value, price_sum, low_stock_count
+        FROM inventory_category_rollup
+    ''')
+    stored = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    # 数量、金额是浮点累加结果，按对账容差比较
+    tolerances = (0, STOCK_TOLERANCE, VALUE_TOLERANCE, VALUE_TOLERANCE, 0)
+    drift = []
+    for category in sorted(set(actual) | set(stored)):
+        expected, current = actual.get(category), stored.get(category)
+        if expected is None or current is None or not all(
+            math.isclose(float(a or 0), float(b or 0), rel_tol=1e-9, abs_tol=tolerance)
+            for a, b, tolerance in zip(expected, current, tolerances)
+        ):
+            drift.append(category)
+    return drift
+
+
+def load_category_rollup(cursor):
+    """读取库存分类汇总，按库存金额从高到低排列"""
+    cursor.execute('''
+        SELECT item_category, item_count, total_stock, total_value, price_sum, low_stock_count
+        FROM inventory_category_rollup
+        ORDER BY total_value DESC
+    ''')
+    return [
+        {
+            'category': category or '未分类',
+            'item_count': item_count,
+            'total_stock': round(float(total_stock), 4),
+            'total_value': round(float(total_value), 2),
+            'avg_price': round(float(price_sum) / item_count, 4) if item_count else 0.0,
+            'low_stock_count': low_stock_count
+        }
+        for category, item_count, total_stock, total_value, price_sum, low_stock_count in cursor.fetchall()
+    ]
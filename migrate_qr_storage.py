@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+二维码存储迁移脚本
+将 qrcodes/ 下平铺的 order_X.png 移动到哈希分片目录 qrcodes/ab/cd/，
+并重建 qr_code_index 索引表
+"""
+
+import sqlite3
+import os
+import sys
+
+from excel_processor import OrderProcessor
+from qr_store import qr_relative_path, record_qr_files
+
+# 每批写入索引的记录数
+BATCH_SIZE = 1000
+
+
+def migrate_qr_storage(db_file="orders.db", qr_dir="qrcodes"):
+    """迁移二维码文件到分片目录并建立索引"""
+    print("🔧 开始二维码存储迁移...")
+
+    if not os.path.exists(qr_dir):
+        print(f"❌ 二维码目录 {qr_dir} 不存在，无需迁移")
+        return
+
+    # 确保索引表存在
+    OrderProcessor(db_file=db_file, base_url="").init_database()
+
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+
+    moved_count = 0
+    indexed_count = 0
+    batch = []
+
+    try:
+        # 1. 移动平铺文件（os.scandir 逐项读取，不一次性加载整个目录列表）
+        with os.scandir(qr_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not entry.is_file() or not (name.startswith('order_') and name.endswith('.png')):
+                    continue
+
+                order_id = name[len('order_'):-len('.png')]
+                target = os.path.join(qr_dir, qr_relative_path(order_id))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(entry.path, target)
+                moved_count += 1
+
+        print(f"📦 已移动 {moved_count} 个二维码文件到分片目录")
+
+        # 2. 按分片目录重建索引（重复执行迁移时也会补录遗漏的文件）
+        for root, _, files in os.walk(qr_dir):
+            if os.path.normpath(root) == os.path.normpath(qr_dir):
+                continue
+            for name in files:
+                if not (name.startswith('order_') and name.endswith('.png')):
+                    continue
+                order_id = name[len('order_'):-len('.png')]
+                relative_path = qr_relative_path(order_id)
+                full_path = os.path.join(qr_dir, relative_path)
+                if not os.path.exists(full_path):
+                    continue
+                batch.append((order_id, relative_path, os.path.getsize(full_path)))
+                if len(batch) >= BATCH_SIZE:
+                    record_qr_files(cursor, batch)
+                    conn.commit()
+                    indexed_count += len(batch)
+                    batch = []
+
+        if batch:
+            record_qr_files(cursor, batch)
+            indexed_count += len(batch)
+        conn.commit()
+
+        cursor.execute("SELECT COUNT(*) FROM qr_code_index")
+        total_indexed = cursor.fetchone()[0]
+
+        print(f"✅ 二维码存储迁移完成！本次写入索引 {indexed_count} 条，索引总数: {total_indexed}")
+
+    except Exception as e:
+        print(f"❌ 迁移失败: {str(e)}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "orders.db"
+    qr_path = sys.argv[2] if len(sys.argv) > 2 else "qrcodes"
+    migrate_qr_storage(db_path, qr_path)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+物料需求计划（MRP）
+把待处理销售订单（及额外计划需求）经多级BOM展开为原料毛需求，与当前库存、在途采购做净额计算，
+以 low_stock_threshold 为再订货点、warning_stock_threshold 为补货目标生成采购建议。
+所有物料装入数组一次向量化计算，采购建议可按采购订单模板格式导出后直接上传入库
+"""
+
+from datetime import datetime
+
+import numpy as np
+
+from bom_engine import BomCycleError, BomGraph
+
+# 采购订单模板列（与 purchase_template.xlsx / 上传采购订单一致）
+PURCHASE_TEMPLATE_COLUMNS = ['采购单号', '物品编码', '物品名称', '分类', '供应商', '采购日期', '数量', '单位', '单价', '其他费用']
+
+# 没有采购记录的物料在采购建议中的供应商
+DEFAULT_SUPPLIER = '待定'
+
+
+def load_pending_demand(cursor):
+    """待处理销售订单（尚未转换为生产订单）的产品需求 {产品编码: 数量}"""
+    cursor.execute('''
+        SELECT product_code, SUM(quantity)
+        FROM orders
+        WHERE product_code IS NOT NULL AND production_order_id IS NULL
+        GROUP BY product_code
+    ''')
+    return {row[0]: float(row[1] or 0) for row in cursor.fetchall()}
+
+
+def load_last_suppliers(cursor):
+    """每个物料最近一次采购的供应商 {物料编码: 供应商}"""
+    cursor.execute('''
+        SELECT item_code, supplier_name FROM (
+            SELECT item_code, supplier_name,
+                   ROW_NUMBER() OVER (PARTITION BY item_code ORDER BY purchase_date DESC, id DESC) AS rn
+            FROM purchase_records
+        ) WHERE rn = 1
+    ''')
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def plan_material_requirements(cursor, demand=None, scheduled_receipts=None, include_pending=True):
+    """计算物料需求计划
+
+    demand: 额外计划需求 {产品编码: 数量}，与待处理销售订单需求累加
+    scheduled_receipts: 在途采购 {物料编码: 数量}（采购订单导入即入库，系统中没有在途状态，由调用方提供）
+    include_pending: 是否计入待处理销售订单需求
+    返回 {'materials': 各物料净需求, 'suggestions': 采购建议, 'unplanned': 无法展开的需求, 'errors': BOM错误}
+    """
+    graph = BomGraph.load(cursor)
+
+    cursor.execute('''
+        SELECT item_code, item_name, item_category, unit, current_stock, weighted_avg_price,
+               COALESCE(low_stock_threshold, 100), COALESCE(warning_stock_threshold, 200)
+        FROM inventory_items
+        ORDER BY item_code
+    ''')
+    # 采购计划只针对需要采购的物料：没有BOM、且不是成品
+    items = [row for row in cursor.fetchall() if not graph.has_bom(row[0]) and row[2] != '产品']
+
+    codes = [row[0] for row in items]
+    material_index = {code: index for index, code in enumerate(codes)}
+    names = [row[1] for row in items]
+    categories = [row[2] for row in items]
+    units = [row[3] for row in items]
+    stocks = [float(row[4] or 0) for row in items]
+    prices = [float(row[5] or 0) for row in items]
+    low = [float(row[6]) for row in items]
+    warning = [float(row[7]) for row in items]
+
+    total_demand = load_pending_demand(cursor) if include_pending else {}
+    for product_code, quantity in (demand or {}).items():
+        total_demand[product_code] = total_demand.get(product_code, 0) + float(quantity)
+
+    # 需求展开为 (物料行, 数量) 列表，BOM中有但库存表中没有的原料按零库存追加
+    rows, quantities = [], []
+    unplanned = {}
+    errors = {}
+
+    def material_row(code):
+        if code not in material_index:
+            material_index[code] = len(codes)
+            codes.append(code)
+            names.append(code)
+            categories.append('原材料')
+            units.append(graph.unit(code) or '个')
+            stocks.append(0.0)
+            prices.append(0.0)
+            low.append(0.0)
+            warning.append(0.0)
+        return material_index[code]
+
+    for product_code, quantity in sorted(total_demand.items()):
+        if quantity <= 0:
+            continue
+        if graph.has_bom(product_code):
+            try:
+                flat = graph.flatten(product_code)
+            except BomCycleError as e:
+                errors[product_code] = str(e)
+                continue
+            for code, unit_quantity in flat.items():
+                rows.append(material_row(code))
+                quantities.append(unit_quantity * quantity)
+        elif product_code in material_index:
+            # 直接销售的外购物料
+            rows.append(material_index[product_code])
+            quantities.append(quantity)
+        else:
+            unplanned[product_code] = quantity
+
+    count = len(codes)
+    gross = np.bincount(np.array(rows, dtype=np.intp), weights=np.array(quantities, dtype=float), minlength=count)
+    receipts = np.zeros(count)
+    for code, quantity in (scheduled_receipts or {}).items():
+        if code in material_index:
+            receipts[material_index[code]] += float(quantity)
+
+    stock = np.array(stocks, dtype=float)
+    low = np.array(low, dtype=float)
+    warning = np.array(warning, dtype=float)
+    projected = stock + receipts - gross
+
+    # 预计库存低于再订货点时补到补货目标，按整单位向上取整
+    target = np.maximum(warning, low)
+    reorder = projected < low
+    suggested = np.where(reorder, np.ceil(np.round(target - projected, 6)), 0.0)
+    net_requirement = np.maximum(gross - stock - receipts, 0.0)
+
+    suppliers = load_last_suppliers(cursor)
+    materials = []
+    for index in np.flatnonzero((gross > 0) | reorder):
+        code = codes[index]
+        price = prices[index]
+        materials.append({
+            'material_code': code,
+            'material_name': names[index],
+            'category': categories[index],
+            'unit': units[index],
+            'current_stock': round(float(stock[index]), 4),
+            'gross_requirement': round(float(gross[index]), 4),
+            'scheduled_receipts': round(float(receipts[index]), 4),
+            'projected_stock': round(float(projected[index]), 4),
+            'net_requirement': round(float(net_requirement[index]), 4),
+            'low_stock_threshold': float(low[index]),
+            'warning_stock_threshold': float(warning[index]),
+            'suggested_quantity': float(suggested[index]),
+            'unit_price': round(price, 4),
+            'estimated_amount': round(float(suggested[index]) * price, 2),
+            'supplier': suppliers.get(code, DEFAULT_SUPPLIER)
+        })
+
+    suggestions = [material for material in materials if material['suggested_quantity'] > 0]
+    return {
+        'demand': {code: quantity for code, quantity in sorted(total_demand.items()) if quantity > 0},
+        'materials': materials,
+        'suggestions': suggestions,
+        'suggestion_count': len(suggestions),
+        'estimated_total': round(sum(material['estimated_amount'] for material in suggestions), 2),
+        'unplanned': unplanned,
+        'errors': errors
+    }
+
+
+def check_available_to_promise(cursor, lines):
+    """批量可承诺量（ATP）检查，只读不扣减库存
+
+    lines: [(product_code, quantity)]，按顺序分配：先占用成品库存，不足部分按多级BOM展开到最底层原料，
+    以剩余原料库存计算可生产数量（整件）。前面的行占用的库存后面的行不能再用。
+    返回每行的承诺结果列表，顺序与 lines 一致
+    """
+    graph = BomGraph.load(cursor)
+
+    # 原料可用库存向量（负库存按0计），各产品每件原料用量按需展开
+    material_index = {}
+    product_bom = {}
+    for product_code, _ in lines:
+        if product_code in product_bom or not graph.has_bom(product_code):
+            continue
+        try:
+            flat = {code: quantity for code, quantity in graph.flatten(product_code).items() if quantity > 0}
+        except BomCycleError as e:
+            product_bom[product_code] = e
+            continue
+        columns = np.array([material_index.setdefault(code, len(material_index)) for code in flat], dtype=np.intp)
+        product_bom[product_code] = (columns, np.array(list(flat.values()), dtype=float))
+
+    materials = list(material_index)
+    available = np.maximum(np.array([graph.stock(code) for code in materials], dtype=float), 0.0)
+    finished = {}
+
+    results = []
+    for line_number, (product_code, quantity) in enumerate(lines, start=1):
+        result = {
+            'line': line_number,
+            'product_code': product_code,
+            'quantity': quantity,
+            'from_stock': 0.0,
+            'from_production': 0.0,
+        }
+
+        # 1. 成品库存
+        if product_code not in finished:
+            finished[product_code] = max(float(graph.stock(product_code)), 0.0)
+        from_stock = min(quantity, finished[product_code])
+        finished[product_code] -= from_stock
+        remaining = quantity - from_stock
+
+        # 2. 原料库存可生产的数量
+        bom = product_bom.get(product_code)
+        from_production = 0.0
+        shortages = []
+        if remaining > 0 and isinstance(bom, BomCycleError):
+            result['error'] = str(bom)
+        elif remaining > 0 and bom is None:
+            result['error'] = '成品库存不足且找不到产品的BOM清单'
+        elif remaining > 0:
+            columns, unit_quantities = bom
+            buildable = np.floor(np.min(available[columns] / unit_quantities) + 1e-9) if len(columns) else remaining
+            from_production = float(min(remaining, max(buildable, 0.0)))
+            available[columns] -= unit_quantities * from_production
+
+            # 剩余缺口对应的原料缺口
+            if remaining > from_production:
+                missing = unit_quantities * (remaining - from_production) - available[columns]
+                shortages = [
+                    {
+                        'material_code': materials[column],
+                        'required': round(float(unit_quantities[k] * (remaining - from_production)), 4),
+                        'available': round(float(available[column]), 4),
+                        'shortage': round(float(missing[k]), 4)
+                    }
+                    for k, column in enumerate(columns) if missing[k] > 1e-9
+                ]
+
+        promised = from_stock + from_production
+        result.update({
+            'from_stock': round(from_stock, 4),
+            'from_production': round(from_production, 4),
+            'promised': round(promised, 4),
+            'shortfall': round(quantity - promised, 4),
+            'can_promise': quantity - promised <= 1e-9,
+            'material_shortages': shortages
+        })
+        results.append(result)
+
+    return results
+
+
+def purchase_suggestion_rows(suggestions, purchase_date=None):
+    """把采购建议转换为采购订单模板行（列顺序同 PURCHASE_TEMPLATE_COLUMNS）"""
+    now = datetime.now()
+    purchase_date = purchase_date or now.strftime('%Y-%m-%d')
+    prefix = f"MRP{now.strftime('%Y%m%d%H%M%S')}"
+    return [
+        [
+            f"{prefix}-{index:03d}",
+            material['material_code'],
+            material['material_name'],
+            material['category'],
+            material['supplier'],
+            purchase_date,
+            material['suggested_quantity'],
+            material['unit'],
+            material['unit_price'],
+            0
+        ]
+        for index, material in enumerate(suggestions, start=1)
+    ]
@@ -2,190 +2,309 @@
 # -*- coding: utf-8 -*-
 
 import sqlite3
+import uuid
 from datetime import datetime
 import logging
 
+from bom_engine import BomCycleError, BomGraph
+from cost_engine import recalculate_affected_costs
+from inventory_store import STOCK_TOLERANCE, apply_stock_changes, begin_immediate, record_transactions
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class ProductionOrderManager:
-    """生产订单管理器"""
+    """生产订单管理器
+    
+    所有查询和扣减共用一个数据库连接；每个生产订单的原料扣减、库存流水和销售订单标记在同一事务中提交
+    """
     
-    def __init__(self, db_path='orders.db'):
+    def __init__(self, db_path='orders.db', conn=None, bom_graph=None):
+        """conn 指定时复用调用方的连接（由调用方负责关闭），否则首次使用时自行打开；
+        bom_graph 指定时复用调用方已加载的BOM结构图"""
         self.db_path = db_path
+        self._conn = conn
+        self._owns_conn = conn is None
+        self._bom_graph = bom_graph
+    
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path)
+        return self._conn
+    
+    def close(self):
+        """关闭管理器自行打开的连接"""
+        if self._owns_conn and self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    def get_bom_graph(self):
+        """获取BOM结构图（首次使用时加载，同一管理器内多个产品共用）"""
+        if self._bom_graph is None:
+            self._bom_graph = BomGraph.load(self.conn.cursor())
+        return self._bom_graph
     
     def get_sales_demand(self):
-        """获取销售订单需求汇总"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """获取待处理销售订单需求汇总（已转换为生产订单的订单不再计入）
         
+        返回 [(产品编码, 需求数量, 最大rowid)]，标记已处理时只标记统计时已存在的订单
+        """
+        cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT product_code, SUM(quantity) as total_demand
+            SELECT product_code, SUM(quantity) as total_demand, MAX(rowid) as last_rowid
             FROM orders 
+            WHERE product_code IS NOT NULL AND production_order_id IS NULL
             GROUP BY product_code 
             ORDER BY product_code
         ''')
-        
-        sales_demand = cursor.fetchall()
-        conn.close()
-        
-        return sales_demand
+        return cursor.fetchall()
     
-    def get_bom_requirements(self, product_code, quantity):
-        """根据BOM获取生产所需原料"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+    def get_pending_demand(self, product_code, last_rowid):
+        """在当前写事务内重新统计产品 rowid 不超过 last_rowid 的待处理销售订单，返回 (订单数, 需求数量)"""
+        cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT material_code, required_quantity
-            FROM bom_items 
-            WHERE product_code = ?
-        ''', (product_code,))
-        
-        bom_items = cursor.fetchall()
-        conn.close()
+            SELECT COUNT(*), COALESCE(SUM(quantity), 0) FROM orders
+            WHERE product_code = ? AND production_order_id IS NULL AND rowid <= ?
+        ''', (product_code, last_rowid))
+        return cursor.fetchone()
+    
+    def mark_orders_processed(self, product_code, last_rowid, production_order_id):
+        """把产品的待处理销售订单标记为已转换为指定生产订单（随当前事务提交），返回标记的订单数"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            UPDATE orders SET production_order_id = ?
+            WHERE product_code = ? AND production_order_id IS NULL AND rowid <= ?
+        ''', (production_order_id, product_code, last_rowid))
+        return cursor.rowcount
+    
+    def get_bom_requirements(self, product_code, quantity):
+        """根据BOM获取生产所需原料（多级BOM展开到最底层原料）"""
+        graph = self.get_bom_graph()
+        if not graph.has_bom(product_code):
+            return []
         
         # 计算总需求量
-        material_requirements = []
-        for material_code, required_qty in bom_items:
-            total_needed = required_qty * quantity
-            material_requirements.append((material_code, total_needed))
-        
-        return material_requirements
+        return graph.requirements(product_code, quantity)
     
     def get_current_inventory(self, material_code):
         """获取当前库存"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT current_stock
+        return self.get_current_inventories([material_code]).get(material_code, 0)
+    
+    def get_current_inventories(self, material_codes):
+        """批量获取当前库存，返回 {物料编码: 库存}（不存在的物料不返回）"""
+        material_codes = list(material_codes)
+        if not material_codes:
+            return {}
+        placeholders = ','.join(['?' for _ in material_codes])
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT item_code, current_stock
             FROM inventory_items 
-            WHERE item_code = ?
-        ''', (material_code,))
+            WHERE item_code IN ({placeholders})
+        ''', material_codes)
+        return {code: stock or 0 for code, stock in cursor.fetchall()}
+    
+    def deduct_materials(self, material_requirements, order_reference):
+        """批量扣减原料库存并记录库存流水（不提交，随调用方事务提交）
         
-        result = cursor.fetchone()
-        conn.close()
+        material_requirements: [(原料编码, 扣减数量)]
+        返回 {原料编码: (扣减前库存, 扣减后库存)}
+        """
+        cursor = self.conn.cursor()
         
-        return result[0] if result else 0
-    
-    def deduct_material_inventory(self, material_code, quantity, order_reference):
-        """扣减原料库存"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # 库存在SQL中相对扣减（current_stock = current_stock + 负数量），并发写入不丢失更新；
+        # version 只是变动计数，不做冲突检查
+        changed = apply_stock_changes(cursor, [(code, -quantity, None) for code, quantity in material_requirements])
         
-        try:
-            # 获取当前库存
-            current_stock = self.get_current_inventory(material_code)
-            new_stock = current_stock - quantity
-            
-            # 更新库存
-            cursor.execute('''
-                UPDATE inventory_items 
-                SET current_stock = ?, last_updated = ?
-                WHERE item_code = ?
-            ''', (new_stock, datetime.now().isoformat(), material_code))
-            
-            # 记录库存交易
-            cursor.execute('''
-                INSERT INTO inventory_transactions 
-                (item_code, transaction_type, quantity, unit_price, total_amount, 
-                transaction_date, notes)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
+        record_transactions(cursor, [
+            (
                 material_code, 
                 '生产出库', 
                 -quantity,  # 负数表示出库
                 0,  # 单价，生产出库不涉及金额
                 0,  # 总金额
-                datetime.now().isoformat(),
                 f'生产订单原料消耗: {order_reference} - {material_code} × {quantity}'
-            ))
+            )
+            for material_code, quantity in material_requirements
+        ])
+        return changed
+    
+    def save_production_order(self, production_order_id, product_code, quantity, material_requirements, status='released'):
+        """保存生产订单及原料明细（不提交，随调用方事务提交）"""
+        now = datetime.now().isoformat()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT INTO production_orders
+            (production_order_id, product_code, quantity, status, created_at, released_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (production_order_id, product_code, quantity, status, now, now if status == 'released' else None))
+        cursor.executemany('''
+            INSERT INTO production_order_lines (production_order_id, material_code, quantity)
+            VALUES (?, ?, ?)
+        ''', [(production_order_id, material_code, needed) for material_code, needed in material_requirements])
+    
+    def complete_production_order(self, production_order_id):
+        """生产订单完工：状态改为 completed，成品按生产数量和领用原料成本入库"""
+        cursor = self.conn.cursor()
+        try:
+            begin_immediate(self.conn)
+            now = datetime.now().isoformat()
+            # 条件更新：只有已下达（原料已出库）的生产订单可以完工，且只完工入库一次
+            cursor.execute('''
+                UPDATE production_orders SET status = 'completed', completed_at = ?
+                WHERE production_order_id = ? AND status = 'released'
+            ''', (now, production_order_id))
+            if cursor.rowcount == 0:
+                self.conn.rollback()
+                cursor.execute('SELECT status FROM production_orders WHERE production_order_id = ?', (production_order_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return {"success": False, "error": f"生产订单 {production_order_id} 不存在"}
+                if row[0] == 'planned':
+                    return {"success": False, "error": f"生产订单 {production_order_id} 尚未下达，原料未出库，不能完工"}
+                if row[0] == 'completed':
+                    return {"success": False, "error": f"生产订单 {production_order_id} 已完工"}
+                return {"success": False, "error": f"生产订单 {production_order_id} 状态为 {row[0]}，不能完工"}
             
-            conn.commit()
+            cursor.execute('''
+                SELECT product_code, quantity FROM production_orders WHERE production_order_id = ?
+            ''', (production_order_id,))
+            product_code, quantity = cursor.fetchone()
             
-            logger.info(f"✅ 原料出库: {material_code} × {quantity} (剩余: {new_stock})")
-            return True, f"库存扣减成功，剩余: {new_stock}"
+            # 成品按本订单领用原料的成本入库（原料出库不改变加权平均价，按当前均价计算）
+            cursor.execute('''
+                SELECT SUM(l.quantity * COALESCE(i.weighted_avg_price, 0))
+                FROM production_order_lines l
+                LEFT JOIN inventory_items i ON i.item_code = l.material_code
+                WHERE l.production_order_id = ?
+            ''', (production_order_id,))
+            incoming_cost = cursor.fetchone()[0]
+            unit_price = incoming_cost / quantity if incoming_cost is not None and quantity > 0 else 0
             
+            apply_stock_changes(cursor, [(product_code, quantity, incoming_cost)])
+            record_transactions(cursor, [(
+                product_code, '生产入库', quantity, unit_price, incoming_cost or 0,
+                f'生产订单完工入库: {production_order_id} - {product_code} × {quantity}'
+            )])
+            
+            # 成品（半成品）加权平均价变化后，重算以它为子件的上层产品成本
+            if incoming_cost is not None:
+                try:
+                    refreshed = recalculate_affected_costs(cursor, [product_code])
+                    if refreshed:
+                        logger.info(f"💰 已重算受影响的 {refreshed} 个产品成本")
+                except Exception as e:
+                    logger.warning(f"⚠️ 重算受影响产品成本失败: {e}，完工入库仍会保存")
+            self.conn.commit()
+            
+            logger.info(f"✅ 生产订单完工: {production_order_id}，成品入库 {product_code} × {quantity}")
+            return {"success": True, "production_order_id": production_order_id,
+                    "product_code": product_code, "quantity": quantity}
+        
         except Exception as e:
-            conn.rollback()
-            logger.error(f"❌ 扣减原料库存失败: {e}")
-            return False, str(e)
-        finally:
-            conn.close()
+            self.conn.rollback()
+            logger.error(f"❌ 生产订单完工失败: {e}")
+            return {"success": False, "error": str(e)}
+    
+    def new_production_order_id(self, product_code):
+        """生成生产订单号"""
+        return f"PROD_{product_code}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
     
-    def create_production_order(self, product_code, quantity):
-        """创建生产订单并扣减原料库存"""
+    def create_production_order(self, product_code, quantity, production_order_id=None, sales_rowid=None):
+        """创建生产订单并扣减原料库存
+        
+        sales_rowid 指定时，在写事务内重新统计该产品 rowid 不超过此值的待处理销售订单，
+        需求数量与 quantity 一致时才扣减原料，并在同一事务内把这些订单标记为已处理；
+        不一致（例如已被并发的导入处理）时不扣减。
+        返回是否扣减成功（失败时整单回滚）；产品没有有效BOM、待处理需求已变化、未创建生产订单时返回None
+        """
         
         print(f"\n🏭 创建生产订单: {product_code} × {quantity}")
         
         # 获取BOM需求
-        material_requirements = self.get_bom_requirements(product_code, quantity)
+        try:
+            material_requirements = self.get_bom_requirements(product_code, quantity)
+        except BomCycleError as e:
+            print(f"❌ 产品 {product_code} 的BOM配方无效: {e}")
+            return None
         
         if not material_requirements:
             print(f"❌ 产品 {product_code} 没有找到BOM配方")
-            return False
+            return None
         
         print(f"📋 根据BOM计算原料需求:")
         
-        # 检查库存并扣减
-        production_order_id = f"PROD_{product_code}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        all_success = True
+        if production_order_id is None:
+            production_order_id = self.new_production_order_id(product_code)
         
+        # 一次查询所有原料库存，只用于提示库存不足
+        stocks = self.get_current_inventories(code for code, _ in material_requirements)
         for material_code, needed_quantity in material_requirements:
-            current_stock = self.get_current_inventory(material_code)
-            
+            current_stock = stocks.get(material_code, 0)
             print(f"   🔧 {material_code}: 需要 {needed_quantity}, 库存 {current_stock}")
-            
             if current_stock < needed_quantity:
                 print(f"   ⚠️ {material_code}: 库存不足 (缺少 {needed_quantity - current_stock})")
                 # 继续执行，允许负库存
-            
-            # 扣减库存
-            success, message = self.deduct_material_inventory(
-                material_code, needed_quantity, production_order_id
-            )
-            
-            if not success:
-                print(f"   ❌ {material_code}: 扣减失败 - {message}")
-                all_success = False
-            else:
-                print(f"   ✅ {material_code}: {message}")
         
-        if all_success:
-            print(f"🎉 生产订单 {production_order_id} 创建成功，原料库存已扣减")
-        else:
-            print(f"⚠️ 生产订单 {production_order_id} 部分成功，请检查库存状态")
+        try:
+            begin_immediate(self.conn)
+            # 需求是在事务外统计的，取得写锁后重新统计，并发导入已处理的订单不再重复扣减
+            if sales_rowid is not None:
+                pending_count, pending_quantity = self.get_pending_demand(product_code, sales_rowid)
+                if abs(pending_quantity - quantity) > STOCK_TOLERANCE:
+                    self.conn.rollback()
+                    print(f"⚠️ 产品 {product_code} 的待处理需求已变化（{quantity} → {pending_quantity}），"
+                          f"未创建生产订单，原料库存未扣减")
+                    return None
+            
+            self.save_production_order(production_order_id, product_code, quantity, material_requirements)
+            changed = self.deduct_materials(material_requirements, production_order_id)
+            if sales_rowid is not None:
+                marked = self.mark_orders_processed(product_code, sales_rowid, production_order_id)
+                if marked != pending_count:
+                    raise RuntimeError(f"标记的销售订单数 {marked} 与待处理订单数 {pending_count} 不一致")
+                print(f"   🏷️ {marked} 个销售订单已标记为生产订单 {production_order_id}")
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"❌ 扣减原料库存失败: {e}")
+            print(f"⚠️ 生产订单 {production_order_id} 创建失败，原料库存未扣减")
+            return False
         
-        return all_success
+        for material_code, needed_quantity in material_requirements:
+            remaining = changed[material_code][1] if material_code in changed else '物料不存在'
+            logger.info(f"✅ 原料出库: {material_code} × {needed_quantity} (剩余: {remaining})")
+        print(f"🎉 生产订单 {production_order_id} 创建成功，原料库存已扣减")
+        return True
     
     def process_all_sales_orders(self):
-        """处理所有销售订单，转换为生产订单"""
+        """处理待处理的销售订单，转换为生产订单（每个订单只扣减一次原料）"""
         
         print("🚀 开始处理销售订单转生产订单...")
         
-        # 获取销售需求
+        # 获取待处理的销售需求
         sales_demand = self.get_sales_demand()
         
         if not sales_demand:
-            print("❌ 没有找到销售订单")
+            print("✅ 没有待处理的销售订单")
             return
         
-        print(f"📊 发现 {len(sales_demand)} 种产品的销售需求:")
-        for product_code, total_quantity in sales_demand:
+        print(f"📊 发现 {len(sales_demand)} 种产品的待处理销售需求:")
+        for product_code, total_quantity, _ in sales_demand:
             print(f"   📦 {product_code}: {total_quantity} 件")
         
-        # 为每种产品创建生产订单
-        for product_code, total_quantity in sales_demand:
-            self.create_production_order(product_code, total_quantity)
+        # 为每种产品创建生产订单，原料扣减成功的订单在同一事务中标记为已处理；
+        # 没有BOM的产品保持待处理，补充BOM后再扣减
+        for product_code, total_quantity, last_rowid in sales_demand:
+            self.create_production_order(product_code, total_quantity, sales_rowid=last_rowid)
         
         print("\n🎯 生产订单处理完成！")
     
     def show_inventory_summary(self):
         """显示库存汇总"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self.conn.cursor()
         
         print("\n📊 当前库存状态:")
         cursor.execute('SELECT item_code, current_stock FROM inventory_items ORDER BY item_code')
@@ -194,8 +313,6 @@ class ProductionOrderManager:
         for material_code, quantity in materials:
             status = "⚠️" if quantity < 0 else "✅"
             print(f"   {status} {material_code}: {quantity}")
-        
-        conn.close()
 
 def main():
     """主函数"""
@@ -205,14 +322,17 @@ def main():
     print("🏭 生产订单管理系统")
     print("=" * 60)
     
-    # 显示当前库存
-    manager.show_inventory_summary()
-    
-    # 处理销售订单
-    manager.process_all_sales_orders()
-    
-    # 显示处理后的库存
-    manager.show_inventory_summary()
+    try:
+        # 显示当前库存
+        manager.show_inventory_summary()
+        
+        # 处理销售订单
+        manager.process_all_sales_orders()
+        
+        # 显示处理后的库存
+        manager.show_inventory_summary()
+    finally:
+        manager.close()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
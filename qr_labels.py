@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+二维码标签页PDF生成
+按 N 联（列×行）把订单二维码标签排版到A4页面：二维码直接由模块矩阵绘制，
+各页可在多个进程中并行渲染，PDF逐页写出，内存占用与标签数量无关
+"""
+
+import os
+import sqlite3
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+from qr_store import assign_short_codes, build_qr_payload
+
+# A4 页面尺寸（英寸）与PDF单位（点，1英寸=72点）
+A4_INCHES = (8.27, 11.69)
+PDF_POINTS_PER_INCH = 72
+
+DEFAULT_DPI = 200
+DEFAULT_COLUMNS = 3
+DEFAULT_ROWS = 8
+PAGE_MARGIN_MM = 8
+QUIET_ZONE_MODULES = 2
+
+# 并行渲染的进程数上限（每个进程常驻一页位图）
+MAX_RENDER_WORKERS = 4
+
+# 中文字体候选（可通过环境变量 LABEL_FONT_PATH 指定）
+FONT_CANDIDATES = [
+    'C:/Windows/Fonts/msyh.ttc',
+    'C:/Windows/Fonts/simhei.ttf',
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',
+    '/System/Library/Fonts/PingFang.ttc',
+]
+
+
+@lru_cache(maxsize=8)
+def load_label_font(size):
+    """加载标签字体，找不到中文字体时退回Pillow默认字体"""
+    candidates = [os.environ.get('LABEL_FONT_PATH')] + FONT_CANDIDATES
+    for path in candidates:
+        if path and os.path.exists(path):
+            try:
+                return ImageFont.truetype(path, size)
+            except OSError:
+                continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 的默认字体不支持指定字号
+        return ImageFont.load_default()
+
+
+def qr_matrix_image(payload):
+    """由二维码模块矩阵直接生成1位图，每个模块一个像素（不经过qrcode的图片工厂）"""
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=QUIET_ZONE_MODULES,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    size = len(matrix)
+
+    img = Image.new('1', (size, size), 1)
+    img.putdata([0 if module else 1 for row in matrix for module in row])
+    return img
+
+
+def _fit_text(draw, text, font, max_width):
+    """截断超出标签宽度的文字"""
+    if draw.textlength(text, font=font) <= max_width:
+        return text
+    while text and draw.textlength(text + '…', font=font) > max_width:
+        text = text[:-1]
+    return text + '…'
+
+
+def render_label_page(job):
+    """渲染一页标签，返回 (宽, 高, Flate压缩后的1位像素数据)
+
+    job 为 (labels, columns, rows, dpi)，labels 为 [(二维码内容, 订单号, 客户, 产品)]。
+    该函数在子进程中执行，参数和返回值都必须可序列化。
+    """
+    labels, columns, rows, dpi = job
+    page_w = round(A4_INCHES[0] * dpi)
+    page_h = round(A4_INCHES[1] * dpi)
+    margin = round(PAGE_MARGIN_MM / 25.4 * dpi)
+    cell_w = (page_w - 2 * margin) // columns
+    cell_h = (page_h - 2 * margin) // rows
+    padding = max(min(cell_w, cell_h) // 12, 2)
+
+    page = Image.new('1', (page_w, page_h), 1)
+    draw = ImageDraw.Draw(page)
+
+    # 二维码边长不超过标签的宽和高，文字排在右侧剩余空间
+    qr_box = min(cell_w, cell_h) - 2 * padding
+    title_font = load_label_font(max(qr_box // 6, 10))
+    text_font = load_label_font(max(qr_box // 8, 8))
+
+    for index, (payload, order_id, customer_name, product) in enumerate(labels):
+        col = index % columns
+        row = index // columns
+        x0 = margin + col * cell_w
+        y0 = margin + row * cell_h
+
+        # 按整数倍放大模块，保证打印后每个模块边缘清晰
+        qr_img = qr_matrix_image(payload)
+        module_px = max(qr_box // qr_img.width, 1)
+        qr_img = qr_img.resize((qr_img.width * module_px, qr_img.height * module_px), Image.NEAREST)
+        page.paste(qr_img, (x0 + padding, y0 + (cell_h - qr_img.height) // 2))
+
+        text_x = x0 + 2 * padding + qr_img.width
+        text_width = x0 + cell_w - padding - text_x
+        if text_width <= 0:
+            continue
+        lines = [
+            (order_id, title_font),
+            (customer_name, text_font),
+            (product, text_font),
+        ]
+        line_gap = qr_box // 4
+        text_y = y0 + (cell_h - line_gap * len(lines)) // 2
+        for text, font in lines:
+            draw.text((text_x, text_y), _fit_text(draw, str(text or ''), font, text_width), font=font, fill=0)
+            text_y += line_gap
+
+    return page_w, page_h, zlib.compress(page.tobytes())
+
+
+class StreamingPdfWriter:
+    """逐页输出的最小PDF写入器：每页一个1位灰度图像，各方法返回需要输出的字节"""
+
+    PAGES_OBJ = 1
+    CATALOG_OBJ = 2
+
+    def __init__(self, page_size_points):
+        self.page_size = page_size_points
+        self.offset = 0
+        self.object_offsets = {}
+        self.page_objects = []
+        self.next_obj = 3
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def _object(self, number, body, stream=None):
+        self.object_offsets[number] = self.offset
+        data = f"{number} 0 obj\n".encode('ascii') + body
+        if stream is not None:
+            data += b"\nstream\n" + stream + b"\nendstream"
+        data += b"\nendobj\n"
+        return self._emit(data)
+
+    def begin(self):
+        return self._emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def add_page(self, width, height, flate_bits):
+        image_obj, content_obj, page_obj = self.next_obj, self.next_obj + 1, self.next_obj + 2
+        self.next_obj += 3
+        self.page_objects.append(page_obj)
+        page_w, page_h = self.page_size
+
+        image = self._object(image_obj, (
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /FlateDecode "
+            f"/Length {len(flate_bits)} >>"
+        ).encode('ascii'), flate_bits)
+
+        content_stream = f"q {page_w:.2f} 0 0 {page_h:.2f} 0 0 cm /Im0 Do Q".encode('ascii')
+        content = self._object(content_obj, f"<< /Length {len(content_stream)} >>".encode('ascii'), content_stream)
+
+        page = self._object(page_obj, (
+            f"<< /Type /Page /Parent {self.PAGES_OBJ} 0 R "
+            f"/MediaBox [0 0 {page_w:.2f} {page_h:.2f}] "
+            f"/Resources << /XObject << /Im0 {image_obj} 0 R >> >> "
+            f"/Contents {content_obj} 0 R >>"
+        ).encode('ascii'))
+        return image + content + page
+
+    def finish(self):
+        kids = ' '.join(f"{number} 0 R" for number in self.page_objects)
+        data = self._object(self.PAGES_OBJ, (
+            f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_objects)} >>"
+        ).encode('ascii'))
+        data += self._object(self.CATALOG_OBJ, f"<< /Type /Catalog /Pages {self.PAGES_OBJ} 0 R >>".encode('ascii'))
+
+        xref_offset = self.offset
+        total_objects = self.next_obj
+        xref = [f"xref\n0 {total_objects}\n", "0000000000 65535 f \n"]
+        for number in range(1, total_objects):
+            xref.append(f"{self.object_offsets[number]:010d} 00000 n \n")
+        xref.append(
+            f"trailer\n<< /Size {total_objects} /Root {self.CATALOG_OBJ} 0 R >>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n"
+        )
+        return data + self._emit(''.join(xref).encode('ascii'))
+
+
+def iter_label_pages(db_file, order_id_batches, base_url, labels_per_page):
+    """按批读取订单并分配短码，组装为每页的标签列表（生成器）"""
+    page = []
+    for batch in order_id_batches:
+        conn = sqlite3.connect(db_file)
+        try:
+            cursor = conn.cursor()
+            short_codes = assign_short_codes(cursor, batch)
+            conn.commit()
+            placeholders = ','.join(['?' for _ in batch])
+            cursor.execute(f'''
+                SELECT order_id, customer_name, product_details
+                FROM orders WHERE order_id IN ({placeholders})
+            ''', batch)
+            details = {row[0]: row for row in cursor.fetchall()}
+        finally:
+            conn.close()
+
+        for order_id in batch:
+            if order_id not in details:
+                continue
+            _, customer_name, product_details = details[order_id]
+            payload = build_qr_payload(base_url, short_codes[order_id])
+            page.append((payload, order_id, customer_name, product_details))
+            if len(page) == labels_per_page:
+                yield page
+                page = []
+    if page:
+        yield page
+
+
+def _render_pages(jobs, workers):
+    """渲染各页，workers>1 时多进程并行，按提交顺序返回并限制预取页数"""
+    if workers <= 1:
+        for job in jobs:
+            yield render_label_page(job)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(render_label_page, job))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def clamp_render_workers(workers=None):
+    """渲染进程数限制在 1..min(4, CPU核数)，未指定时取上限"""
+    limit = min(MAX_RENDER_WORKERS, os.cpu_count() or 1)
+    if workers is None:
+        return limit
+    return max(1, min(workers, limit))
+
+
+def generate_label_pdf(pages, columns=DEFAULT_COLUMNS, rows=DEFAULT_ROWS, dpi=DEFAULT_DPI, workers=None):
+    """生成标签页PDF，逐块返回PDF字节（生成器）"""
+    workers = clamp_render_workers(workers)
+
+    page_size = (A4_INCHES[0] * PDF_POINTS_PER_INCH, A4_INCHES[1] * PDF_POINTS_PER_INCH)
+    writer = StreamingPdfWriter(page_size)
+    yield writer.begin()
+
+    jobs = ((labels, columns, rows, dpi) for labels in pages)
+    for width, height, flate_bits in _render_pages(jobs, workers):
+        yield writer.add_page(width, height, flate_bits)
+
+    yield writer.finish()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+二维码短码与存储管理
+二维码中只编码稳定的短路径 /q/<短码>，短码通过 qr_short_codes 表解析为订单号，
+服务器地址变化时无需重新生成二维码。
+二维码图片按订单号哈希分散存放在 qrcodes/ab/cd/order_X.png，文件清单记录在
+qr_code_index 表中，列表和导出无需扫描目录。
+设置 QR_STORAGE=sqlite 时二维码PNG保存在 qr_images 表中，与订单在同一事务内写入和删除，
+文件目录仅作为读取缓存。
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+
+BASE36_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+SHORT_CODE_PREFIX = "/q"
+
+# 短码格式：1-12位小写base36（36^12 < 2^63，解码结果不会超出SQLite整数范围）
+SHORT_CODE_PATTERN = re.compile(r'[0-9a-z]{1,12}')
+
+# SQLite单条语句的参数数量有限，批量查询时分块
+SQL_CHUNK_SIZE = 500
+
+# 二维码存储方式：file（文件目录）或 sqlite（qr_images表，文件目录作缓存）
+QR_STORAGE_FILE = 'file'
+QR_STORAGE_SQLITE = 'sqlite'
+
+
+def get_qr_storage_backend():
+    """读取二维码存储方式配置（环境变量 QR_STORAGE），默认文件存储"""
+    backend = os.environ.get('QR_STORAGE', QR_STORAGE_FILE).strip().lower()
+    return QR_STORAGE_SQLITE if backend == QR_STORAGE_SQLITE else QR_STORAGE_FILE
+
+
+def encode_base36(number):
+    """将正整数编码为base36短码"""
+    if number < 0:
+        raise ValueError("短码编号不能为负数")
+    if number == 0:
+        return BASE36_ALPHABET[0]
+    digits = []
+    while number:
+        number, remainder = divmod(number, 36)
+        digits.append(BASE36_ALPHABET[remainder])
+    return ''.join(reversed(digits))
+
+
+def decode_base36(code):
+    """将base36短码解码为整数，格式非法（含空白、符号或超长）时抛出ValueError"""
+    code = code.lower() if isinstance(code, str) else ''
+    if not SHORT_CODE_PATTERN.fullmatch(code):
+        raise ValueError("短码格式无效")
+    return int(code, 36)
+
+
+def get_canonical_base_url():
+    """读取配置的二维码规范域名（环境变量 QR_BASE_URL），未配置时返回None"""
+    base_url = os.environ.get('QR_BASE_URL', '').strip()
+    return base_url.rstrip('/') or None
+
+
+def build_qr_payload(base_url, short_code):
+    """生成二维码内容：<规范域名>/q/<短码>"""
+    return f"{base_url.rstrip('/')}{SHORT_CODE_PREFIX}/{short_code}"
+
+
+def assign_short_codes(cursor, order_ids):
+    """为订单分配短码（已分配的保持不变），返回 {order_id: 短码}"""
+    order_ids = list(order_ids)
+    cursor.executemany(
+        'INSERT OR IGNORE INTO qr_short_codes (order_id) VALUES (?)',
+        [(order_id,) for order_id in order_ids]
+    )
+    return get_short_codes(cursor, order_ids)
+
+
+def get_short_codes(cursor, order_ids):
+    """批量查询订单的短码，未分配短码的订单不出现在结果中"""
+    order_ids = list(order_ids)
+    short_codes = {}
+    for start in range(0, len(order_ids), SQL_CHUNK_SIZE):
+        chunk = order_ids[start:start + SQL_CHUNK_SIZE]
+        placeholders = ','.join(['?' for _ in chunk])
+        cursor.execute(
+            f'SELECT id, order_id FROM qr_short_codes WHERE order_id IN ({placeholders})',
+            chunk
+        )
+        for code_id, order_id in cursor.fetchall():
+            short_codes[order_id] = encode_base36(code_id)
+    return short_codes
+
+
+def resolve_short_code(cursor, short_code):
+    """根据短码查找订单号（主键查询），找不到时返回None"""
+    try:
+        code_id = decode_base36(short_code)
+    except ValueError:
+        return None
+    cursor.execute('SELECT order_id FROM qr_short_codes WHERE id = ?', (code_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def qr_relative_path(order_id):
+    """二维码图片相对二维码目录的分片路径：ab/cd/order_X.png"""
+    digest = hashlib.md5(str(order_id).encode('utf-8')).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}/order_{order_id}.png"
+
+
+def qr_file_path(qr_dir, order_id):
+    """二维码图片的完整分片路径"""
+    return os.path.join(qr_dir, qr_relative_path(order_id))
+
+
+def legacy_qr_file_path(qr_dir, order_id):
+    """旧版平铺存储的二维码路径（迁移前生成的文件）"""
+    return os.path.join(qr_dir, f"order_{order_id}.png")
+
+
+def find_qr_file(qr_dir, order_id):
+    """查找订单二维码文件，优先分片路径，兼容未迁移的旧文件，不存在时返回None"""
+    for path in (qr_file_path(qr_dir, order_id), legacy_qr_file_path(qr_dir, order_id)):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def record_qr_files(cursor, entries):
+    """写入二维码文件索引，entries 为 [(order_id, 相对路径, 文件大小)]"""
+    cursor.executemany('''
+        INSERT INTO qr_code_index (order_id, file_path, file_size, updated_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(order_id) DO UPDATE SET
+            file_path = excluded.file_path,
+            file_size = excluded.file_size,
+            updated_at = CURRENT_TIMESTAMP
+    ''', entries)
+
+
+def get_indexed_qr_paths(cursor, order_ids):
+    """批量查询已索引的二维码相对路径，返回 {order_id: 相对路径}"""
+    order_ids = list(order_ids)
+    paths = {}
+    for start in range(0, len(order_ids), SQL_CHUNK_SIZE):
+        chunk = order_ids[start:start + SQL_CHUNK_SIZE]
+        placeholders = ','.join(['?' for _ in chunk])
+        cursor.execute(
+            f'SELECT order_id, file_path FROM qr_code_index WHERE order_id IN ({placeholders})',
+            chunk
+        )
+        paths.update(cursor.fetchall())
+    return paths
+
+
+def list_qr_index(cursor, page=1, page_size=100):
+    """分页读取二维码索引，返回 (总数, [(order_id, 相对路径, 更新时间)])"""
+    cursor.execute('SELECT COUNT(*) FROM qr_code_index')
+    total = cursor.fetchone()[0]
+    cursor.execute('''
+        SELECT order_id, file_path, updated_at
+        FROM qr_code_index
+        ORDER BY id
+        LIMIT ? OFFSET ?
+    ''', (page_size, (page - 1) * page_size))
+    return total, cursor.fetchall()
+
+
+def remove_qr_files(cursor, qr_dir, order_ids):
+    """删除订单的二维码文件、数据库图片及索引记录，返回删除的文件数
+
+    数据库中的记录随调用方的事务一起提交，文件（或缓存文件）删除失败不会留下孤立的图片数据。
+    """
+    order_ids = list(order_ids)
+    removed = 0
+    for order_id in order_ids:
+        for path in (qr_file_path(qr_dir, order_id), legacy_qr_file_path(qr_dir, order_id)):
+            if os.path.exists(path):
+                os.remove(path)
+                removed += 1
+    for start in range(0, len(order_ids), SQL_CHUNK_SIZE):
+        chunk = order_ids[start:start + SQL_CHUNK_SIZE]
+        placeholders = ','.join(['?' for _ in chunk])
+        cursor.execute(f'DELETE FROM qr_code_index WHERE order_id IN ({placeholders})', chunk)
+        cursor.execute(f'DELETE FROM qr_images WHERE order_id IN ({placeholders})', chunk)
+    return removed
+
+
+def save_qr_blob(cursor, order_id, png_bytes):
+    """保存二维码PNG到qr_images表（随调用方事务提交）"""
+    cursor.execute('''
+        INSERT INTO qr_images (order_id, image, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(order_id) DO UPDATE SET
+            image = excluded.image,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (order_id, sqlite3.Binary(png_bytes)))
+
+
+def get_qr_blob_size(cursor, order_id):
+    """查询数据库中二维码图片的字节数（不读取图片内容），不存在时返回None"""
+    cursor.execute('SELECT length(image) FROM qr_images WHERE order_id = ?', (order_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def load_qr_blobs(cursor, order_ids):
+    """批量读取二维码图片，返回 {order_id: memoryview}，后续切片和写出不再复制数据"""
+    order_ids = list(order_ids)
+    blobs = {}
+    for start in range(0, len(order_ids), SQL_CHUNK_SIZE):
+        chunk = order_ids[start:start + SQL_CHUNK_SIZE]
+        placeholders = ','.join(['?' for _ in chunk])
+        cursor.execute(
+            f'SELECT order_id, image FROM qr_images WHERE order_id IN ({placeholders})',
+            chunk
+        )
+        for order_id, image in cursor.fetchall():
+            blobs[order_id] = memoryview(image)
+    return blobs
+
+
+def write_qr_cache_file(qr_dir, order_id, data):
+    """把数据库中的二维码写入文件缓存（先写临时文件再替换，多进程并发写入安全）"""
+    path = qr_file_path(qr_dir, order_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+
+class ZipStreamBuffer:
+    """供 zipfile 写入的只追加缓冲区（不支持seek），每写完一个条目就取出数据作为流式响应输出"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        # 不可变数据（bytes、数据库图片的memoryview）直接保留引用，drain 时只合并复制一次
+        if isinstance(data, bytearray) or (isinstance(data, memoryview) and not data.readonly):
+            data = bytes(data)
+        self._chunks.append(data)
+        return data.nbytes if isinstance(data, memoryview) else len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """取出并清空已写入的数据"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+库存对账脚本
+按库存流水重新计算每个物料的账面库存，报告与 inventory_items 不一致的物料和分类汇总，
+加 --repair 参数时在同一事务中修复（含重建分类汇总），可定期执行（如每天一次的计划任务）
+"""
+
+import sqlite3
+import sys
+
+from excel_processor import OrderProcessor
+from inventory_store import reconcile_inventory
+
+
+def reconcile(db_file="orders.db", repair=False):
+    """库存对账"""
+    print(f"🔍 开始库存对账{'（修复模式）' if repair else ''}...")
+
+    # 确保对账索引和期初余额存在
+    OrderProcessor(db_file=db_file, base_url="").init_database()
+
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+
+    try:
+        result = reconcile_inventory(cursor, repair=repair)
+        conn.commit()
+
+        for item in result['drift']:
+            print(f"⚠️  {item['item_code']}: 库存 {item['current_stock']} / 账面 {item['ledger_stock']}"
+                  f"（差异 {item['stock_drift']}），金额差异 {item['value_drift']}")
+        for item in result['orphans']:
+            print(f"⚠️  {item['item_code']}: 物料已删除，账面库存 {item['ledger_stock']} 未冲销"
+                  f"（{item['transaction_count']} 条流水）")
+        for category in result['rollup_drift']:
+            print(f"⚠️  分类汇总 {category} 与物料不一致")
+
+        print(f"✅ 库存对账完成！共检查 {result['checked']} 个物料，"
+              f"不一致 {len(result['drift'])} 个，未冲销的已删除物料 {len(result['orphans'])} 个，"
+              f"汇总不一致分类 {len(result['rollup_drift'])} 个"
+              f"{'，已修复' if result['repaired'] else ''}")
+
+    except Exception as e:
+        print(f"❌ 库存对账失败: {str(e)}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--repair"]
+    db_path = args[0] if args else "orders.db"
+    reconcile(db_path, repair="--repair" in sys.argv[1:])
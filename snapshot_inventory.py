@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+库存余额快照脚本
+记录当天所有物料的库存余额快照，供历史库存查询使用，
+可定期执行（如每天一次的计划任务）
+"""
+
+import sqlite3
+import sys
+
+from excel_processor import OrderProcessor
+from inventory_store import create_inventory_snapshot
+
+
+def snapshot_inventory(db_file="orders.db", snapshot_date=None):
+    """记录库存余额快照"""
+    print("📸 开始记录库存余额快照...")
+
+    # 确保快照表存在
+    OrderProcessor(db_file=db_file, base_url="").init_database()
+
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+
+    try:
+        count = create_inventory_snapshot(cursor, snapshot_date)
+        conn.commit()
+        print(f"✅ 库存余额快照完成！共记录 {count} 个物料")
+
+    except Exception as e:
+        print(f"❌ 记录快照失败: {str(e)}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "orders.db"
+    snapshot_inventory(db_path)
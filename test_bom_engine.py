@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试BOM展开引擎：循环引用被拒绝、增量重建物料反查索引与全量重建结果一致
+"""
+
+import random
+
+import pytest
+
+from bom_engine import BomCycleError, BomGraph, rebuild_where_used
+from cost_engine import BatchCostEngine, CostRules, simulate_cost_changes
+
+# KIT → A → B → A 形成循环，KIT 依赖循环；GOOD 与循环无关
+CYCLIC_BOM = [
+    ('KIT', 'A', 1),
+    ('A', 'B', 2),
+    ('B', 'A', 1),
+    ('B', 'RAW', 3),
+    ('GOOD', 'RAW', 4),
+]
+
+
+def where_used_rows(conn):
+    return sorted(conn.execute('SELECT material_code, product_code, depth FROM bom_where_used').fetchall())
+
+
+def full_rebuild_rows(conn):
+    cursor = conn.cursor()
+    cursor.execute('SAVEPOINT full_rebuild')
+    rebuild_where_used(cursor)
+    rows = where_used_rows(conn)
+    cursor.execute('ROLLBACK TO full_rebuild')
+    cursor.execute('RELEASE full_rebuild')
+    return rows
+
+
+def test_incremental_where_used_matches_full_rebuild(conn):
+    # 多级结构：L0 → L1 → L2 → 原料，随机增删子件后只重建变更产品
+    rng = random.Random(7)
+    levels = [[f'L{level}_{index}' for index in range(4)] for level in range(3)]
+    materials = ['RAW001', 'RAW002', 'RAW003', 'PKG001', 'PART001']
+    cursor = conn.cursor()
+
+    def lower_codes(product_code):
+        level = int(product_code[1])
+        return [code for lower in levels[level + 1:] for code in lower] + materials
+
+    for _ in range(60):
+        product_code = rng.choice([code for level in levels for code in level])
+        material_code = rng.choice(lower_codes(product_code))
+        cursor.execute(
+            'DELETE FROM bom_items WHERE product_code = ? AND material_code = ?', (product_code, material_code)
+        )
+        if cursor.rowcount == 0:
+            cursor.execute(
+                'INSERT INTO bom_items (product_code, material_code, required_quantity, unit) VALUES (?, ?, 1, ?)',
+                (product_code, material_code, '个')
+            )
+        rebuild_where_used(cursor, BomGraph.load(cursor), changed_products=[product_code])
+        assert where_used_rows(conn) == full_rebuild_rows(conn)
+
+
+def test_unchanged_products_are_left_alone(conn):
+    cursor = conn.cursor()
+    before = where_used_rows(conn)
+    assert rebuild_where_used(cursor, changed_products=[]) == 0
+    assert where_used_rows(conn) == before
+    # PROD002 没有上层产品，只重写它自己的索引行
+    written = rebuild_where_used(cursor, changed_products=['PROD002'])
+    assert written == len([row for row in before if row[1] == 'PROD002'])
+    assert where_used_rows(conn) == before
+
+
+def test_cycle_is_detected_and_rejected():
+    graph = BomGraph(CYCLIC_BOM, {'RAW': (2.0, 0, '个')})
+
+    assert graph.cyclic == {'KIT', 'A', 'B'}
+    cycle = graph.find_cycle('KIT')
+    assert cycle[0] == cycle[-1] and set(cycle) == {'A', 'B'}
+    assert graph.find_cycle('GOOD') is None
+
+    with pytest.raises(BomCycleError):
+        graph.flatten('KIT')
+    with pytest.raises(BomCycleError):
+        graph.unit_cost('A')
+    assert graph.flatten('GOOD') == {'RAW': 4.0}
+    assert graph.unit_cost('GOOD') == 8.0
+
+
+def test_batch_engine_skips_cyclic_products():
+    engine = BatchCostEngine(BomGraph(CYCLIC_BOM, {'RAW': (2.0, 0, '个')}), CostRules([]))
+
+    assert engine.products == ['GOOD']
+    assert set(engine.errors) == {'KIT', 'A', 'B'}
+    records, errors = engine.quote([('GOOD', 2, 0), ('KIT', 1, 0)])
+    assert [record['product_code'] for record in records] == ['GOOD']
+    assert 'KIT' in errors
+
+
+def test_simulation_reports_cyclic_products(conn):
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO bom_items (product_code, material_code, required_quantity, unit) VALUES (?, ?, ?, '个')",
+        [('LOOP_A', 'LOOP_B', 1), ('LOOP_B', 'LOOP_A', 1)]
+    )
+
+    result = simulate_cost_changes(cursor, price_changes={'RAW001': 10})
+
+    assert set(result['errors']) == {'LOOP_A', 'LOOP_B'}
+    assert {product['product_code'] for product in result['products']} == {'PROD001'}
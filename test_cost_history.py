@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试成本快照去重和成本历史压缩：成本 A→B→A 变化时历史保留三段，已有快照的计算时间不被改写
+"""
+
+from cost_engine import calculate_product_cost, compact_cost_history, save_cost_records
+
+
+def set_price(conn, item_code, price):
+    conn.execute('UPDATE inventory_items SET weighted_avg_price = ? WHERE item_code = ?', (price, item_code))
+
+
+def save_snapshot(conn, calculation_date, quantity=1):
+    """保存 PROD001 的成本快照，并把新写入快照的计算时间改为指定时间"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM production_costs')
+    last_id = cursor.fetchone()[0]
+    inserted = save_cost_records(cursor, [calculate_product_cost(cursor, 'PROD001', quantity)])
+    cursor.execute('''
+        UPDATE production_costs SET calculation_date = ?, last_seen_at = ? WHERE id > ?
+    ''', (calculation_date, calculation_date, last_id))
+    conn.commit()
+    return inserted
+
+
+def history(conn):
+    return conn.execute('''
+        SELECT calculation_date, unit_cost FROM production_costs
+        WHERE product_code = 'PROD001' ORDER BY calculation_date, id
+    ''').fetchall()
+
+
+def test_price_round_trip_keeps_three_periods(conn):
+    assert save_snapshot(conn, '2024-01-01 00:00:00') == 1
+    cost_a = history(conn)[0][1]
+
+    set_price(conn, 'RAW001', 20)
+    assert save_snapshot(conn, '2024-02-01 00:00:00') == 1
+    set_price(conn, 'RAW001', 8.5)
+    assert save_snapshot(conn, '2024-03-01 00:00:00') == 1
+
+    rows = history(conn)
+    assert [row[0] for row in rows] == ['2024-01-01 00:00:00', '2024-02-01 00:00:00', '2024-03-01 00:00:00']
+    assert rows[0][1] == rows[2][1] == cost_a
+    assert rows[1][1] > cost_a
+
+
+def test_unchanged_cost_keeps_original_date(conn):
+    save_snapshot(conn, '2024-01-01 00:00:00')
+    # 成本不变（不同数量的单位成本相同）时不新增记录，原快照的计算时间不变，只刷新 last_seen_at
+    assert save_snapshot(conn, '2024-05-01 00:00:00', quantity=3) == 0
+    rows = conn.execute('''
+        SELECT calculation_date, last_seen_at FROM production_costs WHERE product_code = 'PROD001'
+    ''').fetchall()
+    assert len(rows) == 1
+    assert rows[0][0] == '2024-01-01 00:00:00'
+    assert rows[0][1] > rows[0][0]
+
+
+def test_compact_merges_only_consecutive_duplicates(conn):
+    save_snapshot(conn, '2024-01-01 00:00:00')
+    set_price(conn, 'RAW001', 20)
+    save_snapshot(conn, '2024-02-01 00:00:00')
+    set_price(conn, 'RAW001', 8.5)
+    save_snapshot(conn, '2024-03-01 00:00:00')
+
+    # 模拟旧版本写入的连续重复快照（没有内容哈希）
+    conn.execute('''
+        INSERT INTO production_costs (
+            cost_id, product_code, material_cost, labor_cost, management_cost, transport_cost,
+            other_cost, tax_cost, total_cost, quantity, unit_cost, calculation_date
+        )
+        SELECT 'legacy', product_code, material_cost, labor_cost, management_cost, transport_cost,
+               other_cost, tax_cost, total_cost, quantity, unit_cost, '2024-04-01 00:00:00'
+        FROM production_costs WHERE calculation_date = '2024-03-01 00:00:00'
+    ''')
+    conn.commit()
+
+    cursor = conn.cursor()
+    merged, trimmed = compact_cost_history(cursor)
+    conn.commit()
+
+    assert (merged, trimmed) == (1, 0)
+    assert [row[0] for row in history(conn)] == ['2024-01-01 00:00:00', '2024-02-01 00:00:00', '2024-03-01 00:00:00']
+    last_seen = conn.execute('''
+        SELECT last_seen_at FROM production_costs WHERE calculation_date = '2024-03-01 00:00:00'
+    ''').fetchone()[0]
+    assert last_seen == '2024-04-01 00:00:00'
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试带单价入库后只重算使用该物料的产品成本
+"""
+
+import contextlib
+import io
+
+from excel_processor import OrderProcessor
+
+
+def cost_snapshots(conn):
+    return dict(conn.execute('SELECT product_code, COUNT(*) FROM production_costs GROUP BY product_code').fetchall())
+
+
+def test_priced_stock_in_refreshes_affected_products(conn, db_file):
+    processor = OrderProcessor(db_file=db_file, base_url='http://test')
+    with contextlib.redirect_stdout(io.StringIO()):
+        # 不带单价的入库不改变加权平均价，不重算成本
+        assert processor.update_product_stock('RAW001', 10)
+        assert cost_snapshots(conn) == {}
+
+        assert processor.update_product_stock('RAW001', 10, unit_price=50)
+
+    users = {row[0] for row in conn.execute("SELECT product_code FROM bom_where_used WHERE material_code = 'RAW001'")}
+    assert users
+    assert set(cost_snapshots(conn)) == users
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试库存流水：有无快照时的历史库存查询、库存对账、旧表迁移和兼容视图的写入
+"""
+
+import calendar
+import contextlib
+import io
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+
+from excel_processor import OrderProcessor
+from inventory_store import (
+    apply_stock_changes, create_inventory_snapshot, get_inventory_as_of, reconcile_inventory, record_item_deletion,
+    record_transactions
+)
+
+
+def noon(day):
+    """某日（本地时间）中午的Unix时间戳"""
+    return int(time.mktime(datetime.strptime(f'{day} 12:00', '%Y-%m-%d %H:%M').timetuple()))
+
+
+def move(cursor, item_code, quantity, total_amount=None, day='2024-01-10'):
+    """按指定日期记录一笔库存变动，同时更新库存余额"""
+    unit_price = total_amount / quantity if total_amount else None
+    record_transactions(cursor, [(
+        item_code, 'in' if quantity > 0 else 'out', quantity, unit_price, total_amount, '测试'
+    )], created_at=noon(day))
+    apply_stock_changes(cursor, [(item_code, quantity, total_amount)])
+
+
+def current(cursor, item_code):
+    cursor.execute('SELECT current_stock, weighted_avg_price FROM inventory_items WHERE item_code = ?', (item_code,))
+    return tuple(float(value) for value in cursor.fetchone())
+
+
+def test_as_of_without_snapshot_rolls_back_from_current(conn):
+    cursor = conn.cursor()
+    move(cursor, 'RAW001', 100, 1000, day='2024-01-10')
+    move(cursor, 'RAW001', -30, day='2024-01-10')
+    move(cursor, 'RAW001', 50, 800, day='2024-01-12')
+    move(cursor, 'RAW001', -20, day='2024-01-12')
+    conn.commit()
+    stock, price = current(cursor, 'RAW001')
+
+    method, snapshot_date, balances, scanned = get_inventory_as_of(cursor, '2024-01-11')
+
+    assert (method, snapshot_date, scanned) == ('current', None, 2)
+    as_of_stock, as_of_price, value = balances['RAW001']
+    assert as_of_stock == pytest.approx(stock - 30)
+    # 没有快照时价值按当前单价估算
+    assert as_of_price == pytest.approx(price)
+    assert value == pytest.approx((stock - 30) * price)
+
+    # 期初余额流水不计入历史库存
+    assert get_inventory_as_of(cursor, '2024-01-12')[2]['RAW001'][0] == pytest.approx(stock)
+
+
+def test_as_of_replays_ledger_after_snapshot(conn):
+    cursor = conn.cursor()
+    move(cursor, 'RAW001', 100, 1000, day='2024-01-10')
+    move(cursor, 'RAW001', -30, day='2024-01-10')
+    create_inventory_snapshot(cursor, '2024-01-10')
+    snapshot_stock, snapshot_price = current(cursor, 'RAW001')
+
+    move(cursor, 'RAW001', 50, 800, day='2024-01-12')
+    move(cursor, 'RAW001', -20, day='2024-01-12')
+    move(cursor, 'RAW001', 10, 300, day='2024-01-15')
+    conn.commit()
+
+    method, snapshot_date, balances, scanned = get_inventory_as_of(cursor, '2024-01-11')
+    assert (method, snapshot_date, scanned) == ('snapshot', '2024-01-10', 0)
+    assert balances['RAW001'][:2] == pytest.approx((snapshot_stock, snapshot_price))
+
+    # 只重放快照之后、该日结束前的流水，单价按移动加权平均重算
+    method, snapshot_date, balances, scanned = get_inventory_as_of(cursor, '2024-01-12')
+    assert (method, snapshot_date, scanned) == ('snapshot', '2024-01-10', 2)
+    expected_price = (snapshot_price * snapshot_stock + 800) / (snapshot_stock + 50)
+    assert balances['RAW001'] == pytest.approx((
+        snapshot_stock + 30, expected_price, (snapshot_stock + 30) * expected_price
+    ))
+
+    # 重放到最后一笔流水之后与当前库存一致
+    assert get_inventory_as_of(cursor, '2024-01-20')[2]['RAW001'][:2] == pytest.approx(current(cursor, 'RAW001'))
+
+
+def test_reconcile_reports_and_repairs_drift(conn):
+    cursor = conn.cursor()
+    move(cursor, 'RAW001', 100, 1000)
+    move(cursor, 'RAW002', -5)
+    conn.commit()
+    assert reconcile_inventory(cursor)['drift'] == []
+
+    # 绕过流水直接改库存：RAW001 数量偏离，RAW002 只有金额偏离
+    cursor.execute("UPDATE inventory_items SET current_stock = current_stock + 7 WHERE item_code = 'RAW001'")
+    cursor.execute("UPDATE inventory_items SET total_value = total_value + 50 WHERE item_code = 'RAW002'")
+    # 已删除物料遗留的流水
+    record_transactions(cursor, [('GONE001', 'in', 3, None, None, '测试')])
+    conn.commit()
+    stock, price = current(cursor, 'RAW001')
+
+    report = reconcile_inventory(cursor)
+    drift = {item['item_code']: item for item in report['drift']}
+    assert set(drift) == {'RAW001', 'RAW002'}
+    assert drift['RAW001']['stock_drift'] == pytest.approx(7)
+    assert drift['RAW001']['ledger_stock'] == pytest.approx(stock - 7)
+    assert drift['RAW002']['stock_drift'] == 0
+    assert drift['RAW002']['value_drift'] == pytest.approx(50)
+    assert report['orphans'] == [{'item_code': 'GONE001', 'ledger_stock': 3, 'transaction_count': 1}]
+    assert not report['repaired']
+    assert current(cursor, 'RAW001') == (stock, price)
+
+    repaired = reconcile_inventory(cursor, repair=True)
+    conn.commit()
+    assert repaired['repaired']
+    assert current(cursor, 'RAW001') == pytest.approx((stock - 7, price))
+
+    after = reconcile_inventory(cursor)
+    assert (after['drift'], after['orphans'], after['repaired']) == ([], [], False)
+    # 修复只补记冲销流水，已删除物料的流水仍保留
+    cursor.execute('''
+        SELECT COUNT(*), SUM(l.quantity) FROM inventory_ledger l
+        JOIN inventory_item_keys k ON k.item_id = l.item_id WHERE k.item_code = 'GONE001'
+    ''')
+    assert cursor.fetchone() == (2, 0)
+
+
+def test_deleted_item_keeps_as_of_history(conn):
+    cursor = conn.cursor()
+    move(cursor, 'RAW001', 100, 1000, day='2024-01-10')
+    create_inventory_snapshot(cursor, '2024-01-10')
+    move(cursor, 'RAW001', -30, day='2024-01-12')
+    conn.commit()
+    before = {day: get_inventory_as_of(cursor, day)[2]['RAW001'] for day in ('2024-01-05', '2024-01-12')}
+
+    record_item_deletion(cursor, 'RAW001')
+    cursor.execute("DELETE FROM inventory_items WHERE item_code = 'RAW001'")
+    conn.commit()
+
+    # 删除日之前的历史库存不变（快照重放和从当前库存倒推两种方式）
+    for day, balance in before.items():
+        assert get_inventory_as_of(cursor, day)[2]['RAW001'] == pytest.approx(balance)
+    cursor.execute("SELECT COUNT(*) FROM inventory_snapshots WHERE item_code = 'RAW001'")
+    assert cursor.fetchone()[0] == 1
+    # 冲销后账面库存为零，对账不报告
+    assert reconcile_inventory(cursor)['orphans'] == []
+
+
+def test_reconcile_within_tolerance_is_clean(conn):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE inventory_items SET total_value = total_value + 0.004 WHERE item_code = 'RAW003'")
+    conn.commit()
+    assert reconcile_inventory(cursor)['drift'] == []
+
+
+LEGACY_TRANSACTIONS = [
+    (5, 'RAW001', 'in', 100, 10.0, 1000.0, '2024-01-10 04:00:00', '采购'),
+    (7, 'RAW001', 'out', 30, None, None, '2024-01-11T12:00:00', '销售订单 SO1 出库'),
+    (9, 'RAW002', '采购入库', 20, 12.0, 240.0, '2024-01-12 01:30:00', None),
+]
+
+
+def init_database(db_file):
+    processor = OrderProcessor(db_file=db_file, base_url='http://test')
+    with contextlib.redirect_stdout(io.StringIO()):
+        processor.init_database()
+
+
+def test_legacy_transactions_are_migrated(tmp_path):
+    db_file = str(tmp_path / 'legacy.db')
+    legacy = sqlite3.connect(db_file)
+    legacy.execute('''
+        CREATE TABLE inventory_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_code TEXT NOT NULL,
+            transaction_type TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            unit_price REAL,
+            total_amount REAL,
+            transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            notes TEXT
+        )
+    ''')
+    legacy.executemany('INSERT INTO inventory_transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?)', LEGACY_TRANSACTIONS)
+    legacy.commit()
+    legacy.close()
+
+    init_database(db_file)
+    # 再次初始化不重复迁移
+    init_database(db_file)
+
+    conn = sqlite3.connect(db_file)
+    try:
+        assert conn.execute(
+            "SELECT type FROM sqlite_master WHERE name = 'inventory_transactions'"
+        ).fetchone()[0] == 'view'
+
+        ledger = conn.execute('''
+            SELECT l.id, k.item_code, t.type_name, l.quantity, l.created_at
+            FROM inventory_ledger l
+            JOIN inventory_item_keys k ON k.item_id = l.item_id
+            JOIN inventory_transaction_types t ON t.type_id = l.type_id
+            ORDER BY l.id
+        ''').fetchall()
+        # 流水id不变，'out' 数量改为负数；CURRENT_TIMESTAMP 格式按UTC、带'T'的按本地时间换算
+        assert ledger == [
+            (5, 'RAW001', 'in', 100, calendar.timegm((2024, 1, 10, 4, 0, 0))),
+            (7, 'RAW001', 'out', -30, int(time.mktime((2024, 1, 11, 12, 0, 0, 0, 0, -1)))),
+            (9, 'RAW002', '采购入库', 20, calendar.timegm((2024, 1, 12, 1, 30, 0))),
+        ]
+
+        # 兼容视图保持旧表的字段和符号
+        view_rows = conn.execute('''
+            SELECT id, item_code, transaction_type, quantity, unit_price, total_amount, notes
+            FROM inventory_transactions ORDER BY id
+        ''').fetchall()
+        assert view_rows == [row[:6] + row[7:] for row in LEGACY_TRANSACTIONS]
+
+        # 新流水的id接在迁移的流水之后
+        conn.execute("INSERT INTO inventory_transactions (item_code, transaction_type, quantity) VALUES ('RAW001', 'in', 1)")
+        assert conn.execute('SELECT MAX(id) FROM inventory_ledger').fetchone()[0] == 10
+    finally:
+        conn.close()
+
+
+def test_view_insert_and_delete_write_through_to_ledger(conn):
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO inventory_transactions
+        (item_code, transaction_type, quantity, unit_price, total_amount, transaction_date, notes)
+        VALUES ('RAW001', 'out', 4, NULL, NULL, '2024-02-01 08:00:00', '视图出库'),
+               ('NEW001', '盘点调整', 2, 5.0, 10.0, NULL, '视图调整')
+    ''')
+    conn.commit()
+
+    rows = dict(cursor.execute('''
+        SELECT notes, quantity FROM inventory_ledger WHERE notes LIKE '视图%'
+    ''').fetchall())
+    assert rows == {'视图出库': -4, '视图调整': 2}
+    assert cursor.execute(
+        "SELECT created_at FROM inventory_ledger WHERE notes = '视图出库'"
+    ).fetchone()[0] == calendar.timegm((2024, 2, 1, 8, 0, 0))
+    # 没有时间时取当前时间，新物料和新流水类型自动登记
+    assert abs(cursor.execute(
+        "SELECT created_at FROM inventory_ledger WHERE notes = '视图调整'"
+    ).fetchone()[0] - time.time()) < 60
+    assert cursor.execute("SELECT 1 FROM inventory_item_keys WHERE item_code = 'NEW001'").fetchone()
+    assert cursor.execute("SELECT 1 FROM inventory_transaction_types WHERE type_name = '盘点调整'").fetchone()
+
+    view_row = cursor.execute('''
+        SELECT transaction_type, quantity, transaction_date FROM inventory_transactions WHERE notes = '视图出库'
+    ''').fetchone()
+    assert view_row == ('out', 4, '2024-02-01 08:00:00')
+
+    cursor.execute("DELETE FROM inventory_transactions WHERE notes LIKE '视图%'")
+    conn.commit()
+    assert cursor.execute("SELECT COUNT(*) FROM inventory_ledger WHERE notes LIKE '视图%'").fetchone()[0] == 0
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试库存分类汇总：触发器维护的汇总与重新分组结果一致，库存等于阈值算库存不足，
+对账发现汇总表偏离，修复时全量重建
+"""
+
+import contextlib
+import io
+
+import pytest
+
+from excel_processor import OrderProcessor
+from inventory_store import apply_stock_changes, check_category_rollup, load_category_rollup, reconcile_inventory
+
+
+def grouped(conn):
+    """按物料重新分组计算的汇总"""
+    return {
+        row[0]: row[1:] for row in conn.execute('''
+            SELECT item_category, COUNT(*), SUM(current_stock), SUM(total_value), SUM(weighted_avg_price),
+                   SUM(current_stock <= COALESCE(low_stock_threshold, 100))
+            FROM inventory_items GROUP BY item_category
+        ''')
+    }
+
+
+def rollup(conn):
+    return {
+        row[0]: row[1:] for row in conn.execute('''
+            SELECT item_category, item_count, total_stock, total_value, price_sum, low_stock_count
+            FROM inventory_category_rollup
+        ''')
+    }
+
+
+def assert_rollup_matches(conn):
+    expected, actual = grouped(conn), rollup(conn)
+    assert set(actual) == set(expected)
+    for category, values in expected.items():
+        assert actual[category] == pytest.approx(values), category
+
+
+def test_triggers_keep_rollup_in_step(conn):
+    cursor = conn.cursor()
+    assert_rollup_matches(conn)
+
+    # 新增物料（含新分类）
+    cursor.executemany('''
+        INSERT INTO inventory_items
+        (item_code, item_name, item_category, unit, current_stock, weighted_avg_price, total_value,
+         low_stock_threshold, warning_stock_threshold)
+        VALUES (?, ?, ?, '个', ?, ?, ?, ?, ?)
+    ''', [
+        ('TOOL001', '扳手', '工具', 3, 20.0, 60.0, 5, 10),
+        ('TOOL002', '钳子', '工具', 50, 8.0, 400.0, None, None),
+        ('RAW009', '铜', '原材料', 500, 30.0, 15000.0, 100, 200),
+    ])
+    assert_rollup_matches(conn)
+
+    # 库存变动、改单价、改阈值、改分类
+    apply_stock_changes(cursor, [('RAW001', -40, None), ('TOOL001', 10, 250.0), ('RAW009', -450, None)])
+    cursor.execute("UPDATE inventory_items SET weighted_avg_price = 9.5, total_value = current_stock * 9.5 WHERE item_code = 'RAW002'")
+    cursor.execute("UPDATE inventory_items SET low_stock_threshold = 1000 WHERE item_code = 'TOOL002'")
+    cursor.execute("UPDATE inventory_items SET item_category = '工具' WHERE item_code = 'PART001'")
+    assert_rollup_matches(conn)
+
+    # 删除物料，分类清空后汇总行也删除
+    cursor.execute("DELETE FROM inventory_items WHERE item_code = 'PKG001'")
+    cursor.execute("DELETE FROM inventory_items WHERE item_category = '工具'")
+    conn.commit()
+    assert_rollup_matches(conn)
+    assert '工具' not in rollup(conn)
+    assert check_category_rollup(cursor) == []
+
+    categories = {row['category']: row for row in load_category_rollup(cursor)}
+    assert set(categories) == set(grouped(conn))
+
+
+def test_reconcile_repairs_rollup_drift(conn):
+    cursor = conn.cursor()
+    assert check_category_rollup(cursor) == []
+
+    # 绕过触发器直接改汇总表：数量偏离、缺一个分类、多一个分类
+    cursor.execute("UPDATE inventory_category_rollup SET total_stock = total_stock + 5 WHERE item_category = '原材料'")
+    cursor.execute("DELETE FROM inventory_category_rollup WHERE item_category = '包装'")
+    cursor.execute('''
+        INSERT INTO inventory_category_rollup
+        (item_category, item_count, total_stock, total_value, price_sum, low_stock_count)
+        VALUES ('已停用', 1, 0, 0, 0, 0)
+    ''')
+    conn.commit()
+
+    report = reconcile_inventory(cursor)
+    assert report['rollup_drift'] == ['包装', '原材料', '已停用']
+    assert not report['repaired']
+
+    repaired = reconcile_inventory(cursor, repair=True)
+    conn.commit()
+    assert repaired['repaired']
+    assert check_category_rollup(cursor) == []
+    assert reconcile_inventory(cursor)['rollup_drift'] == []
+
+
+def test_stock_at_threshold_counts_as_low(conn, db_file):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE inventory_items SET current_stock = low_stock_threshold WHERE item_code = 'RAW003'")
+    conn.commit()
+    assert_rollup_matches(conn)
+
+    summary = OrderProcessor(db_file=db_file, base_url='http://test').get_inventory_summary()
+    assert 'RAW003' in [item['item_code'] for item in summary['low_stock_items']]
+    low_counts = {category['category']: category['low_stock_count'] for category in summary['categories']}
+    assert low_counts == {category: values[4] for category, values in grouped(conn).items()}
+
+
+def test_init_upgrades_strict_low_stock_definitions(conn, db_file):
+    # 模拟旧版本按“低于阈值”建的部分索引
+    conn.execute('DROP INDEX idx_inventory_items_low_stock')
+    conn.execute('''
+        CREATE INDEX idx_inventory_items_low_stock
+        ON inventory_items (current_stock) WHERE current_stock < COALESCE(low_stock_threshold, 100)
+    ''')
+    conn.execute("UPDATE inventory_items SET current_stock = low_stock_threshold WHERE item_code = 'RAW003'")
+    conn.execute("UPDATE inventory_category_rollup SET low_stock_count = 0")
+    conn.commit()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        OrderProcessor(db_file=db_file, base_url='http://test').init_database()
+
+    definitions = [row[0] for row in conn.execute('''
+        SELECT sql FROM sqlite_master
+        WHERE name IN ('inventory_rollup_insert', 'inventory_rollup_delete', 'inventory_rollup_update',
+                       'idx_inventory_items_low_stock')
+    ''')]
+    assert len(definitions) == 4
+    assert all('current_stock < COALESCE' not in sql for sql in definitions)
+    assert_rollup_matches(conn)
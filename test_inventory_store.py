@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试库存变动原语：多进程同时变动库存不丢失更新、不出现 database is locked
+"""
+
+import multiprocessing
+import sqlite3
+
+from inventory_store import apply_stock_changes, begin_immediate
+
+WORKERS = 6
+INCREMENTS = 200
+
+
+def _increment_stock(db_file, item_code, count, errors):
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    try:
+        for _ in range(count):
+            # 先读后写的事务：读取前就取得写锁
+            begin_immediate(conn)
+            cursor.execute('SELECT current_stock FROM inventory_items WHERE item_code = ?', (item_code,))
+            cursor.fetchone()
+            apply_stock_changes(cursor, [(item_code, 1, None)])
+            conn.commit()
+    except Exception as e:
+        errors.put(repr(e))
+    finally:
+        conn.close()
+
+
+def test_concurrent_increments_are_not_lost(db_file):
+    conn = sqlite3.connect(db_file)
+    before, version = conn.execute(
+        "SELECT current_stock, version FROM inventory_items WHERE item_code = 'RAW001'"
+    ).fetchone()
+    conn.close()
+
+    errors = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_increment_stock, args=(db_file, 'RAW001', INCREMENTS, errors))
+        for _ in range(WORKERS)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+
+    failures = []
+    while not errors.empty():
+        failures.append(errors.get())
+    assert failures == []
+    assert all(process.exitcode == 0 for process in processes)
+
+    conn = sqlite3.connect(db_file)
+    after, new_version = conn.execute(
+        "SELECT current_stock, version FROM inventory_items WHERE item_code = 'RAW001'"
+    ).fetchone()
+    conn.close()
+    assert after == before + WORKERS * INCREMENTS
+    assert new_version == version + WORKERS * INCREMENTS
+
+
+def test_apply_stock_changes_returns_before_and_after(conn):
+    cursor = conn.cursor()
+    stock = cursor.execute("SELECT current_stock FROM inventory_items WHERE item_code = 'RAW002'").fetchone()[0]
+    changed = apply_stock_changes(cursor, [('RAW002', 10, 100.0), ('RAW002', -4, None), ('NOPE', 1, None)])
+    conn.commit()
+    assert changed == {'RAW002': (stock, stock + 6)}
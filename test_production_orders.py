@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试生产订单：并发处理同一批销售订单只扣减一次原料；只有已下达的生产订单可以完工入库，且只入库一次；
+成品按领用原料成本入库
+"""
+
+import contextlib
+import io
+import sqlite3
+
+from production_order_manager import ProductionOrderManager
+
+
+def product_stock(conn):
+    return conn.execute("SELECT current_stock FROM inventory_items WHERE item_code = 'PROD001'").fetchone()[0]
+
+
+def stocks(conn, item_codes):
+    placeholders = ','.join(['?' for _ in item_codes])
+    return dict(conn.execute(
+        f'SELECT item_code, current_stock FROM inventory_items WHERE item_code IN ({placeholders})', item_codes
+    ).fetchall())
+
+
+def test_overlapping_managers_deduct_demand_once(conn, db_file):
+    conn.execute('''
+        INSERT INTO orders (order_id, customer_name, order_date, amount, product_details, product_code, quantity)
+        VALUES ('SO-1', '张三', '2024-01-01', 100, '产品A', 'PROD001', 6),
+               ('SO-2', '李四', '2024-01-01', 100, '产品A', 'PROD001', 4)
+    ''')
+    conn.commit()
+    materials = ['RAW001', 'RAW002', 'PKG001', 'PART001']
+    before = stocks(conn, materials)
+
+    # 两个导入各自统计到同一批待处理需求，随后先后创建生产订单
+    first = ProductionOrderManager(db_file, conn=sqlite3.connect(db_file))
+    second = ProductionOrderManager(db_file, conn=sqlite3.connect(db_file))
+    try:
+        first_demand = first.get_sales_demand()
+        second_demand = second.get_sales_demand()
+        assert first_demand == second_demand == [('PROD001', 10, 2)]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = [
+                manager.create_production_order(product_code, quantity, sales_rowid=last_rowid)
+                for manager, demand in ((first, first_demand), (second, second_demand))
+                for product_code, quantity, last_rowid in demand
+            ]
+        required = dict(first.get_bom_requirements('PROD001', 10))
+    finally:
+        first.conn.close()
+        second.conn.close()
+
+    assert results == [True, None]
+    after = stocks(conn, materials)
+    for code in materials:
+        assert after[code] == before[code] - required[code]
+
+    production_orders = [row[0] for row in conn.execute('SELECT production_order_id FROM production_orders')]
+    assert len(production_orders) == 1
+    linked = {row[0] for row in conn.execute('SELECT production_order_id FROM orders')}
+    assert linked == set(production_orders)
+
+
+def test_planned_order_cannot_complete(conn, db_file):
+    manager = ProductionOrderManager(db_file, conn=conn)
+    manager.save_production_order('PO-PLANNED', 'PROD001', 5, [('RAW001', 10)], status='planned')
+    conn.commit()
+    stock = product_stock(conn)
+
+    result = manager.complete_production_order('PO-PLANNED')
+
+    assert not result['success']
+    assert '尚未下达' in result['error']
+    assert product_stock(conn) == stock
+    assert conn.execute("SELECT status FROM production_orders WHERE production_order_id = 'PO-PLANNED'").fetchone()[0] == 'planned'
+
+
+def test_released_order_completes_once(conn, db_file):
+    manager = ProductionOrderManager(db_file, conn=conn)
+    manager.save_production_order('PO-RELEASED', 'PROD001', 5, [('RAW001', 10)])
+    conn.commit()
+    stock = product_stock(conn)
+
+    assert manager.complete_production_order('PO-RELEASED')['success']
+    assert product_stock(conn) == stock + 5
+
+    again = manager.complete_production_order('PO-RELEASED')
+    assert not again['success']
+    assert '已完工' in again['error']
+    assert product_stock(conn) == stock + 5
+    assert not manager.complete_production_order('PO-MISSING')['success']
+
+
+def test_receipt_is_valued_at_issued_material_cost(conn, db_file):
+    manager = ProductionOrderManager(db_file, conn=conn)
+    manager.save_production_order('PO-COST', 'PROD001', 5, [('RAW001', 10), ('RAW002', 5)])
+    conn.commit()
+
+    assert manager.complete_production_order('PO-COST')['success']
+
+    unit_price, total_amount = conn.execute('''
+        SELECT unit_price, total_amount FROM inventory_transactions
+        WHERE item_code = 'PROD001' AND transaction_type = '生产入库'
+    ''').fetchone()
+    assert total_amount == 10 * 8.5 + 5 * 12.0
+    assert unit_price == total_amount / 5
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试二维码短码解析：非法或超长短码返回None，不抛出异常
+"""
+
+import pytest
+
+from qr_store import assign_short_codes, resolve_short_code
+
+
+def test_assigned_code_resolves(conn):
+    cursor = conn.cursor()
+    short_code = assign_short_codes(cursor, ['ORD001'])['ORD001']
+    assert resolve_short_code(cursor, short_code) == 'ORD001'
+    assert resolve_short_code(cursor, short_code.upper()) == 'ORD001'
+
+
+@pytest.mark.parametrize('short_code', ['', ' 1', '+1', '1_0', '1 ', 'z' * 13, '9' * 40])
+def test_invalid_code_returns_none(conn, short_code):
+    assign_short_codes(conn.cursor(), ['ORD001'])
+    assert resolve_short_code(conn.cursor(), short_code) is None
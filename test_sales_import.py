@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试销售订单导入：某一行失败时，该行的库存扣减、库存流水和二维码数据一起回滚
+"""
+
+import contextlib
+import io
+
+import pandas as pd
+
+from excel_processor import OrderProcessor
+from qr_store import QR_STORAGE_SQLITE
+
+
+def test_failed_row_leaves_no_orphans(db_file, conn, tmp_path):
+    excel_file = str(tmp_path / 'sales.xlsx')
+    pd.DataFrame([
+        {'订单号': 'SO-OK', '客户姓名': '张三', '订单日期': '2024-01-01',
+         '产品编码': 'PROD001', '产品名称': '产品', '数量': 2, '销售单价': 100},
+        {'订单号': 'SO-BAD', '客户姓名': '李四', '订单日期': '2024-01-01',
+         '产品编码': 'PROD001', '产品名称': '产品', '数量': 3, '销售单价': 100},
+    ]).to_excel(excel_file, index=False)
+
+    # 写入订单时拒绝 SO-BAD：此时库存、流水和二维码都已写入
+    conn.execute('''
+        CREATE TRIGGER reject_order BEFORE INSERT ON orders WHEN NEW.order_id = 'SO-BAD'
+        BEGIN SELECT RAISE(ABORT, 'rejected'); END
+    ''')
+    conn.commit()
+    stock = conn.execute("SELECT current_stock FROM inventory_items WHERE item_code = 'PROD001'").fetchone()[0]
+
+    processor = OrderProcessor(excel_file=excel_file, db_file=db_file, base_url='http://test')
+    processor.qr_storage = QR_STORAGE_SQLITE
+    processor.qr_output_dir = str(tmp_path / 'qrcodes')
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = processor.process_excel_data()
+
+    assert result['success_count'] == 1
+    assert conn.execute("SELECT current_stock FROM inventory_items WHERE item_code = 'PROD001'").fetchone()[0] == stock - 2
+    for table in ('orders', 'qr_images', 'qr_short_codes', 'qr_code_index'):
+        order_ids = [row[0] for row in conn.execute(f'SELECT order_id FROM {table}')]
+        assert order_ids == ['SO-OK'], table
+    notes = [row[0] for row in conn.execute("SELECT notes FROM inventory_transactions WHERE notes LIKE '销售订单%'")]
+    assert notes == ['销售订单 SO-OK 出库']